@@ -0,0 +1,165 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Admission control module:
+Holds the new tasks in the worker while the build queue of their Bamboo server is full, instead of triggering them
+all at once and slowing every build of the server down.
+
+The queue depth of each Bamboo server ('queue.json?expand=queuedBuilds') is sampled at most every 'sample_interval'
+seconds; the builds triggered since the last sample are added to it. The new tasks are admitted, highest priority
+first (then oldest first), until the estimated queue reaches 'max_queued'; the others stay NEW_REQUEST in Redis and
+are admitted by the next sweeps, as the queue drains. While the queue cannot be sampled, every task is admitted.
+"""
+
+
+import sys
+import threading
+
+from os import path
+from time import monotonic
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from metrics import REGISTRY
+
+
+QUEUE_DEPTH = REGISTRY.gauge('bamboo_queue_depth', "Builds waiting in the queue of a Bamboo server, last sample.",
+                             ('server',))
+TASKS_HELD = REGISTRY.gauge('admission_held_tasks', "New tasks held by the worker, Bamboo queue full.", ('server',))
+QUEUE_SAMPLE_ERRORS = REGISTRY.counter('bamboo_queue_sample_errors_total', "Bamboo queue samples which failed.",
+                                       ('server',))
+
+
+class BambooQueue(object):
+    """Estimated build queue of one Bamboo server."""
+
+    def __init__(self, server=None):
+        """Create the queue instance object.
+        :param server: Bamboo server name [string]
+        """
+        self.__server = server
+
+        # Last sample, None until sampled; builds triggered since then
+        self.__depth = None
+        self.__sample_time = None
+        self.__triggered = 0
+
+    @property
+    def server(self):
+        """Get the Bamboo server name."""
+        return self.__server
+
+    @property
+    def depth(self):
+        """Get the estimated number of queued builds, None if never sampled."""
+        return None if self.__depth is None else self.__depth + self.__triggered
+
+    def sample(self, queue_depth=None, sample_interval=None):
+        """Sample the queue depth, unless sampled less than 'sample_interval' seconds ago. On error, the last sample
+        is kept and used until the next attempt.
+        :param queue_depth: Returns the number of queued builds of the server [function]
+        :param sample_interval: Seconds between two samples [float]
+        """
+
+        if self.__sample_time is not None and monotonic() - self.__sample_time < sample_interval:
+            return
+
+        self.__sample_time = monotonic()
+        try:
+            depth = int(queue_depth())
+        except Exception as err:
+            print("Error when sampling the build queue of Bamboo server '{server}': {err}".format(
+                server=self.server, err=err
+            ))
+            QUEUE_SAMPLE_ERRORS.inc(server=self.server)
+            return
+
+        self.__depth = depth
+        self.__triggered = 0
+        QUEUE_DEPTH.set(depth, server=self.server)
+
+    def triggered(self, count=1):
+        """Count builds triggered since the last sample.
+        :param count: Number of builds [int]
+        """
+        self.__triggered += count
+
+
+class AdmissionControl(object):
+    """Admission control of the new tasks: one estimated queue per Bamboo server, shared by the threads of the
+    process."""
+
+    def __init__(self, max_queued=50, sample_interval=30.0):
+        """Create the admission control instance object.
+        :param max_queued: Queued builds above which the new tasks of a server are held [int]
+        :param sample_interval: Seconds between two samples of the queue of a server [float]
+        """
+        self.__max_queued = max_queued
+        self.__sample_interval = sample_interval
+
+        # {bamboo_server: queue}
+        self.__queues = dict()
+        self.__lock = threading.Lock()
+
+    @property
+    def max_queued(self):
+        """Get the queued builds above which the new tasks are held."""
+        return self.__max_queued
+
+    @property
+    def sample_interval(self):
+        """Get the seconds between two samples of a queue."""
+        return self.__sample_interval
+
+    @staticmethod
+    def priority_order(task_values=None):
+        """Sort key of the new tasks: highest priority first, then oldest first.
+        :param task_values: The task [TaskRecord]
+        """
+        return -(task_values.priority or 0), task_values.insert_time or 0
+
+    def queue(self, bamboo_server=None):
+        """Get (create on first use) the estimated queue of a Bamboo server.
+        :param bamboo_server: Bamboo server name [string]
+        :return: The queue [BambooQueue]
+        """
+
+        with self.__lock:
+            queue = self.__queues.get(bamboo_server)
+            if queue is None:
+                queue = self.__queues[bamboo_server] = BambooQueue(server=bamboo_server)
+
+        return queue
+
+    def admit(self, bamboo_server=None, task_records=None, queue_depth=None):
+        """Select the new tasks of a Bamboo server which may be triggered now.
+        :param bamboo_server: Bamboo server name [string]
+        :param task_records: New tasks of the server [list of TaskRecord]
+        :param queue_depth: Returns the number of queued builds of the server, called when a sample is due [function]
+        :return: (admitted tasks, by priority; held tasks) [tuple]
+        """
+
+        if not task_records:
+            TASKS_HELD.set(0, server=bamboo_server)
+            return [], []
+
+        # Only one thread processes the tasks of a server (see 'TasksProcessingUnit.server_unit')
+        queue = self.queue(bamboo_server=bamboo_server)
+        queue.sample(queue_depth=queue_depth, sample_interval=self.sample_interval)
+
+        task_records = sorted(task_records, key=self.priority_order)
+        if queue.depth is None:
+            admitted_count = len(task_records)
+        else:
+            admitted_count = max(0, min(len(task_records), self.max_queued - queue.depth))
+
+        TASKS_HELD.set(len(task_records) - admitted_count, server=bamboo_server)
+
+        return task_records[:admitted_count], task_records[admitted_count:]
+
+    def triggered(self, bamboo_server=None):
+        """Count a build triggered on a Bamboo server in its estimated queue: only the admitted tasks which were
+        actually triggered fill the queue up.
+        :param bamboo_server: Bamboo server name [string]
+        """
+        self.queue(bamboo_server=bamboo_server).triggered()
@@ -4,20 +4,50 @@
 """The module controls the load and the run of Flask server."""
 
 
-from flask import Flask
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Config, Flask
 
+from config import default as default_config
 
-APP = Flask(__name__, template_folder="templates", static_folder="static", instance_relative_config=True)
+
+class LazyConfig(Config):
+    """Flask config which builds the objects of 'config.default' (Redis clients, caches...) on first use:
+    'from_object()' only copies the plain settings.
+    """
+
+    def __missing__(self, key):
+        if key not in default_config.lazy_objects:
+            raise KeyError(key)
+
+        value = self[key] = getattr(default_config, key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class LazyConfigFlask(Flask):
+    """Flask application using LazyConfig."""
+
+    config_class = LazyConfig
+
+
+APP = LazyConfigFlask(__name__, template_folder="templates", static_folder="static", instance_relative_config=True)
 
 # Load the default configuration
 # Now we can access the configuration variables via app.config["VAR_NAME"]
 # APP.config.from_object('config.development')
 APP.config.from_object('config.default')
 
-# The toolbar is only enabled in debug mode and if ['SECRET_KEY'] is enabled
-TOOLBAR = DebugToolbarExtension()
-TOOLBAR.init_app(APP)
+# The toolbar adds work to every request: only loaded in development ('run.py') and if ['SECRET_KEY'] is enabled
+TOOLBAR = None
+if APP.config.get('DEBUG'):
+    from flask_debugtoolbar import DebugToolbarExtension
+
+    TOOLBAR = DebugToolbarExtension()
+    TOOLBAR.init_app(APP)
 
 
 from app import views
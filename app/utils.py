@@ -5,23 +5,45 @@
 
 
 import functools
-import json
 import re
 import sys
 
+from collections import namedtuple
+from flask import Response as FlaskResponse, send_file
 from os import path
+from urllib.parse import unquote, urlparse
 
 # Add custom libs
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 from app import APP
+from artifact_cache import ArtifactDiskCache
+from json_utils import JsonUtils
+
+
+# Returned by the views decorated with 'ResponseUtils.return_json'
+Response = namedtuple('Response', "return_code return_data")
 
 
 class ResponseUtils(object):
     """Utils class used to return custom response back to app."""
 
+    @staticmethod
+    def json_response(return_code=None, return_data=None):
+        """Build a JSON response.
+        :param return_code: HTTP return code [int]
+        :param return_data: Data to return [dictionary], or already serialised as JSON [bytes]
+        """
+
+        if not isinstance(return_data, bytes):
+            return_data = JsonUtils.dumps(return_data)
+
+        return APP.response_class(response=return_data, status=return_code, mimetype='application/json')
+
     @staticmethod
     def return_json(func):
-        """Wrapper to return a custom JSON response."""
+        """Wrapper to return a custom JSON response. The view returns the data [dictionary], or the JSON body when it is
+        already serialised (e.g.: read from Redis) [bytes].
+        """
 
         @functools.wraps(func)
         def inner(*args, **kwargs):
@@ -36,24 +58,12 @@ class ResponseUtils(object):
             except TypeError as err:
                 print("Error when processing function: {msg}".format(msg=err))
                 if not returned_data:
-                    return APP.response_class(
-                        response=json.dumps("NO DATA TO RETURN"),
-                        status=406,
-                        mimetype='application/json'
-                    )
-
-            if not isinstance(returned_data, dict):
-                response = APP.response_class(
-                    response=json.dumps("DATA CASTING ERROR"),
-                    status=406,
-                    mimetype='application/json'
-                )
+                    return ResponseUtils.json_response(return_code=406, return_data="NO DATA TO RETURN")
+
+            if not isinstance(returned_data, (dict, bytes)):
+                response = ResponseUtils.json_response(return_code=406, return_data="DATA CASTING ERROR")
             else:
-                response = APP.response_class(
-                    response=json.dumps(returned_data),
-                    status=returned_code_value,
-                    mimetype='application/json'
-                )
+                response = ResponseUtils.json_response(return_code=returned_code_value, return_data=returned_data)
 
             # Returning the value to the original frame
             return response
@@ -61,6 +71,238 @@ class ResponseUtils(object):
         return inner
 
 
+class ArtifactUtils(object):
+    """Utils class used to serve the Bamboo artifacts to the clients."""
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def disk_cache():
+        """Get the on-disk artifacts cache shared by all the requests of the process."""
+        return ArtifactDiskCache()
+
+    @staticmethod
+    def stream_to_cache(bamboo_response=None, cache_writer=None, chunk_size=1024 * 1024):
+        """Stream an artifact from Bamboo to the client while adding it to the cache.
+        :param bamboo_response: Streamed Bamboo response [requests.Response]
+        :param cache_writer: Writer used to add the artifact to the cache [ArtifactCacheWriter]
+        :param chunk_size: Size of the chunks sent to the client, in bytes [int]
+        """
+
+        try:
+            for chunk in bamboo_response.iter_content(chunk_size=chunk_size):
+                if cache_writer:
+                    cache_writer.write(chunk)
+                yield chunk
+
+            if cache_writer:
+                cache_writer.commit()
+        except BaseException:
+            # Bamboo error or client gone: do not keep a partial file
+            if cache_writer:
+                cache_writer.abort()
+            raise
+        finally:
+            bamboo_response.close()
+
+    @staticmethod
+    def stream_response(bamboo_response=None, cache_writer=None):
+        """Get the response streaming an artifact from Bamboo to the client and to the cache.
+        :param bamboo_response: Streamed Bamboo response [requests.Response]
+        :param cache_writer: Writer used to add the artifact to the cache [ArtifactCacheWriter]
+        :return: The response [flask.Response]
+        """
+
+        response = FlaskResponse(
+            ArtifactUtils.stream_to_cache(bamboo_response=bamboo_response, cache_writer=cache_writer),
+            status=200, headers=ArtifactUtils.stream_headers(bamboo_response=bamboo_response),
+            mimetype='application/octet-stream', direct_passthrough=True
+        )
+
+        # The streaming may never start (e.g.: client gone): the download lock must not wait for the garbage collector
+        @response.call_on_close
+        def close_stream():
+            if cache_writer:
+                cache_writer.abort()
+            bamboo_response.close()
+
+        return response
+
+    @staticmethod
+    def stream_headers(bamboo_response=None):
+        """Get the headers of an artifact streamed from Bamboo.
+        :param bamboo_response: Streamed Bamboo response [requests.Response]
+        :return: {header: value} [dictionary]
+        """
+
+        # The length is only known upfront if Bamboo did not compress the file ('requests' decompresses it)
+        headers = dict()
+        if bamboo_response.headers.get('Content-Length') and not bamboo_response.headers.get('Content-Encoding'):
+            headers['Content-Length'] = bamboo_response.headers.get('Content-Length')
+
+        return headers
+
+    @staticmethod
+    def send_cached(cached_file=None):
+        """Let the WSGI server send a cached artifact (sendfile() where supported, 'Range' requests are honoured).
+        :param cached_file: Full path to the cached file [string]
+        :return: The response, None if there is no such file (e.g.: evicted since the lookup) [flask.Response]
+        """
+
+        if not cached_file:
+            return None
+
+        try:
+            return send_file(cached_file, mimetype='application/octet-stream', conditional=True)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def claim_download(artifact_cache=None, cache_key=None, timeout=None):
+        """Take the right to download a missing artifact into the cache, waiting for the download of the same
+        artifact by another request if any.
+        :param artifact_cache: The on-disk cache [ArtifactDiskCache]
+        :param cache_key: {server, plan_key, job_name, artifact_path} of the artifact [dictionary]
+        :param timeout: Seconds to wait for another download [float]
+        :return: (response, None) if the artifact was cached meanwhile, else (None, lock held by the caller). The lock
+        is None when the wait timed out: the artifact is then not cached [tuple]
+        """
+
+        download_lock = artifact_cache.download_lock(**cache_key)
+        if not download_lock.acquire(timeout=timeout):
+            return None, None
+
+        cached_response = ArtifactUtils.send_cached(cached_file=artifact_cache.lookup(count=False, **cache_key))
+        if cached_response:
+            download_lock.release()
+            return cached_response, None
+
+        return None, download_lock
+
+    @staticmethod
+    def cache_writer(artifact_cache=None, cache_key=None, download_lock=None):
+        """Get the writer adding a downloaded artifact to the cache; it releases the download lock.
+        :param artifact_cache: The on-disk cache [ArtifactDiskCache]
+        :param cache_key: {server, plan_key, job_name, artifact_path} of the artifact [dictionary]
+        :param download_lock: Lock of the download, None if not taken [ArtifactDownloadLock]
+        :return: The writer, None if the artifact is not cached [ArtifactCacheWriter]
+        """
+
+        if not download_lock:
+            return None
+
+        try:
+            return artifact_cache.writer(download_lock=download_lock, **cache_key)
+        except OSError as err:
+            print("Error when adding artifact to the cache: {err}".format(err=err))
+            download_lock.release()
+            return None
+
+    @staticmethod
+    def proxy_links(artifacts_links=None, product=None, object_id=None):
+        """Translate Bamboo artifacts links to links served by the app.
+        :param artifacts_links: Bamboo artifacts links [list]
+        :param product: The name of the product [string]
+        :param object_id: Object ID in Redis (SHA512) [string]
+        :return: A list of links
+        """
+
+        app_config = APP.config.get('APP_CONFIG', {})
+        return [
+            r"http://{host}:{port}/get_artifact/{product}/{id}/{artifact_path}".format(
+                host=app_config.get('host', "host"), port=app_config.get('port', "0000"), product=product,
+                id=object_id, artifact_path=ArtifactUtils.artifact_path(artifact_link=link)
+            )
+            for link in artifacts_links or []
+        ]
+
+    @staticmethod
+    def artifact_path(artifact_link=None):
+        """Get the <artifact_name>/<file_name> part of a Bamboo artifact link, as used in the proxy links.
+        :param artifact_link: Bamboo artifact link [string]
+        :return: Artifact path [string]
+        """
+        return "/".join(artifact_link.rstrip("/").split("/")[-2:])
+
+    @staticmethod
+    def is_task_artifact(artifact_path=None, artifacts_links=None):
+        """Check that a requested artifact path is one of the artifacts of the task. Only these are requested from
+        Bamboo: the requests carry the account credentials, any other path could reach any Bamboo page.
+        :param artifact_path: <artifact_name>/<file_name> as requested (URL decoded) [string]
+        :param artifacts_links: Bamboo artifacts links of the task [list]
+        :return: True/False [boolean]
+        """
+
+        if not artifact_path or ".." in artifact_path.split("/"):
+            return False
+
+        return any(
+            unquote(ArtifactUtils.artifact_path(artifact_link=link)) == artifact_path for link in artifacts_links or []
+        )
+
+
+class BambooServerUtils(object):
+    """Utils class used to select the Bamboo server of a task."""
+
+    @staticmethod
+    def same_host(name=None, server=None):
+        """Check that a host name refers to a Bamboo server: same host (case insensitive), the short name of the other
+        (e.g.: bamboo1 and bamboo1.domain.com), and the same port when both have one.
+        :param name: host[:port] [string]
+        :param server: Bamboo server name, host[:port] [string]
+        :return: True/False [boolean]
+        """
+
+        try:
+            parsed_name, parsed_server = urlparse("//" + name.lower()), urlparse("//" + server.lower())
+            if parsed_name.port and parsed_server.port and parsed_name.port != parsed_server.port:
+                return False
+        except ValueError:
+            # Invalid port
+            return False
+
+        name_host, server_host = parsed_name.hostname or "", parsed_server.hostname or ""
+        return name_host == server_host or (
+            "." not in name_host and name_host == server_host.split(".")[0]
+        ) or (
+            "." not in server_host and server_host == name_host.split(".")[0]
+        )
+
+    @staticmethod
+    def known_server(name=None):
+        """Get the configured Bamboo server a host name refers to (see 'same_host').
+        :param name: host[:port] [string]
+        :return: Bamboo server name, None if not known or ambiguous [string]
+        """
+
+        default_server = APP.config.get('BAMBOO_SERVER')
+        known_servers = list(dict.fromkeys([default_server] + list(APP.config.get('BAMBOO_SERVERS') or [])))
+        if name in known_servers:
+            return name
+
+        matching_servers = [server for server in known_servers if BambooServerUtils.same_host(name=name, server=server)]
+        return matching_servers[0] if len(matching_servers) == 1 else None
+
+    @staticmethod
+    def task_server(requested_server=None, plan_url=None):
+        """Get the Bamboo server of a new task: the requested one, else the host of the plan URL, else (no host) the
+        default server. Only the configured servers are accepted: the requests carry the account credentials, and a
+        task must not run on another server than the one its plan URL points to.
+        :param requested_server: Bamboo server requested by the user [string]
+        :param plan_url: URL of the Bamboo plan (e.g.: https://bamboo1/browse/ABC-XYZ) [string]
+        :return: Bamboo server name, None if the requested server or the plan URL host is not known [string]
+        """
+
+        if requested_server:
+            return BambooServerUtils.known_server(name=requested_server)
+
+        # E.g.: https://user@bamboo1.domain.com:8443/browse/ABC-XYZ => bamboo1.domain.com:8443
+        plan_host = urlparse(plan_url or "").netloc.rpartition("@")[2]
+        if not plan_host:
+            return APP.config.get('BAMBOO_SERVER')
+
+        return BambooServerUtils.known_server(name=plan_host)
+
+
 class ShaUtils(object):
     """ShaUtils."""
 
@@ -9,17 +9,66 @@ Takes the tasks from the Redis DB and returns the status of them. Also, it updat
 import hashlib
 import sys
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 from datetime import datetime
-from flask import render_template, request
-from json import dumps, loads
+from flask import Response as FlaskResponse, after_this_request, g, render_template, request
 from os import path
 from time import time
+from uuid import uuid4
 
 # Add custom libs
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 from app import APP
-from app.utils import ShaUtils, ResponseUtils
+from app.utils import ArtifactUtils, BambooServerUtils, Response, ResponseUtils, ShaUtils
+from bamboo_api import BambooAPI
+from json_utils import JsonUtils
+from metrics import REGISTRY, WORKER_METRICS_KEY
+from redis_utils import RedisUtils
+from task_codec import TaskCodec
+from task_record import TaskRecord
+from utils import LatencyStats, TaskDump
+
+
+# Keys per SCAN call and per pipeline of the DB dumps
+DUMP_BATCH_SIZE = 500
+DUMP_MAX_BATCH_SIZE = 10000
+
+
+def task_etag(revision=None):
+    """Get the ETag of a task status response.
+    :param revision: Revision of the task [int]
+    :return: ETag, unquoted [string]
+    """
+    return "r{0}".format(revision)
+
+
+def set_task_etag(revision=None):
+    """Add the ETag of the task to the response of the current request.
+    :param revision: Revision of the task [int]
+    """
+
+    @after_this_request
+    def add_etag(response):
+        response.set_etag(task_etag(revision=revision))
+        return response
+
+
+@APP.before_request
+def start_request_timer():
+    """Keep the start time of the request for the metrics."""
+    g.request_start_time = time()
+
+
+@APP.after_request
+def observe_request(response):
+    """Record the duration of the request in the metrics."""
+
+    start_time = g.get('request_start_time')
+    if start_time is not None:
+        REGISTRY.histogram('http_request_duration_seconds', "Duration of the API requests.",
+                           ('endpoint', 'status')).observe(time() - start_time, endpoint=request.endpoint,
+                                                           status=response.status_code)
+    return response
 
 
 # Root route
@@ -29,15 +78,74 @@ def root():
     return render_template('under_construction.html', **locals())
 
 
+@APP.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose the API metrics and the last snapshot published by the worker in the Prometheus text format."""
+
+    RedisUtils.observe_pool_stats()
+    exposition = REGISTRY.render()
+
+    redis_client = APP.config.get('REDIS')
+    if redis_client:
+        try:
+            exposition += redis_client.get(WORKER_METRICS_KEY) or ""
+        except Exception as err:
+            print("Error when reading the worker metrics: {err}".format(err=err))
+
+    return FlaskResponse(exposition, status=200, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@APP.route('/get_latency_stats', methods=['GET'])
+@APP.route('/get_latency_stats/<product>', methods=['GET'])
+@ResponseUtils.return_json
+def get_latency_stats(product=None):
+    """Get p50/p95/p99 of the task life cycle phases, per product.
+    :param product: The name of the product, all products if not supplied [string]
+    """
+
+    redis_object = APP.config.get('REDIS')
+    if not redis_object:
+        return Response(return_code=400, return_data={
+            "dataBody": {
+                "response": "---",
+                "reason": "Unknown"
+            },
+            "error": True
+        })
+
+    return Response(return_code=200, return_data={
+        "dataBody": LatencyStats(redis_client=redis_object).stats(product=product),
+        "error": False
+    })
+
+
+def request_task_dump(redis_client=None):
+    """Build the reader of the DB dump from the request options: 'status', 'product' and 'count' (keys per batch).
+    :param redis_client: Redis client returning bytes [StrictRedis]
+    :return: The reader [TaskDump], None if 'count' is not valid
+    """
+
+    try:
+        batch_size = int(request.values.get('count', DUMP_BATCH_SIZE))
+    except ValueError:
+        return None
+    if not 0 < batch_size <= DUMP_MAX_BATCH_SIZE:
+        return None
+
+    return TaskDump(redis_client=redis_client, batch_size=batch_size, status=request.values.get('status'),
+                    product=request.values.get('product'))
+
+
 @APP.route('/dump_db_content', methods=['POST'])
 @ResponseUtils.return_json
 def dump_db_content():
-    """Dump the content of the Redis DB as a JSON."""
-
-    Response = namedtuple('Response', "return_code return_data")
+    """Dump the content of the Redis DB as a JSON. Filters: 'status', 'product'.
+    Builds the whole dump in memory: use '/dump_db_content/page' or '/dump_db_content/stream' on large DBs.
+    """
 
-    redis_client = APP.config.get('REDIS')
-    if not redis_client:
+    redis_client = APP.config.get('REDIS_RAW')
+    task_dump = request_task_dump(redis_client=redis_client)
+    if not redis_client or not task_dump:
         return Response(return_code=400, return_data={
             "dataBody": {
                 "response": "---",
@@ -46,25 +154,94 @@ def dump_db_content():
             "error": True
         })
 
-    dump_content = dict()
-    for key in redis_client.scan_iter():
-        dump_content.update({key: loads(redis_client.get(key))})
+    if task_dump.filtered:
+        dump_content = dict(task_dump.entries())
+        if not dump_content:
+            return Response(return_code=200, return_data={"dataBody": "EMPTY", "error": False})
+
+        return Response(return_code=200, return_data=dump_content)
 
-    if not dump_content:
+    # No filter: the body is built from the stored tasks, the ones stored as JSON are copied without being decoded
+    dump_entries = [JsonUtils.dumps(task_id) + b": " + TaskCodec.to_json(task_data)
+                    for task_id, task_data in task_dump.entries(parse=False)]
+    if not dump_entries:
         return Response(return_code=200, return_data={"dataBody": "EMPTY", "error": False})
 
-    return Response(return_code=200, return_data=dump_content)
+    return Response(return_code=200, return_data=b"{" + b", ".join(dump_entries) + b"}")
+
+
+@APP.route('/dump_db_content/page', methods=['POST'])
+@ResponseUtils.return_json
+def dump_db_content_page():
+    """Dump a page of the Redis DB. Options: 'cursor' (returned by the previous page, 0 for the first one), 'count'
+    (keys to read), 'status', 'product'. The dump is complete when the returned cursor is 0.
+    """
+
+    redis_client = APP.config.get('REDIS_RAW')
+    task_dump = request_task_dump(redis_client=redis_client)
+    cursor = request.values.get('cursor', '0')
+    if not redis_client or not task_dump or not cursor.isdigit():
+        return Response(return_code=400, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "Wrong cursor or count"
+            },
+            "error": True
+        })
+
+    # A cluster has one SCAN cursor per node
+    if APP.config.get('REDIS_MODE') == 'cluster':
+        return Response(return_code=501, return_data={
+            "dataBody": {
+                "response": "Not implemented",
+                "reason": "Paging is not available on Redis Cluster, please use '/dump_db_content/stream'"
+            },
+            "error": True
+        })
+
+    next_cursor, entries = task_dump.page(cursor=int(cursor))
+
+    return Response(return_code=200, return_data={
+        "dataBody": {
+            "entries": entries,
+            "cursor": next_cursor,
+            "complete": next_cursor == 0
+        },
+        "error": False
+    })
+
+
+@APP.route('/dump_db_content/stream', methods=['POST'])
+def dump_db_content_stream():
+    """Stream the content of the Redis DB as NDJSON, one {"id": ..., "task": {...}} line per task, sent as the
+    batches are read. Options: 'count' (keys per batch), 'status', 'product'.
+    """
+
+    redis_client = APP.config.get('REDIS_RAW')
+    task_dump = request_task_dump(redis_client=redis_client)
+    if not redis_client or not task_dump:
+        return ResponseUtils.json_response(return_code=400, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "Wrong count"
+            },
+            "error": True
+        })
+
+    # Without filters the tasks are sent as stored, without decoding them
+    lines = (TaskDump.ndjson_line(task_id=task_id, task=task) for task_id, task in task_dump.entries(parse=False))
+
+    return FlaskResponse(lines, status=200, mimetype='application/x-ndjson')
 
 
 @APP.route('/get_product_info/<product>/<object_id>', methods=['GET'])
 @ResponseUtils.return_json
-def get_product_info(object_id=None):
+def get_product_info(product=None, object_id=None):
     """Get status about a product and object ID from Redis.
+    :param product: The name of the product [string]
     :param object_id: Object ID in Redis (SHA512) [string]
     """
 
-    Response = namedtuple('Response', "return_code return_data")
-
     # Check if received ID is SHA512
     if not ShaUtils.is_sha512(maybe_sha=object_id):
         return Response(return_code=400, return_data={
@@ -75,7 +252,7 @@ def get_product_info(object_id=None):
             "error": True
         })
 
-    redis_object = APP.config.get('REDIS')
+    redis_object = APP.config.get('REDIS_RAW')
     if not redis_object:
         return Response(return_code=400, return_data={
             "dataBody": {
@@ -85,7 +262,19 @@ def get_product_info(object_id=None):
             "error": True
         })
 
-    object_info = redis_object.get(object_id)
+    # The task cache, when enabled, has the same interface and falls back to Redis on a miss
+    task_source = APP.config.get('TASK_CACHE')
+    if task_source is None:
+        task_source = TaskRecord
+
+    # The pollers send the ETag of their last response: while the task is not updated, only its revision is read
+    if request.if_none_match:
+        revision = task_source.load_revision(redis_client=redis_object, task_id=object_id)
+        if revision is not None and request.if_none_match.contains_weak(task_etag(revision=revision)):
+            set_task_etag(revision=revision)
+            return Response(return_code=304, return_data=b"")
+
+    object_info = task_source.load(redis_client=redis_object, task_id=object_id)
     if not object_info:
         return Response(return_code=424, return_data={
             "dataBody": {
@@ -95,13 +284,20 @@ def get_product_info(object_id=None):
             "error": True
         })
 
+    # Tasks not written since the revisions exist have no ETag
+    if object_info.revision is not None:
+        set_task_etag(revision=object_info.revision)
+
     # Return response depending on the findings
     return_data = defaultdict(dict)
     return_data.update(
         {
             "dataBody": {
-                "status": loads(object_info).get('status'),
-                "bambooUrl": loads(object_info).get('bamboo_build_url') or "NO_URL",
+                "status": object_info.status,
+                "bambooUrl": object_info.bamboo_build_url or "NO_URL",
+                "timeline": object_info.timeline or {
+                    'inserted': object_info.insert_time
+                },
             },
             "error": False
         }
@@ -109,20 +305,22 @@ def get_product_info(object_id=None):
 
     # If plan has finished => add artifact links
     if return_data['dataBody']['status'] == 'FINISHED':
-        return_data['dataBody']['artifactsUrl'] = loads(object_info).get('artifacts', [])
+        return_data['dataBody']['artifactsUrl'] = object_info.artifacts or []
+        return_data['dataBody']['artifactsProxyUrl'] = ArtifactUtils.proxy_links(
+            artifacts_links=return_data['dataBody']['artifactsUrl'], product=product, object_id=object_id
+        )
 
     return Response(return_code=200, return_data=return_data)
 
 
 @APP.route('/create_task/<product>/<resource>', methods=['GET', 'POST'])
 @ResponseUtils.return_json
-def create_task(product=None):
+def create_task(product=None, resource=None):
     """Creates a request for a specific product.
     :param product: The name of the product [string]
+    :param resource: The requested resource [string]
     """
 
-    Response = namedtuple('Response', "return_code return_data")
-
     # Notify user if he/she uses a wrong method in API call
     if request.method == 'GET':
         return Response(return_code=405, return_data={
@@ -133,13 +331,35 @@ def create_task(product=None):
             "error": True
         })
 
-    bamboo_server = APP.config.get('BAMBOO_SERVER')
     bamboo_main_plan_url = request.values.get('planUrl')
+    bamboo_server = BambooServerUtils.task_server(requested_server=request.values.get('bambooServer'),
+                                                  plan_url=bamboo_main_plan_url)
+    if not bamboo_server:
+        return Response(return_code=400, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "Unknown Bamboo server"
+            },
+            "error": True
+        })
+
+    # Order of the new tasks held while the Bamboo queue is full (see 'admission_control'): highest first
+    try:
+        priority = int(request.values.get('priority') or 0)
+    except ValueError:
+        return Response(return_code=400, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "The priority must be an integer"
+            },
+            "error": True
+        })
+
     bamboo_wait_for_plan_to_finish = request.values.get('waitForPlan')
     bamboo_artifact_on_stage = request.values.get('artifactsOnStage')
     bamboo_artifact_names = request.values.get('artifactNames', '').strip().split(",")
 
-    redis_object = APP.config.get('REDIS')
+    redis_object = APP.config.get('REDIS_RAW')
     if not redis_object:
         return Response(return_code=400, return_data={
             "dataBody": {
@@ -149,37 +369,36 @@ def create_task(product=None):
             "error": True
         })
 
-    internal_id = hashlib.sha512(str(datetime.now()).encode()).hexdigest()
+    # The random part keeps the IDs unique when several tasks are created in the same microsecond
+    internal_id = hashlib.sha512("{0}{1}".format(datetime.now(), uuid4()).encode()).hexdigest()
 
     # Check if the user supplied some options or not
     request_opts = dict()
     if request.args:
-        request_opts = request.args
-
-    # Set object in Redis
-    redis_object.set(
-        internal_id,
-        dumps(
-            {
-                'bamboo_artifact_names': bamboo_artifact_names,
-                'bamboo_artifact_on_stage': bamboo_artifact_on_stage,
-                'bamboo_main_plan_url': bamboo_main_plan_url,
-                'bamboo_server': bamboo_server,
-                'bamboo_state': "NEW",
-                'bamboo_wait_for_plan_to_finish': bamboo_wait_for_plan_to_finish,
-                'request_options': request_opts,
-                'product_name': product,
-                'status': "NEW_REQUEST",
-                'start_build_retries': 0,
-                'stop_build_retries': 0,
-                'insert_time': time()
-            }
-        )
-    )
+        # The first value of each option, as a plain dictionary (the task is encoded as JSON or msgpack)
+        request_opts = request.args.to_dict()
+
+    # Set object in Redis, revision 1
+    revision = TaskRecord(
+        task_id=internal_id,
+        bamboo_artifact_names=bamboo_artifact_names,
+        bamboo_artifact_on_stage=bamboo_artifact_on_stage,
+        bamboo_main_plan_url=bamboo_main_plan_url,
+        bamboo_server=bamboo_server,
+        bamboo_state="NEW",
+        bamboo_wait_for_plan_to_finish=bamboo_wait_for_plan_to_finish,
+        request_options=request_opts,
+        product_name=product,
+        status="NEW_REQUEST",
+        start_build_retries=0,
+        stop_build_retries=0,
+        insert_time=time(),
+        priority=priority or None
+    ).save(redis_client=redis_object)
 
     # Return response depending on the findings
     app_config = APP.config.get('APP_CONFIG', {})
-    if not redis_object.get(internal_id):
+    if not revision:
         return Response(return_code=400, return_data={"error": True})
 
     return Response(
@@ -188,6 +407,7 @@ def create_task(product=None):
             "dataBody":
                 {
                     "bambooMainPlanUrl": bamboo_main_plan_url,
+                    "bambooServer": bamboo_server,
                     "id": internal_id,
                     "urlToCheckForStatus": r"http://{host}:{port}/get_product_info/{product}/{id}".format(
                         host=app_config.get('host', "host"), port=app_config.get('port', "0000"),
@@ -197,3 +417,90 @@ def create_task(product=None):
             "error": False
         }
     )
+
+
+@APP.route('/get_artifact/<product>/<object_id>/<path:artifact_path>', methods=['GET'])
+def get_artifact(product=None, object_id=None, artifact_path=None):
+    """Serve an artifact of a finished task from the on-disk cache, downloading it from Bamboo on a miss.
+    :param product: The name of the product [string]
+    :param object_id: Object ID in Redis (SHA512) [string]
+    :param artifact_path: <artifact_name>/<file_name> as found in the artifacts links [string]
+    """
+
+    # Check if received ID is SHA512
+    if not ShaUtils.is_sha512(maybe_sha=object_id):
+        return ResponseUtils.json_response(return_code=400, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "Wrong ID"
+            },
+            "error": True
+        })
+
+    redis_object = APP.config.get('REDIS_RAW')
+    object_info = redis_object.get(object_id) if redis_object else None
+    if not object_info:
+        return ResponseUtils.json_response(return_code=424, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "Requested ID does not exist in the DB"
+            },
+            "error": True
+        })
+
+    object_info = TaskRecord.decode(task_id=object_id, task_data=object_info)
+    artifact_name, _, file_name = artifact_path.partition("/")
+    # Only the exact paths of the task's artifacts links are requested from Bamboo
+    if object_info.status != 'FINISHED' or not ArtifactUtils.is_task_artifact(
+        artifact_path=artifact_path, artifacts_links=object_info.artifacts
+    ):
+        return ResponseUtils.json_response(return_code=404, return_data={
+            "dataBody": {
+                "response": "Bad request",
+                "reason": "Requested artifact is not available"
+            },
+            "error": True
+        })
+
+    bamboo_server = object_info.bamboo_server
+    plan_key = object_info.bamboo_build_result_key
+    job_name = object_info.bamboo_artifact_on_stage
+
+    # Hit: served from the cache
+    artifact_cache = ArtifactUtils.disk_cache()
+    cache_key = {'server': bamboo_server, 'plan_key': plan_key, 'job_name': job_name, 'artifact_path': artifact_path}
+    cached_response = ArtifactUtils.send_cached(cached_file=artifact_cache.lookup(**cache_key))
+    if cached_response:
+        return cached_response
+
+    # Miss: a single request downloads the artifact, the concurrent ones wait for it and are served from the cache
+    cached_response, download_lock = ArtifactUtils.claim_download(
+        artifact_cache=artifact_cache, cache_key=cache_key, timeout=APP.config.get('ARTIFACTS_DOWNLOAD_WAIT', 300.0)
+    )
+    if cached_response:
+        return cached_response
+
+    # Stream the artifact from Bamboo to the client and to the cache at the same time
+    try:
+        artifact_stream = BambooAPI(bamboo_server=bamboo_server).open_artifact(
+            bamboo_server=bamboo_server, plan_key=plan_key, query_type='download_artifact', job_name=job_name,
+            artifact_name=artifact_name, url_extra_values=file_name
+        )
+        if not artifact_stream.get('response'):
+            raise ValueError("Bamboo returned: {0}".format(artifact_stream.get('status_code')))
+    except Exception as err:
+        if download_lock:
+            download_lock.release()
+        return ResponseUtils.json_response(return_code=502, return_data={
+            "dataBody": {
+                "response": "Bamboo error",
+                "reason": str(err)
+            },
+            "error": True
+        })
+
+    bamboo_response = artifact_stream.get('stream')
+    cache_writer = ArtifactUtils.cache_writer(artifact_cache=artifact_cache, cache_key=cache_key,
+                                              download_lock=download_lock)
+
+    return ArtifactUtils.stream_response(bamboo_response=bamboo_response, cache_writer=cache_writer)
@@ -0,0 +1,504 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Artifacts cache module:
+Keeps what was already learned about the artifacts of finished Bamboo builds so it is not requested again.
+"""
+
+
+import argparse
+import fcntl
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+
+from contextlib import contextmanager
+from json import dumps, loads
+from os import path
+from time import monotonic, sleep, time
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from config import default as config
+from utils import RedisKeyUtils
+
+
+class ArtifactManifestCache(object):
+    """Redis backed cache for the artifacts links of a finished build.
+
+    The artifacts of a finished build never change, so the links found for an artifact are cached by
+    (Bamboo server, build result key, job name, artifact name).
+    """
+
+    def __init__(self, redis_client=None, ttl=86400):
+        """Create the cache instance object.
+        :param redis_client: Redis client used to store the manifests [StrictRedis]
+        :param ttl: Number of seconds a manifest is kept [int]
+        """
+        self.__redis_client = redis_client
+        self.__ttl = ttl
+
+    @property
+    def redis_client(self):
+        """Get the Redis client."""
+        return self.__redis_client
+
+    @property
+    def ttl(self):
+        """Get the time to live of a manifest."""
+        return self.__ttl
+
+    @staticmethod
+    def manifest_key(bamboo_server=None, plan_key=None, job_name=None, artifact_name=None):
+        """Compound the Redis key of an artifact manifest.
+        :param bamboo_server: Bamboo server name [string]
+        :param plan_key: Bamboo build result key [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_name: Name of the artifact as in Bamboo plan stage job [string]
+        :return: Key name [string]
+        """
+        return RedisKeyUtils.internal_key("artifacts_manifest", bamboo_server, plan_key, job_name, artifact_name)
+
+    def get(self, bamboo_server=None, plan_key=None, job_name=None, artifact_name=None):
+        """Get the cached manifest of an artifact.
+        :param bamboo_server: Bamboo server name [string]
+        :param plan_key: Bamboo build result key [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_name: Name of the artifact as in Bamboo plan stage job [string]
+        :return: {"artifacts": [...], "artifacts_links": [...]} on hit, None on miss
+        """
+
+        if not self.redis_client:
+            return None
+
+        try:
+            manifest = self.redis_client.get(
+                self.manifest_key(bamboo_server=bamboo_server, plan_key=plan_key, job_name=job_name,
+                                  artifact_name=artifact_name)
+            )
+        except Exception as err:
+            print("Error when reading artifact manifest from Redis: {err}".format(err=err))
+            return None
+
+        if not manifest:
+            return None
+
+        try:
+            return loads(manifest)
+        except ValueError:
+            return None
+
+    def set(self, bamboo_server=None, plan_key=None, job_name=None, artifact_name=None, artifacts=None,
+            artifacts_links=None):
+        """Cache the manifest of an artifact.
+        :param bamboo_server: Bamboo server name [string]
+        :param plan_key: Bamboo build result key [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_name: Name of the artifact as in Bamboo plan stage job [string]
+        :param artifacts: Names of the files found for the artifact [list]
+        :param artifacts_links: Links to the files found for the artifact [list]
+        """
+
+        if not self.redis_client:
+            return
+
+        try:
+            self.redis_client.setex(
+                self.manifest_key(bamboo_server=bamboo_server, plan_key=plan_key, job_name=job_name,
+                                  artifact_name=artifact_name),
+                self.ttl,
+                dumps({'artifacts': artifacts or [], 'artifacts_links': artifacts_links or []})
+            )
+        except Exception as err:
+            print("Error when writing artifact manifest to Redis: {err}".format(err=err))
+
+
+class ArtifactDownloadLock(object):
+    """Right to download an artifact into the on-disk cache, so concurrent misses download it once.
+
+    A lock file per artifact, locked with flock(): exclusive between the threads and the processes using the cache,
+    and released by the system if the process dies.
+    """
+
+    # Seconds between two attempts to take a busy lock
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, lock_file=None):
+        """Create the lock instance object.
+        :param lock_file: Full path to the lock file [string]
+        """
+        self.__lock_file = lock_file
+        self.__file_handle = None
+
+    def acquire(self, timeout=None):
+        """Take the lock, waiting for the download in progress if any.
+        :param timeout: Seconds to wait at most [float]
+        :return: True when taken, False on timeout [boolean]
+        """
+
+        file_handle = open(self.__lock_file, 'a')
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.__file_handle = file_handle
+                return True
+            except BlockingIOError:
+                if monotonic() >= deadline:
+                    file_handle.close()
+                    return False
+                sleep(self.POLL_INTERVAL)
+
+    def release(self):
+        """Release the lock (the lock file is kept: removing it could let two downloads run at once)."""
+
+        if self.__file_handle is not None:
+            self.__file_handle.close()
+            self.__file_handle = None
+
+
+class ArtifactCacheWriter(object):
+    """Writes one artifact into the on-disk cache while it is downloaded."""
+
+    def __init__(self, cache=None, index_key=None, download_lock=None):
+        """Create the writer instance object.
+        :param cache: The cache the artifact is written into [ArtifactDiskCache]
+        :param index_key: (Bamboo server, build result key, job name, artifact path) [tuple]
+        :param download_lock: Lock of the download, released once the artifact is added or dropped
+        [ArtifactDownloadLock]
+        """
+        self.__cache = cache
+        self.__index_key = index_key
+        self.__download_lock = download_lock
+        self.__sha = hashlib.sha256()
+        self.__size = 0
+        # Committed or aborted
+        self.__finished = False
+
+        file_descriptor, self.__temp_file = tempfile.mkstemp(dir=cache.temp_dir)
+        self.__file_handle = os.fdopen(file_descriptor, 'wb')
+
+    @property
+    def size(self):
+        """Get the number of bytes written so far."""
+        return self.__size
+
+    def write(self, chunk=None):
+        """Append a chunk of the artifact.
+        :param chunk: Artifact content [bytes]
+        """
+
+        if not chunk:
+            return
+
+        self.__file_handle.write(chunk)
+        self.__sha.update(chunk)
+        self.__size += len(chunk)
+
+    def commit(self):
+        """Add the written artifact to the cache.
+        :return: Full path to the cached artifact [string]
+        """
+
+        self.__finished = True
+        self.__file_handle.close()
+        try:
+            return self.__cache.add_blob(index_key=self.__index_key, temp_file=self.__temp_file,
+                                         digest=self.__sha.hexdigest(), size=self.__size)
+        finally:
+            if self.__download_lock:
+                self.__download_lock.release()
+
+    def abort(self):
+        """Drop the written content, unless already committed or aborted."""
+
+        if self.__finished:
+            return
+
+        self.__finished = True
+        self.__file_handle.close()
+        try:
+            os.remove(self.__temp_file)
+        except OSError:
+            pass
+        finally:
+            if self.__download_lock:
+                self.__download_lock.release()
+
+
+class ArtifactDiskCache(object):
+    """Content addressed on-disk cache for the artifacts downloaded from Bamboo.
+
+    The files are stored once per content hash (SHA256) and indexed by (Bamboo server, build result key, job name,
+    artifact path). When the cache grows over its size cap the least recently used files are evicted.
+    """
+
+    STATS = ('hits', 'misses', 'evictions')
+
+    def __init__(self, cache_dir=None, max_size=None):
+        """Create the cache instance object.
+        :param cache_dir: Full path to the cache directory [string]
+        :param max_size: Maximum size of the cache, in bytes [int]
+        """
+        self.__cache_dir = cache_dir or config.ARTIFACTS_CACHE_DIR
+        self.__max_size = config.ARTIFACTS_CACHE_MAX_SIZE if max_size is None else max_size
+
+        self.__objects_dir = path.join(self.__cache_dir, "objects")
+        self.__temp_dir = path.join(self.__cache_dir, "tmp")
+        self.__index_file = path.join(self.__cache_dir, "index.sqlite3")
+
+        os.makedirs(self.__objects_dir, exist_ok=True)
+        os.makedirs(self.__temp_dir, exist_ok=True)
+
+        with self.__connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "server TEXT, plan_key TEXT, job_name TEXT, artifact_path TEXT, digest TEXT, last_access REAL, "
+                "PRIMARY KEY (server, plan_key, job_name, artifact_path))"
+            )
+            connection.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            connection.executemany("INSERT OR IGNORE INTO stats VALUES (?, 0)", ((name,) for name in self.STATS))
+
+    @property
+    def cache_dir(self):
+        """Get the path to the cache directory."""
+        return self.__cache_dir
+
+    @property
+    def max_size(self):
+        """Get the size cap of the cache."""
+        return self.__max_size
+
+    @property
+    def temp_dir(self):
+        """Get the path to the directory holding the partial downloads."""
+        return self.__temp_dir
+
+    @contextmanager
+    def __connect(self):
+        # Several processes may use the same cache: wait for the index lock instead of failing
+        connection = sqlite3.connect(self.__index_file, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def blob_path(self, digest=None):
+        """Compute the path of a cached file.
+        :param digest: SHA256 of the file content [string]
+        :return: Full path to the file [string]
+        """
+        return path.join(self.__objects_dir, digest[:2], digest)
+
+    def lookup(self, server=None, plan_key=None, job_name=None, artifact_path=None, count=True):
+        """Get the cached copy of an artifact.
+        :param server: Bamboo server name [string]
+        :param plan_key: Bamboo build result key [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_path: Path of the artifact inside the job artifacts [string]
+        :param count: Count the lookup as a hit or a miss in the statistics [boolean]
+        :return: Full path to the cached file on hit, None on miss
+        """
+
+        index_key = (server, plan_key, job_name, artifact_path)
+        with self.__connect() as connection:
+            row = connection.execute(
+                "SELECT digest FROM entries WHERE server=? AND plan_key=? AND job_name=? AND artifact_path=?",
+                index_key
+            ).fetchone()
+
+            blob_file = self.blob_path(row[0]) if row else None
+            if blob_file and not path.isfile(blob_file):
+                # File removed behind our back
+                connection.execute(
+                    "DELETE FROM entries WHERE server=? AND plan_key=? AND job_name=? AND artifact_path=?", index_key
+                )
+                blob_file = None
+
+            if not blob_file:
+                if count:
+                    connection.execute("UPDATE stats SET value = value + 1 WHERE name='misses'")
+                return None
+
+            connection.execute(
+                "UPDATE entries SET last_access=? WHERE server=? AND plan_key=? AND job_name=? AND artifact_path=?",
+                (time(),) + index_key
+            )
+            if count:
+                connection.execute("UPDATE stats SET value = value + 1 WHERE name='hits'")
+
+        return blob_file
+
+    def download_lock(self, server=None, plan_key=None, job_name=None, artifact_path=None):
+        """Get the lock taken to download an artifact into the cache.
+        :param server: Bamboo server name [string]
+        :param plan_key: Bamboo build result key [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_path: Path of the artifact inside the job artifacts [string]
+        :return: ArtifactDownloadLock
+        """
+
+        key_digest = hashlib.sha256(dumps([server, plan_key, job_name, artifact_path]).encode()).hexdigest()
+        return ArtifactDownloadLock(lock_file=path.join(self.__temp_dir, "{0}.lock".format(key_digest)))
+
+    def writer(self, server=None, plan_key=None, job_name=None, artifact_path=None, download_lock=None):
+        """Get a writer used to add an artifact to the cache while downloading it.
+        :param server: Bamboo server name [string]
+        :param plan_key: Bamboo build result key [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_path: Path of the artifact inside the job artifacts [string]
+        :param download_lock: Lock of the download, held by the caller and released by the writer
+        [ArtifactDownloadLock]
+        :return: ArtifactCacheWriter
+        """
+        return ArtifactCacheWriter(cache=self, index_key=(server, plan_key, job_name, artifact_path),
+                                   download_lock=download_lock)
+
+    def add_blob(self, index_key=None, temp_file=None, digest=None, size=None):
+        """Move a downloaded file into the cache and index it.
+        :param index_key: (Bamboo server, build result key, job name, artifact path) [tuple]
+        :param temp_file: Full path to the downloaded file [string]
+        :param digest: SHA256 of the file content [string]
+        :param size: Size of the file, in bytes [int]
+        :return: Full path to the cached file [string]
+        """
+
+        blob_file = self.blob_path(digest)
+        os.makedirs(path.dirname(blob_file), exist_ok=True)
+
+        if path.isfile(blob_file):
+            # Same content is already cached
+            os.remove(temp_file)
+        else:
+            os.replace(temp_file, blob_file)
+
+        with self.__connect() as connection:
+            connection.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?)", (digest, size))
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                               tuple(index_key) + (digest, time()))
+
+        self.prune()
+
+        return blob_file
+
+    def prune(self, max_size=None):
+        """Evict the least recently used files until the cache fits into the size cap.
+        :param max_size: Size cap to use instead of the configured one, in bytes [int]
+        :return: Number of evicted files [int]
+        """
+
+        if max_size is None:
+            max_size = self.max_size
+
+        evicted = 0
+        with self.__connect() as connection:
+            # Files no longer indexed
+            for (digest,) in connection.execute(
+                "SELECT digest FROM blobs WHERE digest NOT IN (SELECT digest FROM entries)"
+            ).fetchall():
+                self.__remove_blob(connection, digest)
+
+            total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total_size <= max_size:
+                return evicted
+
+            for digest, size in connection.execute(
+                "SELECT blobs.digest, blobs.size FROM blobs JOIN entries ON blobs.digest = entries.digest "
+                "GROUP BY blobs.digest ORDER BY MAX(entries.last_access)"
+            ).fetchall():
+                if total_size <= max_size:
+                    break
+
+                connection.execute("DELETE FROM entries WHERE digest=?", (digest,))
+                self.__remove_blob(connection, digest)
+                total_size -= size
+                evicted += 1
+
+            connection.execute("UPDATE stats SET value = value + ? WHERE name='evictions'", (evicted,))
+
+        return evicted
+
+    def __remove_blob(self, connection, digest):
+        connection.execute("DELETE FROM blobs WHERE digest=?", (digest,))
+        try:
+            os.remove(self.blob_path(digest))
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all the files from the cache."""
+        return self.prune(max_size=-1)
+
+    def entries(self):
+        """Get all the cached artifacts, most recently used first.
+        :return: A list of dictionaries
+        """
+
+        with self.__connect() as connection:
+            rows = connection.execute(
+                "SELECT entries.server, entries.plan_key, entries.job_name, entries.artifact_path, entries.digest, "
+                "blobs.size, entries.last_access FROM entries JOIN blobs ON entries.digest = blobs.digest "
+                "ORDER BY entries.last_access DESC"
+            ).fetchall()
+
+        keys = ('server', 'plan_key', 'job_name', 'artifact_path', 'digest', 'size', 'last_access')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self):
+        """Get the cache statistics.
+        :return: A dictionary
+        """
+
+        with self.__connect() as connection:
+            stats = dict(connection.execute("SELECT name, value FROM stats").fetchall())
+            stats['entries'] = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            stats['files'], stats['size'] = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs"
+            ).fetchone()
+
+        stats['max_size'] = self.max_size
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+
+        return stats
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Inspect and prune the on-disk artifacts cache.")
+    parser.add_argument('-c', dest='cache_dir', required=False, help='Path to the cache directory!')
+    parser.add_argument('-s', dest='stats', action='store_true', help='Show the cache statistics!')
+    parser.add_argument('-l', dest='list', action='store_true', help='List the cached artifacts!')
+    parser.add_argument('-p', dest='prune', required=False, type=int,
+                        help='Evict least recently used files until the cache is smaller than this many MB!')
+    parser.add_argument('--clear', dest='clear', action='store_true', help='Remove all the cached files!')
+    args = parser.parse_args()
+
+    cache = ArtifactDiskCache(cache_dir=args.cache_dir)
+
+    if args.list:
+        print(dumps(cache.entries(), indent=4))
+
+    if args.prune is not None:
+        print("\nEvicted {0} file(s)\n".format(cache.prune(max_size=args.prune * 1024 * 1024)))
+
+    if args.clear:
+        print("\nEvicted {0} file(s)\n".format(cache.clear()))
+
+    if args.stats or not (args.list or args.clear or args.prune is not None):
+        print(dumps(cache.stats(), indent=4))
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -9,13 +9,16 @@ import base64
 import json
 import os
 import requests
+import shutil
 import sys
+import threading
 
-from bs4 import BeautifulSoup
+from time import time
 
 # Add custom libs
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from config.default import BAMBOO_PASS, BAMBOO_USER
+from config import default as config
+from metrics import REGISTRY
 
 
 class BambooAccount:
@@ -36,22 +39,71 @@ class BambooAccount:
 
     @staticmethod
     def __load_credentials():
-        return BAMBOO_USER, base64.b64decode(BAMBOO_PASS)
+        return config.BAMBOO_USER, base64.b64decode(config.BAMBOO_PASS)
+
+
+class BambooSessions(object):
+    """HTTP sessions to the Bamboo servers: one per server, each with its own connection pool (kept alive between the
+    requests), shared by the threads of the process. A slow server only exhausts its own pool.
+    """
+
+    # {bamboo_server: session}
+    __SESSIONS = dict()
+    __LOCK = threading.Lock()
+
+    @staticmethod
+    def session(bamboo_server=None):
+        """Get (create on first use) the session of a Bamboo server.
+        :param bamboo_server: Bamboo server name [string]
+        :return: The session [requests.Session]
+        """
+
+        session = BambooSessions.__SESSIONS.get(bamboo_server)
+        if session is None:
+            with BambooSessions.__LOCK:
+                session = BambooSessions.__SESSIONS.get(bamboo_server)
+                if session is None:
+                    # Two hosts per server: the API and the artifacts (see 'artifacts_domain')
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=config.BAMBOO_POOL_SIZE)
+                    session = requests.Session()
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    BambooSessions.__SESSIONS[bamboo_server] = session
+
+        return session
+
+    @staticmethod
+    def reset():
+        """Close and drop all the sessions."""
+
+        with BambooSessions.__LOCK:
+            for session in BambooSessions.__SESSIONS.values():
+                session.close()
+            BambooSessions.__SESSIONS.clear()
 
 
 class BambooAPI:
     """Bamboo API related tasks."""
 
-    def __init__(self, verbose=False, bamboo_server=None):
+    def __init__(self, verbose=False, bamboo_server=None, artifact_cache=None, url_scheme=None,
+                 artifacts_domain=None, rate_limiter=None, circuit_breaker=None):
         self.__account = BambooAccount()
+        self.__artifact_cache = artifact_cache
+
+        # Shared by all the instances of the process unless supplied; False disables them
+        self.__rate_limiter = config.BAMBOO_RATE_LIMITER if rate_limiter is None else rate_limiter
+        self.__circuit_breaker = config.BAMBOO_CIRCUIT_BREAKER if circuit_breaker is None else circuit_breaker
+
+        url_scheme = url_scheme or config.BAMBOO_URL_SCHEME
+        artifacts_domain = config.BAMBOO_ARTIFACTS_DOMAIN if artifacts_domain is None else artifacts_domain
 
-        self.__trigger_plan_url_mask = r'https://{bamboo_server_name}/rest/api/latest/queue/'
-        self.__stop_plan_url_mask = r'https://{bamboo_server_name}/build/admin/stopPlan.action'
-        self.__plan_results_url_mask = r'https://{bamboo_server_name}/rest/api/latest/result/'
-        self.__query_plan_url_mask = r'https://{bamboo_server_name}/rest/api/latest/plan/'
-        self.__latest_queue_url_mask = r'https://{bamboo_server_name}/rest/api/latest/queue.json'
-        self.__artifact_url_mask = \
-            r'https://{bamboo_server_name}.sw.nxp.com/browse/{plan_key}/artifact/{job_name}/{artifact_name}/'
+        self.__trigger_plan_url_mask = url_scheme + r'://{bamboo_server_name}/rest/api/latest/queue/'
+        self.__stop_plan_url_mask = url_scheme + r'://{bamboo_server_name}/build/admin/stopPlan.action'
+        self.__plan_results_url_mask = url_scheme + r'://{bamboo_server_name}/rest/api/latest/result/'
+        self.__query_plan_url_mask = url_scheme + r'://{bamboo_server_name}/rest/api/latest/plan/'
+        self.__latest_queue_url_mask = url_scheme + r'://{bamboo_server_name}/rest/api/latest/queue.json'
+        artifacts_url_mask = url_scheme + r'://{bamboo_server_name}' + artifacts_domain
+        self.__artifact_url_mask = artifacts_url_mask + r'/browse/{plan_key}/artifact/{job_name}/{artifact_name}/'
 
         self.__bamboo_server = bamboo_server
         self.__plan_key = None
@@ -75,6 +127,25 @@ class BambooAPI:
         """Get account object."""
         return self.__account
 
+    @property
+    def artifact_cache(self):
+        """Get the on-disk artifacts cache."""
+        return self.__artifact_cache
+
+    @artifact_cache.setter
+    def artifact_cache(self, artifact_cache_value):
+        self.__artifact_cache = artifact_cache_value
+
+    @property
+    def rate_limiter(self):
+        """Get the rate limiter of the Bamboo requests."""
+        return self.__rate_limiter
+
+    @property
+    def circuit_breaker(self):
+        """Get the circuit breaker of the Bamboo requests."""
+        return self.__circuit_breaker
+
     @property
     def artifact_name(self):
         """Get artifact name."""
@@ -172,11 +243,76 @@ class BambooAPI:
         """
 
         response = dict()
-        for key, value in values_to_pack:
+        for key, value in values_to_pack.items():
             response[key] = value
 
         return response
 
+    ###########################################################################################
+    def __send_request(self, operation=None, method=None, url=None, timeout=None, allow_redirects=False, data=None,
+                       stream=False, bamboo_server=None):
+        """Send an HTTP request to Bamboo using the account credentials, once the rate limiter and the circuit breaker
+        allow it.
+        :param operation: Name of the operation, used in metrics and rate limits (e.g.: <trigger/plan_info/stop_plan>)
+        [string]
+        :param method: HTTP method [string]
+        :param url: URL to request [string]
+        :param timeout: Timeout of the request, in seconds [int]
+        :param allow_redirects: Follow redirects [boolean]
+        :param data: Request body [string]
+        :param stream: Do not download the response body upfront [boolean]
+        :param bamboo_server: Bamboo server requested, defaults to 'bamboo_server' [string]
+        :return: requests.Response
+        :raise: Exception, ValueError on errors
+        """
+
+        bamboo_server = bamboo_server or self.bamboo_server
+
+        # Waits outside of the circuit: only the outcome of the request itself is recorded
+        if self.rate_limiter:
+            self.rate_limiter.acquire(bamboo_server=bamboo_server, operation=operation)
+
+        # Fails at once while the server keeps failing (CircuitOpenError is a ValueError)
+        if self.circuit_breaker:
+            self.circuit_breaker.before_request(bamboo_server=bamboo_server)
+
+        start_time = time()
+        status = "error"
+        try:
+            response = BambooSessions.session(bamboo_server=bamboo_server).request(
+                method,
+                url=url,
+                auth=requests.auth.HTTPBasicAuth(self.account.username, self.account.password),
+                headers=self.headers,
+                data=data,
+                timeout=timeout,
+                allow_redirects=allow_redirects,
+                stream=stream
+            )
+            status = str(response.status_code)
+        except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
+                requests.ConnectTimeout, requests.Timeout) as err:
+            raise ValueError(
+                "Error when requesting URL: '{url}'{line_sep}{err}".format(url=url, line_sep=os.linesep, err=err)
+            )
+        except Exception as err:
+            raise Exception(
+                "Unknown error when requesting URL: '{url}'{line_sep}{err}".format(
+                    url=url, line_sep=os.linesep, err=err
+                )
+            )
+        finally:
+            REGISTRY.histogram('bamboo_request_duration_seconds', "Duration of the Bamboo requests.",
+                               ('operation',)).observe(time() - start_time, operation=operation)
+            REGISTRY.counter('bamboo_requests_total', "Bamboo requests by operation and HTTP status.",
+                             ('operation', 'status')).inc(operation=operation, status=status)
+
+            if self.circuit_breaker:
+                self.circuit_breaker.record(bamboo_server=bamboo_server,
+                                            failed=status == "error" or status.startswith("5"))
+
+        return response
+
     ###########################################################################################
     def compound_url(self, query_type=None):
         """Compound the URL.
@@ -189,31 +325,32 @@ class BambooAPI:
 
         if query_type == 'plan_status':
             url = "{url}{plan_key}.json{opt}".format(
-                url=self.query_plan_url_mask.format(self.bamboo_server),
+                url=self.query_plan_url_mask.format(bamboo_server_name=self.bamboo_server),
                 plan_key=self.plan_key,
                 opt="?includeAllStates=true"
             )
         elif query_type == 'plan_info':
             url = "{url}{plan_key}.json{opt}".format(
-                url=self.plan_results_url_mask.format(self.bamboo_server),
+                url=self.plan_results_url_mask.format(bamboo_server_name=self.bamboo_server),
                 plan_key=self.plan_key,
                 opt="?max-results=10000"
             )
         elif query_type == 'stop_plan':
             url = "{url}?planResultKey={plan_key}".format(
-                url=self.stop_plan_url_mask.format(self.bamboo_server),
+                url=self.stop_plan_url_mask.format(bamboo_server_name=self.bamboo_server),
                 plan_key=self.plan_key
             )
         elif query_type == 'query_queue':
             url = "{url}{opt}".format(
-                url=self.latest_queue_url_mask.format(self.bamboo_server),
+                url=self.latest_queue_url_mask.format(bamboo_server_name=self.bamboo_server),
                 opt="?expand=queuedBuilds"
             )
         elif query_type in ['download_artifact', 'query_for_artifacts']:
             url = (
                 "{url}{opt}".format(
                     url=self.artifact_url_mask.format(
-                        self.bamboo_server, self.plan_key, self.job_name, self.artifact_name
+                        bamboo_server_name=self.bamboo_server, plan_key=self.plan_key, job_name=self.job_name,
+                        artifact_name=self.artifact_name
                     ),
                     opt=self.url_extra_values)
             )
@@ -255,28 +392,14 @@ class BambooAPI:
 
                 request_payload["bamboo.{key}".format(key=key)] = [value]
 
-        url = "{url}{plan_key}.json".format(url=self.trigger_plan_url_mask.format(bamboo_server), plan_key=plan_key)
+        url = "{url}{plan_key}.json".format(
+            url=self.trigger_plan_url_mask.format(bamboo_server_name=bamboo_server or self.bamboo_server),
+            plan_key=plan_key
+        )
         if self.verbose:
             print("URL used to trigger build: '{url}'".format(url=url))
-        try:
-            response = requests.request('POST',
-                                        url=url,
-                                        auth=requests.auth.HTTPBasicAuth(self.account.username, self.account.password),
-                                        headers=self.headers,
-                                        data=json.dumps(request_payload),
-                                        timeout=30,
-                                        allow_redirects=False)
-        except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
-                requests.ConnectTimeout, requests.Timeout) as err:
-            raise ValueError(
-                "Error when requesting URL: '{url}'{line_sep}{err}".format(url=url, line_sep=os.linesep, err=err)
-            )
-        except Exception as err:
-            raise Exception(
-                "Unknown error when requesting URL: '{url}'{line_sep}{err}".format(
-                    url=url, line_sep=os.linesep, err=err
-                )
-            )
+        response = self.__send_request(operation='trigger', method='POST', url=url, timeout=30, allow_redirects=False,
+                                       data=json.dumps(request_payload), bamboo_server=bamboo_server)
 
         # Check HTTP response code
         if response.status_code != 200:
@@ -321,29 +444,52 @@ class BambooAPI:
         if self.verbose:
             print("URL used in query: '{url}'".format(url=url))
 
-        try:
-            response = requests.request('GET',
-                                        url=url,
-                                        auth=requests.auth.HTTPBasicAuth(self.account.username, self.account.password),
-                                        headers=self.headers,
-                                        timeout=30,
-                                        allow_redirects=False)
-        except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
-                requests.ConnectTimeout, requests.Timeout) as err:
-            raise ValueError(
-                "Error when requesting URL: '{url}'{line_sep}{err}".format(url=url, line_sep=os.linesep, err=err)
+        response = self.__send_request(operation=query_type, method='GET', url=url, timeout=30, allow_redirects=False)
+
+        # Check HTTP response code
+        if response.status_code != 200:
+            return self.pack_response_to_client(
+                response=False, status_code=response.status_code, content=response.json(), url=url
             )
+
+        try:
+            # Get the JSON reply from the web page
+            response.encoding = "utf-8"
+            response_json = response.json()
+        except ValueError as err:
+            raise ValueError("Error decoding JSON: {err}".format(err=err))
         except Exception as err:
-            raise Exception(
-                "Unknown error when requesting URL: '{url}'{line_sep}{err}".format(
-                    url=url, line_sep=os.linesep, err=err
-                )
-            )
+            raise Exception("Unknown error: {err}".format(err=err))
+
+        # Send response to client
+        return self.pack_response_to_client(
+            response=True, status_code=response.status_code, content=response_json, url=url
+        )
+
+    ###########################################################################################
+    def query_build_queue(self, bamboo_server=None):
+        """Query the build queue of a Bamboo server using Bamboo API.
+        :param bamboo_server: Bamboo server used in API call [string]
+        :return: A dictionary containing HTTP status_code and request content
+        :raise: Exception, ValueError on errors
+        """
+
+        if not bamboo_server and not self.bamboo_server:
+            return {'content': "No Bamboo server supplied!"}
+
+        self.bamboo_server = bamboo_server or self.bamboo_server
+
+        url = self.compound_url('query_queue')
+        if self.verbose:
+            print("URL used to query the build queue: '{url}'".format(url=url))
+
+        response = self.__send_request(operation='query_queue', method='GET', url=url, timeout=30,
+                                       allow_redirects=False)
 
         # Check HTTP response code
         if response.status_code != 200:
             return self.pack_response_to_client(
-                response=False, status_code=response.status_code, content=response.json(), url=url
+                response=False, status_code=response.status_code, content=response.text, url=url
             )
 
         try:
@@ -399,31 +545,17 @@ class BambooAPI:
             if self.verbose:
                 print("URL used to query for artifacts: '{url}'".format(url=url))
 
-            try:
-                response = requests.request('GET',
-                                            url=url,
-                                            auth=requests.auth.HTTPBasicAuth(self.account.username,
-                                                                             self.account.password),
-                                            headers=self.headers,
-                                            timeout=60,
-                                            allow_redirects=True)
-            except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
-                    requests.ConnectTimeout, requests.Timeout) as err:
-                raise ValueError(
-                    "Error when requesting URL: '{url}'{line_sep}{err}".format(url=url, line_sep=os.linesep, err=err)
-                )
-            except Exception as err:
-                raise Exception(
-                    "Unknown error when requesting URL: '{url}'{line_sep}{err}".format(
-                        url=url, line_sep=os.linesep, err=err
-                    )
-                )
+            response = self.__send_request(operation=query_type, method='GET', url=url, timeout=60,
+                                           allow_redirects=True)
 
             # Check HTTP response code
             if response.status_code != 200:
                 http_failed_conn_counter += 1
                 continue
 
+            # Imported here: only the artifacts crawl needs the (slow to import) HTML parser
+            from bs4 import BeautifulSoup
+
             try:
                 # page = requests.get(url).text  <-- Works if Bamboo plan does not require AUTH
                 soup = BeautifulSoup(response.text, 'html.parser')
@@ -458,73 +590,162 @@ class BambooAPI:
         return response_to_client
 
     ###########################################################################################
-    def get_artifact(self, bamboo_server=None, plan_key=None, query_type=None, job_name=None, artifact_name=None,
-                     url_extra_values=None, destination_file=None):
-        """Download artifacts from Bamboo plan.
+    def open_artifact(self, bamboo_server=None, plan_key=None, query_type=None, job_name=None, artifact_name=None,
+                      url_extra_values=None):
+        """Open a streamed download of an artifact from Bamboo plan.
         :param bamboo_server: Bamboo server used in API call [string]
         :param plan_key: Bamboo plan key [string]
         :param query_type: Type of the query (e.g.: <plan_info/plan_status/stop_plan/download_artifact>) [string]
         :param job_name: Bamboo plan job name [string]
         :param artifact_name: Name of the artifact as in Bamboo plan stage job [string]
         :param url_extra_values: Extra values to compound the URL [string]
-        :param destination_file: Full path to destination file [string]
-        :return: A dictionary containing HTTP status_code and request content
+        :return: A dictionary containing HTTP status_code and the streamed response (to be closed by the caller)
         :raise: Exception, ValueError on Errors
         """
 
         if not bamboo_server and not self.bamboo_server:
             return {'content': "No Bamboo server supplied!"}
 
-        if not plan_key or not query_type or not job_name or not artifact_name or not destination_file:
+        if not plan_key or not query_type or not job_name or not artifact_name:
             return {'content': "Incorrect input provided!"}
 
         self.bamboo_server = bamboo_server
         self.plan_key = plan_key
         self.job_name = job_name
         self.artifact_name = artifact_name
-
-        if url_extra_values:
-            self.url_extra_values = url_extra_values
+        self.url_extra_values = url_extra_values or ''
 
         url = self.compound_url(query_type)
 
         if self.verbose:
             print("URL used to download artifact: '{url}'".format(url=url))
 
-        try:
-            response = requests.request('GET',
-                                        url=url,
-                                        auth=requests.auth.HTTPBasicAuth(self.account.username, self.account.password),
-                                        headers=self.headers,
-                                        timeout=60,
-                                        allow_redirects=False)
-        except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
-                requests.ConnectTimeout, requests.Timeout) as err:
-            raise ValueError(
-                "Error when requesting URL: '{url}'{line_sep}{err}".format(url=url, line_sep=os.linesep, err=err)
-            )
-        except Exception as err:
-            raise Exception(
-                "Unknown error when requesting URL: '{url}'{line_sep}{err}".format(
-                    url=url, line_sep=os.linesep, err=err
-                )
-            )
+        response = self.__send_request(operation=query_type, method='GET', url=url, timeout=60, allow_redirects=False,
+                                       stream=True)
 
         # Check HTTP response code
         if response.status_code != 200:
+            response.close()
             return self.pack_response_to_client(
-                response=False, status_code=response.status_code, content=response.json(), url=url
+                response=False, status_code=response.status_code, content=response.reason, url=url
             )
 
+        response_to_client = self.pack_response_to_client(
+            response=True, status_code=response.status_code, content=None, url=url
+        )
+        response_to_client['stream'] = response
+
+        return response_to_client
+
+    ###########################################################################################
+    def copy_cached_artifact(self, artifact_path=None, destination_file=None):
+        """Copy an artifact of the current plan job from the on-disk cache, if it was already downloaded.
+        :param artifact_path: Path of the artifact: name and extra values [string]
+        :param destination_file: Full path to destination file [string]
+        :return: True if copied from the cache [boolean]
+        :raise: Exception on Errors
+        """
+
+        if not self.artifact_cache:
+            return False
+
+        cached_file = self.artifact_cache.lookup(server=self.bamboo_server, plan_key=self.plan_key,
+                                                 job_name=self.job_name, artifact_path=artifact_path)
+        if not cached_file:
+            return False
+
+        if self.verbose:
+            print("Artifact served from cache: '{file}'".format(file=cached_file))
+
         try:
-            get_file = requests.get(url)
+            shutil.copyfile(cached_file, destination_file)
+        except Exception as err:
+            raise Exception("Unknown error when copying cached artifact: {err}".format(err=err))
+
+        return True
+
+    ###########################################################################################
+    @staticmethod
+    def save_artifact_stream(response=None, destination_file=None, cache_writer=None):
+        """Write a streamed artifact to a file, and to the on-disk cache. The response is closed.
+        :param response: Streamed response of 'open_artifact' [requests.Response]
+        :param destination_file: Full path to destination file [string]
+        :param cache_writer: Writes the artifact to the cache, None if not cached [ArtifactCacheWriter]
+        :raise: Exception, ValueError on Errors
+        """
 
+        try:
+            # Stream the file: artifacts can be several GB
             with open(destination_file, 'wb') as f:
-                f.write(get_file.content)
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+
+                    if cache_writer:
+                        cache_writer.write(chunk)
+
+            if cache_writer:
+                cache_writer.commit()
         except ValueError as err:
+            if cache_writer:
+                cache_writer.abort()
             raise ValueError("Error when downloading artifact: {err}".format(err=err))
         except Exception as err:
+            if cache_writer:
+                cache_writer.abort()
             raise Exception("Unknown error when downloading artifact: {err}".format(err=err))
+        finally:
+            response.close()
+
+    ###########################################################################################
+    def get_artifact(self, bamboo_server=None, plan_key=None, query_type=None, job_name=None, artifact_name=None,
+                     url_extra_values=None, destination_file=None):
+        """Download artifacts from Bamboo plan.
+        :param bamboo_server: Bamboo server used in API call [string]
+        :param plan_key: Bamboo plan key [string]
+        :param query_type: Type of the query (e.g.: <plan_info/plan_status/stop_plan/download_artifact>) [string]
+        :param job_name: Bamboo plan job name [string]
+        :param artifact_name: Name of the artifact as in Bamboo plan stage job [string]
+        :param url_extra_values: Extra values to compound the URL [string]
+        :param destination_file: Full path to destination file [string]
+        :return: A dictionary containing HTTP status_code and request content
+        :raise: Exception, ValueError on Errors
+        """
+
+        if not bamboo_server and not self.bamboo_server:
+            return {'content': "No Bamboo server supplied!"}
+
+        if not plan_key or not query_type or not job_name or not artifact_name or not destination_file:
+            return {'content': "Incorrect input provided!"}
+
+        self.bamboo_server = bamboo_server
+        self.plan_key = plan_key
+        self.job_name = job_name
+        self.artifact_name = artifact_name
+
+        # The extra values (file name inside the artifact) are part of the cache key: never reuse stale ones
+        self.url_extra_values = url_extra_values or ''
+
+        url = self.compound_url(query_type)
+        artifact_path = "{name}/{extra}".format(name=artifact_name, extra=self.url_extra_values)
+
+        # Serve the artifact from the on-disk cache if it was already downloaded
+        if self.copy_cached_artifact(artifact_path=artifact_path, destination_file=destination_file):
+            return self.pack_response_to_client(response=True, status_code=200, content=None, url=url)
+
+        artifact_stream = self.open_artifact(bamboo_server=bamboo_server, plan_key=plan_key, query_type=query_type,
+                                             job_name=job_name, artifact_name=artifact_name,
+                                             url_extra_values=url_extra_values)
+        if not artifact_stream.get('response'):
+            return artifact_stream
+
+        response = artifact_stream.get('stream')
+
+        cache_writer = None
+        if self.artifact_cache:
+            cache_writer = self.artifact_cache.writer(server=self.bamboo_server, plan_key=plan_key,
+                                                      job_name=job_name, artifact_path=artifact_path)
+
+        self.save_artifact_stream(response=response, destination_file=destination_file, cache_writer=cache_writer)
 
         # Send response to client
         return self.pack_response_to_client(
@@ -555,24 +776,7 @@ class BambooAPI:
         if self.verbose:
             print("URL used to stop plan: '{url}'".format(url=url))
 
-        try:
-            response = requests.request('POST',
-                                        url=url,
-                                        auth=requests.auth.HTTPBasicAuth(self.account.username, self.account.password),
-                                        headers=self.headers,
-                                        timeout=30,
-                                        allow_redirects=True)
-        except (requests.RequestException, requests.ConnectionError, requests.HTTPError,
-                requests.ConnectTimeout, requests.Timeout) as err:
-            raise ValueError(
-                "Error when requesting URL: '{url}'{line_sep}{err}".format(url=url, line_sep=os.linesep, err=err)
-            )
-        except Exception as err:
-            raise Exception(
-                "Unknown error when requesting URL: '{url}'{line_sep}{err}".format(
-                    url=url, line_sep=os.linesep, err=err
-                )
-            )
+        response = self.__send_request(operation=query_type, method='POST', url=url, timeout=30, allow_redirects=True)
 
         # Check HTTP response code
         if response.status_code != 200:
@@ -0,0 +1,4 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Benchmarks and local stand-ins (Bamboo, Redis) used to exercise the service without production systems."""
@@ -0,0 +1,354 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""API load test:
+Drives '/create_task', '/get_product_info' and '/dump_db_content' at fixed rates (open loop: the requests are sent
+on schedule, no matter how slow the previous ones were) and reports latency percentiles, error rates and throughput
+per endpoint.
+
+By default the Flask APP is served in-process on a free port, backed by the Redis stand-in from
+'benchmarks.fake_redis'. Use '--url' to load an API instance started elsewhere.
+
+With '--ramp' the rate of '/get_product_info' is multiplied step by step; the last step meeting the latency and
+error objectives gives the number of polling agents a single API instance sustains
+(rate x '--poll-interval').
+
+Examples:
+    python benchmarks/api_load.py -r get_product_info=50 -r create_task=2 -d 30
+    python benchmarks/api_load.py --ramp 1,2,4,8,16 --slo-p95 0.2 -o api_load.json
+    python benchmarks/api_load.py --url http://api-host:8888 -r get_product_info=100 -c 32
+"""
+
+
+import argparse
+import heapq
+import queue
+import random
+import sys
+import threading
+
+from json import loads
+from os import path
+from time import sleep, time
+
+import requests
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.report import write_report
+from task_cache import TaskStatusCache
+from utils import StatsUtils
+
+
+class InProcessAPI(object):
+    """The Flask APP served on a background thread, backed by the Redis stand-in."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """Create the server.
+        :param host: Address to listen on [string]
+        :param port: Port to listen on, 0 picks a free one [int]
+        """
+
+        from werkzeug.serving import WSGIRequestHandler, make_server
+        from app import APP
+
+        class QuietRequestHandler(WSGIRequestHandler):
+            """Request handler without the access log."""
+
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.redis_client = FakeRedis()
+        APP.config['REDIS'] = self.redis_client
+        APP.config['REDIS_RAW'] = FakeRedis(server=self.redis_client.server, decode_responses=False)
+        APP.config['TASK_CACHE'] = TaskStatusCache(redis_client=self.redis_client)
+        APP.config['BAMBOO_SERVER'] = "bamboo.local"
+
+        self.__http_server = make_server(host, port, APP, threaded=True, request_handler=QuietRequestHandler)
+        self.__thread = None
+
+    @property
+    def url(self):
+        """Get the base URL of the API."""
+        return "http://{0}:{1}".format(*self.__http_server.server_address[:2])
+
+    def start(self):
+        """Start serving on a background thread."""
+
+        self.__thread = threading.Thread(target=self.__http_server.serve_forever, name="api", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.__http_server.shutdown()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class APILoadGenerator(object):
+    """Sends the requests of the scenario and collects the samples."""
+
+    ENDPOINTS = ('create_task', 'get_product_info', 'dump_db_content')
+
+    def __init__(self, base_url=None, rates=None, concurrency=16, timeout=10.0):
+        """Create the load generator.
+        :param base_url: Base URL of the API (e.g.: http://127.0.0.1:8888) [string]
+        :param rates: Requests per second per endpoint {endpoint: rate} [dictionary]
+        :param concurrency: Number of requests in flight at most [int]
+        :param timeout: Timeout of a request, seconds [float]
+        """
+        self.__base_url = base_url.rstrip("/")
+        self.__rates = rates or {}
+        self.__concurrency = concurrency
+        self.__timeout = timeout
+
+        self.__task_ids = list()
+        self.__task_ids_lock = threading.Lock()
+        self.__local = threading.local()
+
+    @property
+    def task_ids(self):
+        """Get the IDs of the tasks created so far."""
+        return self.__task_ids
+
+    def __session(self):
+        # One keep-alive connection per sender thread
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = self.__local.session = requests.Session()
+        return session
+
+    def __request(self, endpoint=None):
+        if endpoint == 'create_task':
+            return self.__session().post(
+                "{0}/create_task/loadtest/build".format(self.__base_url), timeout=self.__timeout,
+                data={'planUrl': "http://bamboo.local/browse/PROJ-PLAN", 'waitForPlan': "3600",
+                      'artifactsOnStage': "JOB1", 'artifactNames': "binaries"}
+            )
+
+        if endpoint == 'get_product_info':
+            with self.__task_ids_lock:
+                task_id = random.choice(self.__task_ids) if self.__task_ids else "0" * 128
+            return self.__session().get(
+                "{0}/get_product_info/loadtest/{1}".format(self.__base_url, task_id), timeout=self.__timeout
+            )
+
+        return self.__session().post("{0}/dump_db_content".format(self.__base_url), timeout=self.__timeout)
+
+    def seed(self, no_of_tasks=0):
+        """Create tasks to poll before the load starts."""
+
+        for _ in range(no_of_tasks):
+            self.send(endpoint='create_task')
+
+    def send(self, endpoint=None):
+        """Send one request.
+        :return: (success, status code, seconds) [tuple]
+        """
+
+        start_time = time()
+        try:
+            response = self.__request(endpoint=endpoint)
+        except requests.RequestException:
+            return False, None, time() - start_time
+
+        duration = time() - start_time
+        if endpoint == 'create_task' and response.status_code == 200:
+            task_id = loads(response.text).get('dataBody', {}).get('id')
+            with self.__task_ids_lock:
+                self.__task_ids.append(task_id)
+
+        return response.status_code < 400, response.status_code, duration
+
+    def schedule(self, duration=None):
+        """Get the (send time offset, endpoint) of all the requests of a run, in time order."""
+
+        streams = list()
+        for endpoint, rate in self.__rates.items():
+            if rate > 0:
+                heapq.heappush(streams, (1.0 / rate, endpoint, 1.0 / rate))
+
+        while streams:
+            offset, endpoint, interval = heapq.heappop(streams)
+            if offset > duration:
+                continue
+
+            yield offset, endpoint
+            heapq.heappush(streams, (offset + interval, endpoint, interval))
+
+    def run(self, duration=10.0):
+        """Send the load for a while.
+        :param duration: Seconds [float]
+        :return: Results per endpoint [dictionary]
+        """
+
+        jobs = queue.Queue(maxsize=self.__concurrency * 4)
+        samples = {endpoint: list() for endpoint in self.__rates}
+        lock = threading.Lock()
+
+        def sender():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+
+                scheduled_time, endpoint = job
+                success, status_code, service_time = self.send(endpoint=endpoint)
+                # Latency as seen by the clients: from the scheduled send time, so queueing is not hidden
+                with lock:
+                    samples[endpoint].append((success, status_code, service_time, time() - scheduled_time))
+
+        senders = [threading.Thread(target=sender, daemon=True) for _ in range(self.__concurrency)]
+        for sender_thread in senders:
+            sender_thread.start()
+
+        start_time = time()
+        for offset, endpoint in self.schedule(duration=duration):
+            delay = start_time + offset - time()
+            if delay > 0:
+                sleep(delay)
+            jobs.put((start_time + offset, endpoint))
+
+        for _ in senders:
+            jobs.put(None)
+        for sender_thread in senders:
+            sender_thread.join()
+
+        return self.summary(samples=samples, elapsed=time() - start_time)
+
+    def summary(self, samples=None, elapsed=None):
+        """Summarize the samples of a run.
+        :param samples: (success, status code, service time, latency) per endpoint [dictionary]
+        :param elapsed: Duration of the run, in seconds [float]
+        :return: Results per endpoint [dictionary]
+        """
+
+        results = dict()
+        for endpoint, endpoint_samples in samples.items():
+            status_codes = dict()
+            for _, status_code, _, _ in endpoint_samples:
+                status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+
+            errors = sum(1 for success, _, _, _ in endpoint_samples if not success)
+            results[endpoint] = {
+                'target_rate': self.__rates[endpoint],
+                'requests': len(endpoint_samples),
+                'throughput': round(len(endpoint_samples) / elapsed, 2) if elapsed else None,
+                'error_rate': round(errors / float(len(endpoint_samples)), 4) if endpoint_samples else None,
+                'status_codes': status_codes,
+                'latency': StatsUtils.summary([sample[3] for sample in endpoint_samples]),
+                'service_time': StatsUtils.summary([sample[2] for sample in endpoint_samples])
+            }
+
+        return results
+
+
+def parse_rates(rate_options=None):
+    """Parse the 'endpoint=rate' options."""
+
+    rates = {'create_task': 1.0, 'get_product_info': 20.0, 'dump_db_content': 0.1}
+    for rate_option in rate_options or []:
+        endpoint, separator, rate = rate_option.partition("=")
+        if not separator or endpoint not in APILoadGenerator.ENDPOINTS:
+            raise ValueError("Rate must be <endpoint>=<requests per second>: '{0}'".format(rate_option))
+        rates[endpoint] = float(rate)
+
+    return rates
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Load test the API endpoints.")
+    parser.add_argument('--url', dest='url', required=False, help='Base URL of the API, in-process API if missing!')
+    parser.add_argument('-r', dest='rates', action='append', default=[],
+                        help='Requests per second as endpoint=rate (create_task/get_product_info/dump_db_content)!')
+    parser.add_argument('-c', dest='concurrency', type=int, default=16, help='Requests in flight at most!')
+    parser.add_argument('-d', dest='duration', type=float, default=10.0, help='Seconds per step!')
+    parser.add_argument('-s', dest='seed', type=int, default=1000, help='Tasks to create before the load!')
+    parser.add_argument('-o', dest='output', required=False, help='Write the JSON results to this file!')
+    parser.add_argument('--ramp', dest='ramp', default="1", help='Comma separated get_product_info rate factors!')
+    parser.add_argument('--slo-p95', dest='slo_p95', type=float, default=0.5,
+                        help='Highest acceptable get_product_info p95 latency, seconds!')
+    parser.add_argument('--max-error-rate', dest='max_error_rate', type=float, default=0.01,
+                        help='Highest acceptable error rate!')
+    parser.add_argument('--poll-interval', dest='poll_interval', type=float, default=30.0,
+                        help='Seconds between two status polls of an agent!')
+    args = parser.parse_args()
+
+    try:
+        rates = parse_rates(rate_options=args.rates)
+    except ValueError as err:
+        parser.error(str(err))
+
+    api_server = None
+    base_url = args.url
+    if not base_url:
+        api_server = InProcessAPI().start()
+        base_url = api_server.url
+
+    results = list()
+    sustained_step = None
+    try:
+        seeder = APILoadGenerator(base_url=base_url, rates=rates, concurrency=args.concurrency)
+        seeder.seed(no_of_tasks=args.seed)
+
+        for factor in [float(factor) for factor in args.ramp.split(",") if factor.strip()]:
+            step_rates = dict(rates, get_product_info=rates['get_product_info'] * factor)
+            generator = APILoadGenerator(base_url=base_url, rates=step_rates, concurrency=args.concurrency)
+            generator.task_ids.extend(seeder.task_ids)
+
+            step = {'factor': factor, 'rates': step_rates, 'endpoints': generator.run(duration=args.duration)}
+
+            polls = step['endpoints'].get('get_product_info', {})
+            errors = [endpoint['error_rate'] or 0 for endpoint in step['endpoints'].values()]
+            meets_latency = bool(polls.get('requests')) and polls['latency']['p95'] <= args.slo_p95
+            step['meets_objectives'] = meets_latency and max(errors) <= args.max_error_rate
+            step['polling_agents'] = int(polls.get('throughput', 0) * args.poll_interval)
+            results.append(step)
+
+            print("x{factor}: {rate} polls/sec, p95 {p95}s, error rate {error_rate} => {agents} agents{status}".format(
+                factor=factor, rate=polls.get('throughput'), p95=round(polls.get('latency', {}).get('p95') or 0, 4),
+                error_rate=polls.get('error_rate'), agents=step['polling_agents'],
+                status="" if step['meets_objectives'] else " (objectives missed)"
+            ))
+
+            if not step['meets_objectives']:
+                break
+            sustained_step = step
+    finally:
+        if api_server:
+            api_server.stop()
+
+    if sustained_step:
+        print("Sustained: {0} polling agents (one poll every {1}s)".format(
+            sustained_step['polling_agents'], args.poll_interval
+        ))
+
+    write_report(benchmark="api_load", results=results, output=args.output, options={
+        'url': args.url or "in-process",
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'seed': args.seed,
+        'rates': rates,
+        'slo_p95': args.slo_p95,
+        'max_error_rate': args.max_error_rate,
+        'poll_interval': args.poll_interval,
+        'sustained_polling_agents': sustained_step['polling_agents'] if sustained_step else 0
+    })
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,441 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Fake Bamboo server:
+A self-contained HTTP stand-in for the Bamboo endpoints used by 'bamboo_api.BambooAPI', with configurable latency,
+failure rate, build duration and number of build agents.
+
+Endpoints:
+    POST /rest/api/latest/queue/<plan_key>.json                     trigger a build
+    GET  /rest/api/latest/queue.json                                build queue
+    GET  /rest/api/latest/result/<build_result_key>.json            build result
+    GET  /rest/api/latest/plan/<plan_key>.json                      plan details
+    POST /build/admin/stopPlan.action?planResultKey=<key>           stop a build
+    GET  /browse/<key>/artifact/<job>/<artifact>/                   artifact directory listing
+    GET  /browse/<key>/artifact/<job>/<artifact>/<file>             artifact file
+
+Usage from code:
+    server = FakeBambooServer(build_duration=2.0, latency=0.01).start()
+    api = BambooAPI(bamboo_server=server.server_name, url_scheme='http', artifacts_domain='')
+    ...
+    server.stop()
+"""
+
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeBuild(object):
+    """A build of the fake Bamboo server."""
+
+    __slots__ = ('plan_key', 'build_result_key', 'queued_time', 'start_time', 'duration', 'successful', 'stopped')
+
+    def __init__(self, plan_key=None, build_result_key=None, duration=None, successful=True):
+        self.plan_key = plan_key
+        self.build_result_key = build_result_key
+        self.queued_time = time()
+        self.start_time = None
+        self.duration = duration
+        self.successful = successful
+        self.stopped = None
+
+    def finish_time(self):
+        """Get the time the build finished (or will finish), None if not started."""
+
+        if self.stopped is not None:
+            return self.stopped
+        if self.start_time is None:
+            return None
+        return self.start_time + self.duration
+
+    def is_finished(self, current_time=None):
+        """Check if the build has finished."""
+
+        finish_time = self.finish_time()
+        return finish_time is not None and finish_time <= current_time
+
+
+class FakeBambooState(object):
+    """State shared by all the requests handled by the fake server."""
+
+    def __init__(self, latency=0.0, failure_rate=0.0, build_duration=5.0, success_rate=1.0, agents=None,
+                 artifacts=None, seed=None):
+        """Create the server state.
+        :param latency: Delay added to every request, seconds, or a (min, max) range [float/tuple]
+        :param failure_rate: Fraction of the requests answered with HTTP 500 [float]
+        :param build_duration: Duration of a build once an agent picks it up, seconds [float]
+        :param success_rate: Fraction of the builds that succeed [float]
+        :param agents: Number of builds running at the same time, unlimited if None [int]
+        :param artifacts: {artifact name: {file name: size in bytes}} available for every build [dictionary]
+        :param seed: Seed of the random generator, for reproducible runs [int]
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.build_duration = build_duration
+        self.success_rate = success_rate
+        self.agents = agents
+        self.artifacts = artifacts if artifacts is not None else {'binaries': {'image.bin': 1024}}
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.builds = dict()
+        # Builds waiting for an agent (in the queued order) and builds running on the agents
+        self.pending = deque()
+        self.running = list()
+        self.build_numbers = dict()
+        self.requests = dict()
+
+    def count_request(self, endpoint=None):
+        """Count a request per endpoint."""
+
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def delay(self):
+        """Sleep the configured latency."""
+
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            with self.lock:
+                latency = self.random.uniform(*latency)
+        if latency:
+            sleep(latency)
+
+    def should_fail(self):
+        """Decide if the current request fails."""
+
+        if not self.failure_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def advance(self, current_time=None):
+        """Start the queued builds the free agents can pick up. Must be called with the lock held."""
+
+        if self.agents is not None:
+            self.running = [build for build in self.running if not build.is_finished(current_time)]
+
+        while self.pending and (self.agents is None or len(self.running) < self.agents):
+            build = self.pending.popleft()
+            if build.stopped is not None:
+                continue
+
+            build.start_time = current_time
+            if self.agents is not None:
+                self.running.append(build)
+
+    def trigger(self, plan_key=None):
+        """Queue a new build of a plan."""
+
+        with self.lock:
+            build_number = self.build_numbers.get(plan_key, 0) + 1
+            self.build_numbers[plan_key] = build_number
+
+            build_result_key = "{0}-{1}".format(plan_key, build_number)
+            self.builds[build_result_key] = FakeBuild(plan_key=plan_key, build_result_key=build_result_key,
+                                                      duration=self.build_duration,
+                                                      successful=self.random.random() < self.success_rate)
+            self.pending.append(self.builds[build_result_key])
+            self.advance(current_time=time())
+
+        return build_result_key
+
+    def queued_builds(self):
+        """Get the builds waiting for an agent."""
+
+        with self.lock:
+            self.advance(current_time=time())
+            return [build for build in self.pending if build.stopped is None]
+
+    def build(self, build_result_key=None):
+        """Get a build, advancing the simulated time."""
+
+        with self.lock:
+            self.advance(current_time=time())
+            return self.builds.get(build_result_key)
+
+    def stop(self, build_result_key=None):
+        """Stop a build."""
+
+        with self.lock:
+            build = self.builds.get(build_result_key)
+            if build and not build.is_finished(time()):
+                build.stopped = time()
+                build.successful = False
+            return build
+
+
+class FakeBambooHandler(BaseHTTPRequestHandler):
+    """Request handler of the fake Bamboo server."""
+
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are sent separately: on a kept-alive connection, Nagle's algorithm would hold the body
+    # until the client's delayed ACK (~40ms per request)
+    disable_nagle_algorithm = True
+
+    RESULT_RE = re.compile(r'^/rest/api/latest/result/(?P<key>[^/]+)\.json$')
+    PLAN_RE = re.compile(r'^/rest/api/latest/plan/(?P<key>[^/]+)\.json$')
+    TRIGGER_RE = re.compile(r'^/rest/api/latest/queue/(?P<key>[^/]+)\.json$')
+    ARTIFACT_RE = re.compile(r'^/browse/(?P<key>[^/]+)/artifact/(?P<job>[^/]+)/(?P<artifact>[^/]+)/(?P<file>[^/]*)$')
+
+    # Set on the handler class created for each server
+    state = None
+
+    def log_message(self, format, *args):
+        """Keep the output clean."""
+        pass
+
+    def __send(self, status_code=200, body=b"", content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    @staticmethod
+    def __iso_time(epoch_time=None):
+        if epoch_time is None:
+            return None
+        return datetime.fromtimestamp(epoch_time, tz=timezone.utc).isoformat(timespec='milliseconds')
+
+    def __handle(self):
+        parsed_url = urlparse(self.path)
+        url_path = parsed_url.path
+
+        # Drain the request body, if any
+        content_length = int(self.headers.get('Content-Length') or 0)
+        if content_length:
+            self.rfile.read(content_length)
+
+        endpoint = self.__endpoint(url_path)
+        self.state.count_request(endpoint)
+        self.state.delay()
+
+        if self.state.should_fail():
+            return self.__send(500, {'message': "Simulated failure"})
+
+        if endpoint == 'trigger' and self.command == 'POST':
+            plan_key = self.TRIGGER_RE.match(url_path).group('key')
+            build_result_key = self.state.trigger(plan_key=plan_key)
+            return self.__send(200, {
+                'planKey': plan_key,
+                'buildNumber': int(build_result_key.rsplit("-", 1)[-1]),
+                'buildResultKey': build_result_key,
+                'triggerReason': "Manual build",
+                'link': {
+                    'href': "http://{0}/rest/api/latest/result/{1}".format(
+                        self.headers.get('Host'), build_result_key
+                    ),
+                    'rel': "self"
+                }
+            })
+
+        if endpoint == 'queue':
+            queued_builds = self.state.queued_builds()
+            return self.__send(200, {
+                'queuedBuilds': {
+                    'size': len(queued_builds),
+                    'queuedBuild': [
+                        {'planKey': build.plan_key, 'buildResultKey': build.build_result_key}
+                        for build in queued_builds
+                    ]
+                }
+            })
+
+        if endpoint == 'result':
+            return self.__result(self.RESULT_RE.match(url_path).group('key'))
+
+        if endpoint == 'plan':
+            plan_key = self.PLAN_RE.match(url_path).group('key')
+            return self.__send(200, {'key': plan_key, 'enabled': True, 'isBuilding': False, 'isActive': False})
+
+        if endpoint == 'stop' and self.command == 'POST':
+            build_result_key = parse_qs(parsed_url.query).get('planResultKey', [None])[0]
+            if not self.state.stop(build_result_key=build_result_key):
+                return self.__send(404, {'message': "Build not found"})
+            return self.__send(200, {})
+
+        if endpoint == 'artifact':
+            return self.__artifact(self.ARTIFACT_RE.match(url_path))
+
+        return self.__send(404, {'message': "Not found"})
+
+    def __endpoint(self, url_path=None):
+        if self.TRIGGER_RE.match(url_path):
+            return 'trigger'
+        if url_path == '/rest/api/latest/queue.json':
+            return 'queue'
+        if self.RESULT_RE.match(url_path):
+            return 'result'
+        if self.PLAN_RE.match(url_path):
+            return 'plan'
+        if url_path == '/build/admin/stopPlan.action':
+            return 'stop'
+        if self.ARTIFACT_RE.match(url_path):
+            return 'artifact'
+        return 'unknown'
+
+    def __result(self, build_result_key=None):
+        build = self.state.build(build_result_key=build_result_key)
+        if not build:
+            return self.__send(404, {'message': "Result {0} not found".format(build_result_key)})
+
+        current_time = time()
+        if build.stopped is not None:
+            life_cycle, build_state, finished = "NotBuilt", "Unknown", True
+        elif build.start_time is None:
+            life_cycle, build_state, finished = "Queued", "Unknown", False
+        elif not build.is_finished(current_time):
+            life_cycle, build_state, finished = "InProgress", "Unknown", False
+        else:
+            life_cycle, build_state, finished = "Finished", "Successful" if build.successful else "Failed", True
+
+        return self.__send(200, {
+            'key': build_result_key,
+            'planResultKey': {'key': build_result_key},
+            'lifeCycleState': life_cycle,
+            'buildState': build_state,
+            'state': build_state,
+            'finished': finished,
+            'successful': finished and build.successful and build.stopped is None,
+            'buildStartedTime': self.__iso_time(build.start_time),
+            'buildCompletedTime': self.__iso_time(build.finish_time()) if finished else None
+        })
+
+    def __artifact(self, match=None):
+        build = self.state.build(build_result_key=match.group('key'))
+        files = self.state.artifacts.get(match.group('artifact'))
+        if not build or files is None:
+            return self.__send(404, "<html><body><a href='/'>Site homepage</a></body></html>", "text/html")
+
+        file_name = match.group('file')
+        if not file_name:
+            links = "".join("<a href='{0}'>{0}</a>".format(name) for name in sorted(files))
+            return self.__send(200, "<html><body>{0}</body></html>".format(links), "text/html")
+
+        if file_name not in files:
+            return self.__send(404, "<html><body><a href='/'>Site homepage</a></body></html>", "text/html")
+
+        # Deterministic content, so the same artifact always has the same hash
+        pattern = "{0}/{1}\n".format(match.group('artifact'), file_name).encode()
+        size = files[file_name]
+        body = (pattern * (size // len(pattern) + 1))[:size]
+        return self.__send(200, body, "application/octet-stream")
+
+    def do_GET(self):
+        """Handle GET requests."""
+        self.__handle()
+
+    def do_POST(self):
+        """Handle POST requests."""
+        self.__handle()
+
+
+class FakeBambooServer(object):
+    """Fake Bamboo HTTP server running on a background thread."""
+
+    def __init__(self, host="127.0.0.1", port=0, **state_options):
+        """Create the fake server.
+        :param host: Address to listen on [string]
+        :param port: Port to listen on, 0 picks a free one [int]
+        :param state_options: Options of the simulation (see FakeBambooState)
+        """
+        self.__state = FakeBambooState(**state_options)
+
+        handler_class = type("BoundFakeBambooHandler", (FakeBambooHandler,), {'state': self.__state})
+        self.__http_server = ThreadingHTTPServer((host, port), handler_class)
+        self.__http_server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def state(self):
+        """Get the simulation state (builds, request counters, options)."""
+        return self.__state
+
+    @property
+    def server_name(self):
+        """Get the '<host>:<port>' to use as Bamboo server name."""
+        host, port = self.__http_server.server_address[:2]
+        return "{0}:{1}".format(host, port)
+
+    def request_counts(self):
+        """Get the number of requests served, per endpoint."""
+
+        with self.__state.lock:
+            return dict(self.__state.requests)
+
+    def start(self):
+        """Start serving on a background thread."""
+
+        self.__thread = threading.Thread(target=self.__http_server.serve_forever, name="fake-bamboo", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+
+        self.__http_server.shutdown()
+        self.__http_server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Run a fake Bamboo server.")
+    parser.add_argument('--host', dest='host', default="127.0.0.1", help='Address to listen on!')
+    parser.add_argument('--port', dest='port', type=int, default=8085, help='Port to listen on!')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0, help='Delay per request, seconds!')
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float, default=0.0,
+                        help='Fraction of the requests failing with HTTP 500!')
+    parser.add_argument('--build-duration', dest='build_duration', type=float, default=5.0,
+                        help='Duration of a build, seconds!')
+    parser.add_argument('--success-rate', dest='success_rate', type=float, default=1.0,
+                        help='Fraction of the builds that succeed!')
+    parser.add_argument('--agents', dest='agents', type=int, default=None, help='Builds running at the same time!')
+    args = parser.parse_args()
+
+    server = FakeBambooServer(host=args.host, port=args.port, latency=args.latency, failure_rate=args.failure_rate,
+                              build_duration=args.build_duration, success_rate=args.success_rate,
+                              agents=args.agents)
+    print("Fake Bamboo server listening on {0}".format(server.server_name))
+
+    try:
+        server.start()
+        while True:
+            sleep(60)
+            print(json.dumps(server.request_counts()))
+    except KeyboardInterrupt:
+        server.stop()
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
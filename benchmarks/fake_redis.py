@@ -0,0 +1,403 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Fake Redis:
+An in-process stand-in for the subset of the 'redis.StrictRedis' API used by the service, counting every command so
+benchmarks can report Redis operations per task.
+
+Several clients (e.g.: one decoding responses, one returning bytes) can share the same FakeRedisServer.
+"""
+
+
+import fnmatch
+import queue
+import threading
+
+from time import time
+
+
+class FakeRedisServer(object):
+    """Data and counters shared by the fake clients."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = dict()
+        self.expires = dict()
+        self.commands = dict()
+        self.round_trips = 0
+
+        # {cursor: (snapshot of the keys, position)}
+        self.cursors = dict()
+        self.next_cursor = 1
+
+        # {channel: [message queues of the subscribers]}
+        self.subscribers = dict()
+
+    def count(self, command=None, round_trip=True):
+        """Count a command."""
+
+        with self.lock:
+            if command:
+                self.commands[command] = self.commands.get(command, 0) + 1
+            if round_trip:
+                self.round_trips += 1
+
+    def total_commands(self):
+        """Get the number of commands executed."""
+
+        with self.lock:
+            return sum(self.commands.values())
+
+    def reset_counters(self):
+        """Reset the command counters."""
+
+        with self.lock:
+            self.commands.clear()
+            self.round_trips = 0
+
+
+class FakeRedis(object):
+    """Fake Redis client."""
+
+    def __init__(self, server=None, decode_responses=True):
+        """Create the fake client.
+        :param server: Server holding the data, a new one if not supplied [FakeRedisServer]
+        :param decode_responses: Return strings instead of bytes [boolean]
+        """
+        self.server = server or FakeRedisServer()
+        self.decode_responses = decode_responses
+        self._round_trip = True
+
+    # ------------------------------------------------------------------------------------------------------------ #
+    @staticmethod
+    def __encode(value):
+        if isinstance(value, bytes):
+            return value
+        if isinstance(value, float):
+            return repr(value).encode()
+        return str(value).encode()
+
+    def __decode(self, value):
+        if value is None or not self.decode_responses:
+            return value
+        return value.decode()
+
+    def __count(self, command):
+        self.server.count(command=command, round_trip=self._round_trip)
+
+    def __alive(self, name):
+        # Lazy expiry; must be called with the lock held
+        expire_at = self.server.expires.get(name)
+        if expire_at is not None and expire_at <= time():
+            self.server.data.pop(name, None)
+            self.server.expires.pop(name, None)
+        return name in self.server.data
+
+    def __key(self, name):
+        return name.decode() if isinstance(name, bytes) else str(name)
+
+    # ------------------------------------------------------------------------------------------------------------ #
+    def ping(self):
+        """PING."""
+        self.__count('PING')
+        return True
+
+    def get(self, name):
+        """GET."""
+
+        self.__count('GET')
+        name = self.__key(name)
+        with self.server.lock:
+            if not self.__alive(name):
+                return None
+            return self.__decode(self.server.data[name])
+
+    def mget(self, keys, *args):
+        """MGET."""
+
+        self.__count('MGET')
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys.extend(args)
+        with self.server.lock:
+            return [self.__decode(self.server.data[self.__key(key)]) if self.__alive(self.__key(key)) else None
+                    for key in keys]
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        """SET."""
+
+        self.__count('SET')
+        return self.__set(name, value, ex=ex, px=px, nx=nx, xx=xx)
+
+    def __set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        name = self.__key(name)
+        with self.server.lock:
+            exists = self.__alive(name)
+            if (nx and exists) or (xx and not exists):
+                return None
+
+            self.server.data[name] = self.__encode(value)
+            self.server.expires.pop(name, None)
+            if ex:
+                self.server.expires[name] = time() + ex
+            elif px:
+                self.server.expires[name] = time() + px / 1000.0
+        return True
+
+    def setex(self, name, time_value, value):
+        """SETEX."""
+
+        self.__count('SETEX')
+        return self.__set(name, value, ex=time_value)
+
+    def delete(self, *names):
+        """DEL."""
+
+        self.__count('DEL')
+        deleted = 0
+        with self.server.lock:
+            for name in names:
+                name = self.__key(name)
+                if self.__alive(name):
+                    del self.server.data[name]
+                    self.server.expires.pop(name, None)
+                    deleted += 1
+        return deleted
+
+    def exists(self, *names):
+        """EXISTS."""
+
+        self.__count('EXISTS')
+        with self.server.lock:
+            return sum(1 for name in names if self.__alive(self.__key(name)))
+
+    def expire(self, name, time_value):
+        """EXPIRE."""
+
+        self.__count('EXPIRE')
+        name = self.__key(name)
+        with self.server.lock:
+            if not self.__alive(name):
+                return False
+            self.server.expires[name] = time() + time_value
+        return True
+
+    def incr(self, name, amount=1):
+        """INCRBY."""
+
+        self.__count('INCRBY')
+        name = self.__key(name)
+        with self.server.lock:
+            value = int(self.server.data[name]) + amount if self.__alive(name) else amount
+            self.server.data[name] = self.__encode(value)
+        return value
+
+    incrby = incr
+
+    def scan(self, cursor=0, match=None, count=None):
+        """SCAN: walks a snapshot of the keys taken by the first call, skipping the keys deleted meanwhile."""
+
+        self.__count('SCAN')
+        count = count or 10
+        with self.server.lock:
+            if cursor:
+                names, position = self.server.cursors.pop(cursor, ([], 0))
+            else:
+                names, position = sorted(self.server.data), 0
+
+            names_page = [name for name in names[position:position + count] if self.__alive(name)]
+            next_cursor = 0
+            if position + count < len(names):
+                next_cursor = self.server.next_cursor
+                self.server.next_cursor += 1
+                self.server.cursors[next_cursor] = (names, position + count)
+
+        if match:
+            names_page = [name for name in names_page if fnmatch.fnmatchcase(name, match)]
+
+        return next_cursor, [name if self.decode_responses else name.encode() for name in names_page]
+
+    def scan_iter(self, match=None, count=None):
+        """Iterate over the keys using SCAN."""
+
+        cursor = None
+        while cursor != 0:
+            cursor, names = self.scan(cursor=cursor or 0, match=match, count=count)
+            for name in names:
+                yield name
+
+    def dbsize(self):
+        """DBSIZE."""
+
+        self.__count('DBSIZE')
+        with self.server.lock:
+            return sum(1 for name in list(self.server.data) if self.__alive(name))
+
+    def flushdb(self):
+        """FLUSHDB."""
+
+        self.__count('FLUSHDB')
+        with self.server.lock:
+            self.server.data.clear()
+            self.server.expires.clear()
+        return True
+
+    def __list(self, name, create=False):
+        name = self.__key(name)
+        if not self.__alive(name):
+            if not create:
+                return []
+            self.server.data[name] = []
+        return self.server.data[name]
+
+    def lpush(self, name, *values):
+        """LPUSH."""
+
+        self.__count('LPUSH')
+        with self.server.lock:
+            values_list = self.__list(name, create=True)
+            for value in values:
+                values_list.insert(0, self.__encode(value))
+            return len(values_list)
+
+    def rpush(self, name, *values):
+        """RPUSH."""
+
+        self.__count('RPUSH')
+        with self.server.lock:
+            values_list = self.__list(name, create=True)
+            values_list.extend(self.__encode(value) for value in values)
+            return len(values_list)
+
+    def ltrim(self, name, start, end):
+        """LTRIM."""
+
+        self.__count('LTRIM')
+        with self.server.lock:
+            values_list = self.__list(name)
+            values_list[:] = values_list[start:(None if end == -1 else end + 1)]
+        return True
+
+    def lrange(self, name, start, end):
+        """LRANGE."""
+
+        self.__count('LRANGE')
+        with self.server.lock:
+            values_list = self.__list(name)
+            return [self.__decode(value) for value in values_list[start:(None if end == -1 else end + 1)]]
+
+    def llen(self, name):
+        """LLEN."""
+
+        self.__count('LLEN')
+        with self.server.lock:
+            return len(self.__list(name))
+
+    def sadd(self, name, *values):
+        """SADD."""
+
+        self.__count('SADD')
+        name = self.__key(name)
+        with self.server.lock:
+            if not self.__alive(name):
+                self.server.data[name] = set()
+            before = len(self.server.data[name])
+            self.server.data[name].update(self.__encode(value) for value in values)
+            return len(self.server.data[name]) - before
+
+    def smembers(self, name):
+        """SMEMBERS."""
+
+        self.__count('SMEMBERS')
+        name = self.__key(name)
+        with self.server.lock:
+            if not self.__alive(name):
+                return set()
+            return {self.__decode(value) for value in self.server.data[name]}
+
+    def publish(self, channel, message):
+        """PUBLISH."""
+
+        self.__count('PUBLISH')
+        channel = self.__key(channel)
+        with self.server.lock:
+            subscribers = list(self.server.subscribers.get(channel, ()))
+        for messages in subscribers:
+            messages.put({'type': 'message', 'pattern': None, 'channel': self.__decode(channel.encode()),
+                          'data': self.__decode(self.__encode(message))})
+        return len(subscribers)
+
+    def pubsub(self):
+        """Get a pub/sub object."""
+        return FakePubSub(client=self)
+
+    def pipeline(self, transaction=True):
+        """Get a pipeline: commands are queued and sent in one round trip."""
+        return FakePipeline(client=FakeRedis(server=self.server, decode_responses=self.decode_responses))
+
+
+class FakePubSub(object):
+    """Fake Redis pub/sub object: the messages of the subscribed channels are queued until read."""
+
+    def __init__(self, client=None):
+        self.__client = client
+        self.__messages = queue.Queue()
+        self.__channels = list()
+
+    def subscribe(self, *channels):
+        """SUBSCRIBE."""
+
+        with self.__client.server.lock:
+            for channel in channels:
+                channel = channel.decode() if isinstance(channel, bytes) else str(channel)
+                self.__client.server.subscribers.setdefault(channel, []).append(self.__messages)
+                self.__channels.append(channel)
+                self.__messages.put({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                                     'data': len(self.__channels)})
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        """Get the next message, None if none arrives within the timeout."""
+
+        try:
+            return self.__messages.get(timeout=timeout) if timeout else self.__messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        """Unsubscribe from every channel."""
+
+        with self.__client.server.lock:
+            for channel in self.__channels:
+                self.__client.server.subscribers.get(channel, []).remove(self.__messages)
+        self.__channels = list()
+
+
+class FakePipeline(object):
+    """Fake Redis pipeline."""
+
+    def __init__(self, client=None):
+        self.__client = client
+        self.__client._round_trip = False
+        self.__commands = list()
+
+    def __getattr__(self, command_name):
+        command = getattr(self.__client, command_name)
+
+        def queue_command(*args, **kwargs):
+            self.__commands.append((command, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self):
+        """Run the queued commands."""
+
+        self.__client.server.count(round_trip=True)
+
+        commands, self.__commands = self.__commands, list()
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__commands = list()
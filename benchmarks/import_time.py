@@ -0,0 +1,98 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Import-time benchmark:
+Imports each module in fresh interpreters and reports the import time (median, min, max over the runs), plus the
+slowest imports it pulls in (from 'python -X importtime').
+
+Examples:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py -m bamboo_api -r 20 -o import_time.json
+"""
+
+
+import argparse
+import subprocess
+import sys
+
+from os import path
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from benchmarks.report import REPO_DIR, write_report
+from utils import StatsUtils
+
+
+MODULES = ('config.default', 'bamboo_api', 'tasks_processing_unit', 'app')
+
+TIMED_IMPORT = "import time; start_time = time.perf_counter(); import {module}; print(time.perf_counter() - start_time)"
+
+
+def import_time(module=None):
+    """Import a module in a fresh interpreter.
+    :return: Seconds [float]
+    """
+
+    output = subprocess.check_output([sys.executable, "-c", TIMED_IMPORT.format(module=module)], cwd=REPO_DIR)
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def slowest_imports(module=None, limit=10):
+    """Get the imports pulled in by a module with the highest cumulative time.
+    :return: [{module, cumulative_ms, self_ms}] [list]
+    """
+
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {0}".format(module)], cwd=REPO_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True).stderr.decode()
+
+    imports = list()
+    for line in output.splitlines():
+        # E.g: import time:       980 |      91196 |         werkzeug.local
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[0].startswith("import time:") or not fields[1].strip().isdigit():
+            continue
+
+        imports.append({
+            'module': fields[2].strip(),
+            'cumulative_ms': round(int(fields[1]) / 1000.0, 2),
+            'self_ms': round(int(fields[0].split(":")[1]) / 1000.0, 2)
+        })
+
+    return sorted(imports, key=lambda imported: -imported['cumulative_ms'])[:limit]
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the service modules.")
+    parser.add_argument('-m', dest='modules', action='append', default=[], help='Module to import (repeatable)!')
+    parser.add_argument('-r', dest='repeat', type=int, default=10, help='Fresh interpreters per module!')
+    parser.add_argument('-o', dest='output', required=False, help='Write the JSON results to this file!')
+    args = parser.parse_args()
+
+    results = list()
+    for module in args.modules or MODULES:
+        times = [import_time(module=module) for _ in range(args.repeat)]
+        summary = StatsUtils.summary(times)
+        result = {
+            'module': module,
+            'median_ms': round(summary['p50'] * 1000, 2),
+            'min_ms': round(summary['min'] * 1000, 2),
+            'max_ms': round(summary['max'] * 1000, 2),
+            'slowest_imports': slowest_imports(module=module)
+        }
+        results.append(result)
+        print("{module:25} median {median_ms:8.2f}ms  min {min_ms:8.2f}ms  max {max_ms:8.2f}ms".format(**result))
+
+    if args.output:
+        write_report(benchmark="import_time", results=results, output=args.output, options={'repeat': args.repeat})
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmarks of the hot paths:
+    - 'TasksProcessingUnit.process_task' for each task state (fake Bamboo server and Redis stand-in)
+    - 'ShaUtils.is_sha512', 'ResponseUtils.return_json', 'BambooAPI.compound_url'
+    - 'RateLimiter.acquire' when a token is available (the cost added to every Bamboo request)
+    - JSON and compact encoding ('TaskCodec') round-trips of realistic task payloads
+
+Every benchmark reports the best time per call over several repeats. With '--compare' the results are checked
+against a previous report and the run fails if a benchmark got slower than the tolerance.
+
+Examples:
+    python benchmarks/micro.py -o micro_baseline.json
+    python benchmarks/micro.py -k json -k sha512
+    python benchmarks/micro.py --compare micro_baseline.json --tolerance 0.2
+"""
+
+
+import argparse
+import sys
+import tempfile
+import timeit
+
+from json import dumps, loads
+from os import path
+from time import time
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from benchmarks.fake_bamboo import FakeBambooServer
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.report import write_report
+from rate_limiter import RateLimiter
+from task_codec import TaskCodec
+
+
+TASK_ID = "a" * 128
+
+
+def task_payload(bamboo_server=None, status="NEW_REQUEST", **values):
+    """Get a realistic task, as stored in Redis by '/create_task' and updated by the worker."""
+
+    task_values = {
+        'bamboo_artifact_names': ["binaries", "logs"],
+        'bamboo_artifact_on_stage': "JOB1",
+        'bamboo_main_plan_url': "http://{0}/browse/PROJ-PLAN".format(bamboo_server),
+        'bamboo_server': bamboo_server,
+        'bamboo_state': "NEW",
+        'bamboo_wait_for_plan_to_finish': "3600",
+        'request_options': {'branch': "master", 'variant': "release", 'target': "arm64"},
+        'product_name': "product",
+        'status': status,
+        'start_build_retries': 0,
+        'stop_build_retries': 0,
+        'insert_time': time()
+    }
+    task_values.update(values)
+
+    return task_values
+
+
+def finished_payload(bamboo_server=None, **values):
+    """Get a task finished in Bamboo, with its timeline and artifacts."""
+
+    now = time()
+    finished_values = {
+        'bamboo_state': "Finished",
+        'bamboo_build_key_api': "http://{0}/rest/api/latest/result/PROJ-PLAN-1".format(bamboo_server),
+        'bamboo_build_result_key': "PROJ-PLAN-1",
+        'bamboo_build_url': "http://{0}/browse/PROJ-PLAN-1".format(bamboo_server),
+        'build_start_time': now - 300,
+        'build_stop_time': now,
+        'artifacts': ["http://{0}/browse/PROJ-PLAN-1/artifact/JOB1/binaries/image_{1}.bin".format(bamboo_server, index)
+                      for index in range(10)],
+        'timeline': {'inserted': now - 310, 'trigger_sent': now - 305, 'triggered': now - 300, 'started': now - 290,
+                     'bamboo_finished': now - 5, 'finish_detected': now}
+    }
+    finished_values.update(values)
+
+    return task_payload(bamboo_server=bamboo_server, status="FINISHED", **finished_values)
+
+
+class MicroBenchmarks(object):
+    """The micro-benchmarks: {name: (callable, calls per repeat)}."""
+
+    def __init__(self, bamboo_server=None, logs_dir=None):
+        """Prepare the benchmarks.
+        :param bamboo_server: Fake Bamboo server [FakeBambooServer]
+        :param logs_dir: Directory for the logs of the worker [string]
+        """
+
+        import tasks_processing_unit
+        from app import APP
+        from app.utils import Response, ResponseUtils, ShaUtils
+
+        redis_client = FakeRedis()
+        tasks_processing_unit.RedisCommunication.CLIENT = redis_client
+        tasks_processing_unit.RedisCommunication.RAW_CLIENT = FakeRedis(server=redis_client.server,
+                                                                        decode_responses=False)
+        task_pu = tasks_processing_unit.TasksProcessingUnit(bamboo_server=bamboo_server.server_name,
+                                                            path_to_parent_dir=logs_dir, url_scheme='http',
+                                                            artifacts_domain='',
+                                                            rate_limiter=False)
+        server_name = bamboo_server.server_name
+
+        # A running build and a finished one
+        running_key = task_pu.trigger_bamboo_plan(values={
+            'bamboo_server': server_name, 'bamboo_plan_key': "PROJ-RUN", 'bamboo_plan_variables': {}
+        })['content']['build_result_key']
+        finished_key = task_pu.trigger_bamboo_plan(values={
+            'bamboo_server': server_name, 'bamboo_plan_key': "PROJ-DONE", 'bamboo_plan_variables': {}
+        })['content']['build_result_key']
+        bamboo_server.state.builds[finished_key].duration = 0
+
+        in_progress = dict(task_payload(bamboo_server=server_name, status="IN_PROGRESS", build_start_time=time()))
+        tasks = {
+            'new_request': task_payload(bamboo_server=server_name),
+            'in_progress_running': dict(in_progress, bamboo_build_result_key=running_key),
+            'in_progress_finished': dict(in_progress, bamboo_build_result_key=finished_key),
+            'finished_crawl_artifacts': finished_payload(bamboo_server=server_name, post_operation=True,
+                                                         bamboo_build_result_key=finished_key),
+            'finished_done': finished_payload(bamboo_server=server_name, post_operation=False),
+            'finished_erase': finished_payload(bamboo_server=server_name, post_operation=False,
+                                               build_stop_time=time() - 3600)
+        }
+
+        self.benchmarks = dict()
+        for state, task_values in tasks.items():
+            serialized_task = TaskCodec.encode(task_values)
+            # Network bound: fewer calls
+            number = 1000 if state in ('finished_done', 'finished_erase') else 100
+            self.benchmarks["process_task.{0}".format(state)] = (
+                lambda serialized_task=serialized_task: task_pu.process_task(value_to_process=serialized_task), number
+            )
+
+        self.benchmarks['is_sha512.valid'] = (lambda: ShaUtils.is_sha512(maybe_sha=TASK_ID), 100000)
+        self.benchmarks['is_sha512.invalid'] = (lambda: ShaUtils.is_sha512(maybe_sha="not-a-sha"), 100000)
+
+        return_data = {"dataBody": {"status": "FINISHED", "timeline": tasks['finished_done']['timeline'],
+                                    "artifactsUrl": tasks['finished_done']['artifacts']}, "error": False}
+        json_view = ResponseUtils.return_json(lambda: Response(return_code=200, return_data=return_data))
+        app_context = APP.app_context()
+        app_context.push()
+        self.benchmarks['return_json'] = (json_view, 10000)
+
+        task_pu.plan_key = "PROJ-PLAN-1"
+        for query_type in ('plan_status', 'plan_info', 'stop_plan'):
+            self.benchmarks["compound_url.{0}".format(query_type)] = (
+                lambda query_type=query_type: task_pu.compound_url(query_type), 100000
+            )
+
+        # Never waits: measures the bookkeeping only
+        rate_limiter = RateLimiter(rates={'status': (1e9, 1e9)})
+        self.benchmarks['rate_limiter.acquire'] = (
+            lambda: rate_limiter.acquire(bamboo_server=server_name, operation='plan_status'), 100000
+        )
+
+        for state in ('new_request', 'finished_crawl_artifacts'):
+            serialized_task = dumps(tasks[state])
+            self.benchmarks["json.loads.{0}".format(state)] = (lambda data=serialized_task: loads(data), 100000)
+            self.benchmarks["json.dumps.{0}".format(state)] = (lambda data=tasks[state]: dumps(data), 100000)
+
+            encoded_task = TaskCodec.encode(tasks[state], encoding='compact')
+            self.benchmarks["task_codec.decode.{0}".format(state)] = (
+                lambda data=encoded_task: TaskCodec.decode(data), 100000
+            )
+            self.benchmarks["task_codec.encode.{0}".format(state)] = (
+                lambda data=tasks[state]: TaskCodec.encode(data, encoding='compact'), 100000
+            )
+
+    def run(self, name_filters=None, repeat=5, scale=1.0):
+        """Run the benchmarks.
+        :param name_filters: Only run the benchmarks whose name contains one of these [list]
+        :param repeat: Number of repeats, the best one is kept [int]
+        :param scale: Factor applied to the number of calls per repeat [float]
+        :return: {name: {calls, best_usec, ops_per_sec}} [dictionary]
+        """
+
+        results = dict()
+        for name, (function, number) in sorted(self.benchmarks.items()):
+            if name_filters and not any(name_filter in name for name_filter in name_filters):
+                continue
+
+            number = max(int(number * scale), 1)
+            # Warm up: caches, connections
+            function()
+            best_time = min(timeit.Timer(function).repeat(repeat=repeat, number=number)) / number
+            results[name] = {
+                'calls': number,
+                'best_usec': round(best_time * 1e6, 3),
+                'ops_per_sec': round(1.0 / best_time, 1) if best_time else None
+            }
+
+        return results
+
+
+def compare(results=None, baseline_path=None, tolerance=0.2):
+    """Compare the results with a previous report.
+    :return: Names of the benchmarks slower than the baseline by more than the tolerance [list]
+    """
+
+    with open(baseline_path) as file_handle:
+        baseline_results = loads(file_handle.read()).get('results', [{}])[0]
+
+    regressions = list()
+    for name, result in sorted(results.items()):
+        baseline = baseline_results.get(name)
+        if not baseline:
+            continue
+
+        ratio = result['best_usec'] / baseline['best_usec'] if baseline['best_usec'] else 1.0
+        flag = ""
+        if ratio > 1.0 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{0:40} {1:12.3f}us -> {2:12.3f}us  x{3:.2f}{4}".format(
+            name, baseline['best_usec'], result['best_usec'], ratio, flag
+        ))
+
+    return regressions
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the hot paths.")
+    parser.add_argument('-k', dest='filters', action='append', default=[], help='Only run the matching benchmarks!')
+    parser.add_argument('-r', dest='repeat', type=int, default=5, help='Repeats per benchmark (best one is kept)!')
+    parser.add_argument('-s', dest='scale', type=float, default=1.0, help='Factor of the calls per repeat!')
+    parser.add_argument('-o', dest='output', required=False, help='Write the JSON results to this file!')
+    parser.add_argument('--compare', dest='compare', required=False, help='Previous report to compare with!')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                        help='Accepted slowdown vs the previous report (0.2 = 20%%)!')
+    args = parser.parse_args()
+
+    with FakeBambooServer(build_duration=3600.0) as bamboo_server, tempfile.TemporaryDirectory() as logs_dir:
+        results = MicroBenchmarks(bamboo_server=bamboo_server, logs_dir=logs_dir).run(
+            name_filters=args.filters, repeat=args.repeat, scale=args.scale
+        )
+
+    for name, result in results.items():
+        print("{0:40} {1:12.3f}us {2:14.1f} ops/sec".format(name, result['best_usec'], result['ops_per_sec']))
+
+    if args.output:
+        write_report(benchmark="micro", results=[results], output=args.output,
+                     options={'repeat': args.repeat, 'scale': args.scale, 'filters': args.filters})
+
+    if args.compare:
+        regressions = compare(results=results, baseline_path=args.compare, tolerance=args.tolerance)
+        if regressions:
+            print("Slower than '{0}': {1}".format(args.compare, ", ".join(regressions)))
+            sys.exit(1)
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Machine-readable reports of the benchmarks, tagged with the commit so runs can be compared across commits."""
+
+
+import subprocess
+
+from datetime import datetime
+from json import dumps
+from os import path
+from platform import python_version
+
+
+REPO_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def git_commit():
+    """Get the current commit of the repository, if any."""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(benchmark=None, options=None, results=None, output=None):
+    """Write the report of a benchmark as JSON.
+    :param benchmark: Name of the benchmark [string]
+    :param options: Options of the run [dictionary]
+    :param results: Results of the run [list]
+    :param output: Path of the file to write, the report is printed if missing [string]
+    :return: The report [dictionary]
+    """
+
+    report = {
+        'benchmark': benchmark,
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(),
+        'python': python_version(),
+        'options': options or {},
+        'results': results or []
+    }
+
+    if output:
+        with open(output, 'w') as file_handle:
+            file_handle.write(dumps(report, indent=4))
+    else:
+        print(dumps(report, indent=4))
+
+    return report
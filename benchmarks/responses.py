@@ -0,0 +1,157 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""API responses benchmark:
+Calls the views through the Flask test client (no network, Redis stand-in from 'benchmarks.fake_redis') and reports
+the responses per second of each endpoint, per JSON backend ('json' and, when installed, 'orjson'). The backends
+take turns over several repeats and the best repeat is kept.
+
+Examples:
+    python benchmarks/responses.py
+    python benchmarks/responses.py -n 5000 -t 2000 -r 5 -o responses.json
+"""
+
+
+import argparse
+import sys
+
+from os import path
+from time import perf_counter
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.micro import finished_payload, task_payload
+from benchmarks.report import write_report
+from json_utils import JsonUtils, orjson
+from task_cache import TaskStatusCache
+from task_record import TaskRecord
+
+
+RUNNING_ID = "a" * 128
+FINISHED_ID = "b" * 128
+
+
+class ResponsesBenchmark(object):
+    """Responses per second of the API endpoints."""
+
+    def __init__(self, no_of_requests=2000, dump_tasks=1000):
+        """Prepare the APP and the tasks.
+        :param no_of_requests: Requests per endpoint [int]
+        :param dump_tasks: Tasks in the DB for '/dump_db_content' [int]
+        """
+
+        from app import APP
+
+        self.__dump_tasks = dump_tasks
+
+        self.redis_client = FakeRedis()
+        APP.config['REDIS'] = self.redis_client
+        APP.config['REDIS_RAW'] = FakeRedis(server=self.redis_client.server, decode_responses=False)
+        self.task_cache = APP.config['TASK_CACHE'] = TaskStatusCache(redis_client=self.redis_client)
+        APP.config['BAMBOO_SERVER'] = "bamboo.local"
+        self.client = APP.test_client()
+
+        self.requests = {
+            'get_product_info.running': (
+                lambda: self.client.get("/get_product_info/product/{0}".format(RUNNING_ID)), no_of_requests
+            ),
+            # A poller sending the ETag of its last response, while the task is not updated
+            'get_product_info.not_modified': (
+                lambda: self.client.get("/get_product_info/product/{0}".format(RUNNING_ID),
+                                        headers={'If-None-Match': '"r1"'}), no_of_requests
+            ),
+            'get_product_info.finished': (
+                lambda: self.client.get("/get_product_info/product/{0}".format(FINISHED_ID)), no_of_requests
+            ),
+            'create_task': (
+                lambda: self.client.post("/create_task/product/build",
+                                         data={'planUrl': "http://bamboo.local/browse/P-P"}), no_of_requests
+            ),
+            # Every request reads the whole DB
+            'dump_db_content': (lambda: self.client.post("/dump_db_content"), max(no_of_requests // 100, 3)),
+            'dump_db_content.filtered': (
+                lambda: self.client.post("/dump_db_content", data={'status': "FINISHED"}),
+                max(no_of_requests // 100, 3)
+            )
+        }
+
+    def seed(self):
+        """Fill the DB: a running task, a finished task and the tasks for the dumps."""
+
+        self.redis_client.flushdb()
+        # Not notified: written behind the back of the writers
+        self.task_cache.invalidate()
+        # Revision 1
+        TaskRecord(task_id=RUNNING_ID, **task_payload(
+            bamboo_server="bamboo.local", status="IN_PROGRESS", timeline={'inserted': 1.0, 'triggered': 2.0}
+        )).save(redis_client=self.redis_client)
+        self.redis_client.set(FINISHED_ID, TaskRecord(**finished_payload(bamboo_server="bamboo.local")).encode())
+        for index in range(self.__dump_tasks):
+            task_values = finished_payload(bamboo_server="bamboo.local") if index % 2 else task_payload(
+                bamboo_server="bamboo.local")
+            self.redis_client.set("{0:0128x}".format(index + 1), TaskRecord(**task_values).encode())
+
+    def run(self):
+        """Send the requests with the current JSON backend, on a freshly seeded DB.
+        :return: {endpoint: {requests, responses_per_sec}} [dictionary]
+        """
+
+        self.seed()
+
+        results = dict()
+        for name, (send_request, no_of_requests) in sorted(self.requests.items()):
+            # Warm up
+            assert send_request().status_code in (200, 304), name
+
+            start_time = perf_counter()
+            for _ in range(no_of_requests):
+                send_request()
+            elapsed_time = perf_counter() - start_time
+
+            results[name] = {'requests': no_of_requests, 'responses_per_sec': round(no_of_requests / elapsed_time, 1)}
+
+        return results
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Benchmark the responses per second of the API endpoints.")
+    parser.add_argument('-n', dest='no_of_requests', type=int, default=2000, help='Requests per endpoint!')
+    parser.add_argument('-t', dest='dump_tasks', type=int, default=1000, help='Tasks in the DB for the dumps!')
+    parser.add_argument('-r', dest='repeat', type=int, default=3, help='Repeats per backend (best one is kept)!')
+    parser.add_argument('-o', dest='output', required=False, help='Write the JSON results to this file!')
+    args = parser.parse_args()
+
+    benchmark = ResponsesBenchmark(no_of_requests=args.no_of_requests, dump_tasks=args.dump_tasks)
+
+    results = dict()
+    for _ in range(args.repeat):
+        for backend in ('json', 'orjson') if orjson is not None else ('json',):
+            JsonUtils.BACKEND = backend
+            for name, result in benchmark.run().items():
+                best_result = results.setdefault(backend, {}).get(name)
+                if not best_result or result['responses_per_sec'] > best_result['responses_per_sec']:
+                    results[backend][name] = result
+
+    for name in sorted(results['json']):
+        print("{0:30}".format(name) + "".join(
+            "{0:>8} {1:10.1f} resp/sec   ".format(backend, results[backend][name]['responses_per_sec'])
+            for backend in sorted(results)
+        ))
+
+    if args.output:
+        write_report(benchmark="responses", results=[results], output=args.output,
+                     options={'no_of_requests': args.no_of_requests, 'dump_tasks': args.dump_tasks,
+                              'repeat': args.repeat})
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Worker throughput benchmark:
+Seeds N tasks through the '/create_task' endpoint, then runs sweeps of 'TasksProcessingUnit' until every task is
+FINISHED with its artifacts crawled. Bamboo is replaced by 'benchmarks.fake_bamboo' and Redis by
+'benchmarks.fake_redis', so the numbers only depend on the code of the service.
+
+Reported per N: tasks/sec, sweep durations, Bamboo requests per task, Redis commands per task and peak RSS.
+Every N runs in its own process, so the peak RSS of a run is not inherited by the next one.
+
+Examples:
+    python benchmarks/worker_throughput.py -n 100,1000,10000 -o worker_throughput.json
+    python benchmarks/worker_throughput.py -n 50000 --latency 0.001 -o worker_throughput_50k.json
+"""
+
+
+import argparse
+import resource
+import subprocess
+import sys
+import tempfile
+
+from json import dumps, loads
+from os import path
+from time import time
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from benchmarks.fake_bamboo import FakeBambooServer
+from benchmarks.fake_redis import FakeRedis
+from benchmarks.report import REPO_DIR, write_report
+from task_cache import TaskStatusCache
+from task_codec import TaskCodec
+
+
+class WorkerThroughputBenchmark(object):
+    """One benchmark run: N tasks from creation to crawled artifacts."""
+
+    def __init__(self, no_of_tasks=100, latency=0.0, build_duration=0.0, max_sweeps=10):
+        """Create the benchmark instance object.
+        :param no_of_tasks: Number of tasks to seed [int]
+        :param latency: Latency of the fake Bamboo server, seconds [float]
+        :param build_duration: Duration of the fake Bamboo builds, seconds [float]
+        :param max_sweeps: Stop after this many sweeps even if some tasks are not done [int]
+        """
+        self.__no_of_tasks = no_of_tasks
+        self.__latency = latency
+        self.__build_duration = build_duration
+        self.__max_sweeps = max_sweeps
+
+    @staticmethod
+    def done_tasks(redis_client=None):
+        """Count the tasks with the artifacts crawled, without going through the counted client."""
+
+        done = 0
+        for key, value in list(redis_client.server.data.items()):
+            if not isinstance(value, bytes) or len(key) != 128:
+                continue
+
+            task_values = TaskCodec.decode(value)
+            if task_values.get('status') == 'FINISHED' and not task_values.get('post_operation'):
+                done += 1
+
+        return done
+
+    def seed(self, redis_client=None, bamboo_server=None):
+        """Create the tasks through the API.
+        :return: Seconds spent [float]
+        """
+
+        from app import APP
+
+        APP.config['TESTING'] = True
+        APP.config['REDIS'] = redis_client
+        APP.config['REDIS_RAW'] = FakeRedis(server=redis_client.server, decode_responses=False)
+        APP.config['TASK_CACHE'] = TaskStatusCache(redis_client=redis_client)
+        APP.config['BAMBOO_SERVER'] = bamboo_server
+
+        client = APP.test_client()
+        start_time = time()
+        for index in range(self.__no_of_tasks):
+            response = client.post(
+                "/create_task/benchmark/build?variant={0}".format(index % 10),
+                data={
+                    'planUrl': "http://{0}/browse/PROJ-PLAN{1}".format(bamboo_server, index % 100),
+                    'waitForPlan': "3600",
+                    'artifactsOnStage': "JOB1",
+                    'artifactNames': "binaries"
+                }
+            )
+            if response.status_code != 200:
+                raise RuntimeError("Could not create task #{0}: {1}".format(index, response.get_data(as_text=True)))
+
+        return time() - start_time
+
+    def run(self):
+        """Run the benchmark.
+        :return: Results [dictionary]
+        """
+
+        import tasks_processing_unit
+
+        redis_client = FakeRedis()
+        tasks_processing_unit.RedisCommunication.CLIENT = redis_client
+        tasks_processing_unit.RedisCommunication.RAW_CLIENT = FakeRedis(server=redis_client.server,
+                                                                        decode_responses=False)
+
+        with FakeBambooServer(latency=self.__latency, build_duration=self.__build_duration) as bamboo_server, \
+                tempfile.TemporaryDirectory() as logs_dir:
+            seed_time = self.seed(redis_client=redis_client, bamboo_server=bamboo_server.server_name)
+            seed_commands = redis_client.server.total_commands()
+            redis_client.server.reset_counters()
+
+            task_pu = tasks_processing_unit.TasksProcessingUnit(bamboo_server=bamboo_server.server_name,
+                                                                path_to_parent_dir=logs_dir, url_scheme='http',
+                                                                artifacts_domain='',
+                                                                rate_limiter=False, admission_control=False)
+
+            sweeps = list()
+            done = 0
+            while len(sweeps) < self.__max_sweeps and done < self.__no_of_tasks:
+                sweep_result = task_pu.process_sweep(redis_client=redis_client)
+                done = self.done_tasks(redis_client=redis_client)
+                sweeps.append({
+                    'duration': round(sweep_result['duration'], 6),
+                    'tasks': sweep_result['tasks'],
+                    'states': sweep_result['states'],
+                    'done': done
+                })
+            task_pu.log_writer.close()
+
+            bamboo_requests = bamboo_server.request_counts()
+
+        worker_time = sum(sweep['duration'] for sweep in sweeps)
+        redis_commands = redis_client.server.total_commands()
+        return {
+            'tasks': self.__no_of_tasks,
+            'done': done,
+            'seed_seconds': round(seed_time, 6),
+            'seed_tasks_per_sec': round(self.__no_of_tasks / seed_time, 2) if seed_time else None,
+            'seed_redis_ops_per_task': round(seed_commands / float(self.__no_of_tasks), 3),
+            'worker_seconds': round(worker_time, 6),
+            'tasks_per_sec': round(done / worker_time, 2) if worker_time else None,
+            'sweeps': sweeps,
+            'bamboo_requests': bamboo_requests,
+            'bamboo_requests_per_task': round(sum(bamboo_requests.values()) / float(self.__no_of_tasks), 3),
+            'redis_commands': dict(sorted(redis_client.server.commands.items())),
+            'redis_ops_per_task': round(redis_commands / float(self.__no_of_tasks), 3),
+            'redis_round_trips_per_task': round(redis_client.server.round_trips / float(self.__no_of_tasks), 3),
+            # Linux reports kilobytes
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+        }
+
+
+def run_in_subprocess(no_of_tasks=None, args=None):
+    """Run one N in a fresh interpreter and get its results."""
+
+    command = [
+        sys.executable, path.abspath(__file__), '--single', str(no_of_tasks), '--latency', str(args.latency),
+        '--build-duration', str(args.build_duration), '--max-sweeps', str(args.max_sweeps)
+    ]
+    output = subprocess.check_output(command, cwd=REPO_DIR)
+    return loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Benchmark the worker throughput against fake Bamboo and Redis.")
+    parser.add_argument('-n', dest='levels', default="100,1000,10000,50000", help='Comma separated numbers of tasks!')
+    parser.add_argument('-o', dest='output', required=False, help='Write the JSON results to this file!')
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0, help='Fake Bamboo latency, seconds!')
+    parser.add_argument('--build-duration', dest='build_duration', type=float, default=0.0,
+                        help='Fake Bamboo build duration, seconds!')
+    parser.add_argument('--max-sweeps', dest='max_sweeps', type=int, default=10, help='Maximum sweeps per run!')
+    parser.add_argument('--single', dest='single', type=int, required=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: run one level and print its results
+    if args.single:
+        benchmark = WorkerThroughputBenchmark(no_of_tasks=args.single, latency=args.latency,
+                                              build_duration=args.build_duration, max_sweeps=args.max_sweeps)
+        print(dumps(benchmark.run()))
+        sys.exit(0)
+
+    results = list()
+    for no_of_tasks in [int(level) for level in args.levels.split(",") if level.strip()]:
+        level_result = run_in_subprocess(no_of_tasks=no_of_tasks, args=args)
+        print("N={tasks}: {tasks_per_sec} tasks/sec, {bamboo_requests_per_task} Bamboo requests/task, "
+              "{redis_ops_per_task} Redis ops/task, peak RSS {peak_rss_mb} MB".format(**level_result))
+        results.append(level_result)
+
+    write_report(benchmark="worker_throughput", results=results, output=args.output, options={
+        'latency': args.latency,
+        'build_duration': args.build_duration,
+        'max_sweeps': args.max_sweeps
+    })
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Circuit breaker module:
+Stops sending requests to a Bamboo server which keeps failing, instead of waiting for a full timeout on every request.
+
+One circuit per Bamboo server:
+    - closed: the requests are sent; the outcomes of the last 'window' requests are kept and the circuit opens when
+      at least 'min_requests' of them are known and the share of failures reaches 'error_rate'
+    - open: the requests fail at once (CircuitOpenError) during 'open_seconds'
+    - half-open: then a single probe request is let through; the circuit closes if it succeeds, opens again otherwise
+
+A failure is a request which raised (connection error, timeout) or got a 5xx response.
+"""
+
+
+import sys
+import threading
+
+from collections import deque
+from os import path
+from time import monotonic
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from metrics import REGISTRY
+
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+
+# Gauge values of the states
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = REGISTRY.gauge('bamboo_circuit_state', "State of the circuit of a Bamboo server (0: closed, "
+                                                       "1: half-open, 2: open).", ('server',))
+CIRCUIT_REJECTED = REGISTRY.counter('bamboo_circuit_rejected_total', "Bamboo requests not sent, circuit open.",
+                                    ('server',))
+
+
+class CircuitOpenError(ValueError):
+    """The circuit of the Bamboo server is open: the request was not sent."""
+
+
+class Circuit(object):
+    """Circuit of one Bamboo server."""
+
+    def __init__(self, server=None, error_rate=0.5, min_requests=10, window=20, open_seconds=30.0):
+        """Create the circuit instance object.
+        :param server: Bamboo server name [string]
+        :param error_rate: Share of failed requests which opens the circuit [float]
+        :param min_requests: Requests to know before the circuit may open [int]
+        :param window: Number of last requests considered [int]
+        :param open_seconds: Seconds before a probe request is let through [float]
+        """
+        self.__server = server
+        self.__error_rate = error_rate
+        self.__min_requests = min_requests
+        self.__open_seconds = open_seconds
+
+        # True for the failed requests
+        self.__outcomes = deque(maxlen=window)
+        self.__state = CLOSED
+        self.__opened_time = None
+        self.__probing = False
+        self.__lock = threading.Lock()
+
+    @property
+    def server(self):
+        """Get the Bamboo server name."""
+        return self.__server
+
+    @property
+    def state(self):
+        """Get the state of the circuit."""
+        return self.__state
+
+    def __set_state(self, state=None):
+        # Must be called with the lock held
+        if state != self.__state:
+            print("Circuit of Bamboo server '{server}': {old} => {new}".format(server=self.server, old=self.__state,
+                                                                               new=state))
+        self.__state = state
+        CIRCUIT_STATE.set(STATE_VALUES[state], server=self.server)
+
+    def allows(self):
+        """Whether a request may be sent now (without reserving the probe of a half-open circuit)."""
+
+        with self.__lock:
+            if self.__state == OPEN:
+                return monotonic() - self.__opened_time >= self.__open_seconds
+            return not (self.__state == HALF_OPEN and self.__probing)
+
+    def before_request(self):
+        """Check that a request may be sent.
+        :raise: CircuitOpenError when the circuit is open, or half-open with its probe already sent
+        """
+
+        with self.__lock:
+            if self.__state == OPEN and monotonic() - self.__opened_time >= self.__open_seconds:
+                self.__set_state(HALF_OPEN)
+                self.__probing = False
+
+            if self.__state == HALF_OPEN and not self.__probing:
+                self.__probing = True
+                return
+
+            if self.__state == CLOSED:
+                return
+
+        CIRCUIT_REJECTED.inc(server=self.server)
+        raise CircuitOpenError("Bamboo server '{server}' is failing, request not sent (circuit open)!".format(
+            server=self.server
+        ))
+
+    def record(self, failed=False):
+        """Record the outcome of a request.
+        :param failed: The request raised or got a 5xx response [boolean]
+        """
+
+        with self.__lock:
+            if self.__state == HALF_OPEN:
+                self.__probing = False
+                if failed:
+                    self.__opened_time = monotonic()
+                    self.__set_state(OPEN)
+                else:
+                    self.__outcomes.clear()
+                    self.__set_state(CLOSED)
+                return
+
+            self.__outcomes.append(failed)
+            if self.__state == CLOSED and len(self.__outcomes) >= self.__min_requests and \
+                    sum(self.__outcomes) >= self.__error_rate * len(self.__outcomes):
+                self.__opened_time = monotonic()
+                self.__set_state(OPEN)
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of the Bamboo requests: one circuit per Bamboo server, shared by the threads of the process."""
+
+    def __init__(self, error_rate=0.5, min_requests=10, window=20, open_seconds=30.0):
+        """Create the circuit breaker instance object.
+        :param error_rate: Share of failed requests which opens a circuit [float]
+        :param min_requests: Requests to know before a circuit may open [int]
+        :param window: Number of last requests considered [int]
+        :param open_seconds: Seconds before a probe request is let through [float]
+        """
+        self.__circuit_options = {'error_rate': error_rate, 'min_requests': min_requests, 'window': window,
+                                  'open_seconds': open_seconds}
+
+        # {bamboo_server: circuit}
+        self.__circuits = dict()
+        self.__lock = threading.Lock()
+
+    def circuit(self, bamboo_server=None):
+        """Get (create on first use) the circuit of a Bamboo server.
+        :param bamboo_server: Bamboo server name [string]
+        :return: The circuit [Circuit]
+        """
+
+        circuit = self.__circuits.get(bamboo_server)
+        if circuit is None:
+            with self.__lock:
+                circuit = self.__circuits.get(bamboo_server)
+                if circuit is None:
+                    circuit = self.__circuits[bamboo_server] = Circuit(server=bamboo_server,
+                                                                       **self.__circuit_options)
+
+        return circuit
+
+    def allows(self, bamboo_server=None):
+        """Whether a request to a Bamboo server may be sent now.
+        :param bamboo_server: Bamboo server name [string]
+        """
+        return self.circuit(bamboo_server=bamboo_server).allows()
+
+    def before_request(self, bamboo_server=None):
+        """Check that a request to a Bamboo server may be sent.
+        :param bamboo_server: Bamboo server name [string]
+        :raise: CircuitOpenError when its circuit is open
+        """
+        self.circuit(bamboo_server=bamboo_server).before_request()
+
+    def record(self, bamboo_server=None, failed=False):
+        """Record the outcome of a request to a Bamboo server.
+        :param bamboo_server: Bamboo server name [string]
+        :param failed: The request raised or got a 5xx response [boolean]
+        """
+        self.circuit(bamboo_server=bamboo_server).record(failed=failed)
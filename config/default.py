@@ -1,42 +1,215 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
-"""Reads the data in order to run the app."""
+"""Reads the data in order to run the app.
 
+The settings are computed on first use (module '__getattr__', PEP 562): importing this module neither reads
+'config.txt' nor builds the Redis client, so the modules and the CLI tools only pay for what they use.
+"""
 
-import redis
 
 from configparser import ConfigParser
+from functools import lru_cache
 from importlib import resources
+from os import environ, path
 
 
-DEBUG = False
+# Development mode (debug toolbar): set by 'run.py', never by the production entry point 'serve.py'
+DEBUG = environ.get("BAMBOO_API_DEBUG") == "1"
 
-CFG = ConfigParser()
-CFG.read_string(resources.read_text('config', "config.txt"))
 
-BAMBOO_SERVER = CFG.get('bamboo', "server")
-BAMBOO_USER = CFG.get('bamboo', "username")
-BAMBOO_PASS = CFG.get('bamboo', "password")
+@lru_cache(maxsize=None)
+def config_parser():
+    """Read the config file, once."""
 
-HOST_NAME = CFG.get('host_name', "fqdn")
-HOST_PORT = CFG.get('host_name', "port")
-APP_CONFIG = {
-    # This is important in order to know what URL to send back to user request
-    'host': HOST_NAME,
-    'port': HOST_PORT
+    cfg = ConfigParser()
+    cfg.read_string(resources.read_text('config', "config.txt"))
+    return cfg
+
+
+def setting(name=None):
+    """Get a setting, computing it on first use."""
+    return globals()[name] if name in globals() else __getattr__(name)
+
+
+def redis_client(raw=False):
+    """Get the Redis client shared by the process."""
+
+    from redis_utils import RedisUtils
+
+    return RedisUtils.client(raw=raw)
+
+
+def task_cache():
+    """Get the in-process task cache of the API, None when disabled."""
+
+    if not setting('STATUS_CACHE_ENABLED'):
+        return None
+
+    from task_cache import TaskStatusCache
+
+    return TaskStatusCache(redis_client=setting('REDIS'), max_entries=setting('STATUS_CACHE_MAX_ENTRIES'),
+                           ttl=setting('STATUS_CACHE_TTL'))
+
+
+def rate_limiter():
+    """Get the rate limiter of the Bamboo requests shared by the process, None when disabled."""
+
+    if not setting('BAMBOO_RATE_LIMIT_ENABLED'):
+        return None
+
+    from rate_limiter import RateLimiter
+
+    return RateLimiter(rates=setting('BAMBOO_RATE_LIMITS'),
+                       redis_client=setting('REDIS') if setting('BAMBOO_RATE_LIMIT_SHARED') else None)
+
+
+def circuit_breaker():
+    """Get the circuit breaker of the Bamboo requests shared by the process, None when disabled."""
+
+    if not setting('BAMBOO_CIRCUIT_ENABLED'):
+        return None
+
+    from circuit_breaker import CircuitBreaker
+
+    return CircuitBreaker(error_rate=setting('BAMBOO_CIRCUIT_ERROR_RATE'),
+                          min_requests=setting('BAMBOO_CIRCUIT_MIN_REQUESTS'), window=setting('BAMBOO_CIRCUIT_WINDOW'),
+                          open_seconds=setting('BAMBOO_CIRCUIT_OPEN_SECONDS'))
+
+
+def admission_control():
+    """Get the admission control of the new tasks shared by the worker threads, None when disabled."""
+
+    if not setting('ADMISSION_CONTROL_ENABLED'):
+        return None
+
+    from admission_control import AdmissionControl
+
+    return AdmissionControl(max_queued=setting('ADMISSION_MAX_QUEUED'),
+                            sample_interval=setting('ADMISSION_SAMPLE_INTERVAL'))
+
+
+# Lower case: only the settings themselves are upper case (Flask 'config.from_object()' copies those)
+lazy_settings = {
+    'CFG': config_parser,
+
+    'BAMBOO_SERVER': lambda: config_parser().get('bamboo', "server"),
+    'BAMBOO_USER': lambda: config_parser().get('bamboo', "username"),
+    'BAMBOO_PASS': lambda: config_parser().get('bamboo', "password"),
+    'BAMBOO_URL_SCHEME': lambda: config_parser().get('bamboo', "url_scheme", fallback="https"),
+    'BAMBOO_ARTIFACTS_DOMAIN': lambda: config_parser().get('bamboo', "artifacts_domain", fallback=".sw.nxp.com"),
+    # Every Bamboo server the tasks may target: the default one first
+    'BAMBOO_SERVERS': lambda: list(dict.fromkeys([setting('BAMBOO_SERVER')] + [
+        server.strip() for server in config_parser().get('bamboo', "servers", fallback='').split(",") if server.strip()
+    ])),
+    'BAMBOO_POOL_SIZE': lambda: config_parser().getint('bamboo', "pool_size", fallback=10),
+
+    'BAMBOO_RATE_LIMIT_ENABLED': lambda: config_parser().getboolean('rate_limit', "enabled", fallback=True),
+    'BAMBOO_RATE_LIMIT_SHARED': lambda: config_parser().getboolean('rate_limit', "shared", fallback=False),
+    # {operation class: (requests per second, burst)}
+    'BAMBOO_RATE_LIMITS': lambda: {
+        operation_class: (config_parser().getfloat('rate_limit', operation_class + "_rate", fallback=rate),
+                          config_parser().getfloat('rate_limit', operation_class + "_burst", fallback=burst))
+        for operation_class, rate, burst in (('trigger', 5.0, 10.0), ('status', 50.0, 100.0),
+                                             ('artifacts', 20.0, 40.0))
+    },
+    # The limiter itself: one per process, shared by its threads
+    'BAMBOO_RATE_LIMITER': rate_limiter,
+
+    'BAMBOO_CIRCUIT_ENABLED': lambda: config_parser().getboolean('circuit_breaker', "enabled", fallback=True),
+    'BAMBOO_CIRCUIT_ERROR_RATE': lambda: config_parser().getfloat('circuit_breaker', "error_rate", fallback=0.5),
+    'BAMBOO_CIRCUIT_MIN_REQUESTS': lambda: config_parser().getint('circuit_breaker', "min_requests", fallback=10),
+    'BAMBOO_CIRCUIT_WINDOW': lambda: config_parser().getint('circuit_breaker', "window", fallback=20),
+    'BAMBOO_CIRCUIT_OPEN_SECONDS': lambda: config_parser().getfloat('circuit_breaker', "open_seconds", fallback=30.0),
+    # The circuit breaker itself: one per process, shared by its threads
+    'BAMBOO_CIRCUIT_BREAKER': circuit_breaker,
+
+    # Delay before a failed task is processed again: doubled on every failure, jittered, up to the maximum
+    'TASK_RETRY_BACKOFF_BASE': lambda: config_parser().getfloat('task_retries', "backoff_base", fallback=30.0),
+    'TASK_RETRY_BACKOFF_MAX': lambda: config_parser().getfloat('task_retries', "backoff_max", fallback=900.0),
+
+    # Empty: the default; 0 or 1: the servers are processed one after the other
+    'WORKER_SERVER_THREADS': lambda: int(config_parser().get('worker', "server_threads", fallback='') or 8),
+
+    'ADMISSION_CONTROL_ENABLED': lambda: config_parser().getboolean('admission_control', "enabled", fallback=True),
+    'ADMISSION_MAX_QUEUED': lambda: config_parser().getint('admission_control', "max_queued", fallback=50),
+    'ADMISSION_SAMPLE_INTERVAL': lambda: config_parser().getfloat('admission_control', "sample_interval",
+                                                                  fallback=30.0),
+    # The admission control itself: one per worker process
+    'ADMISSION_CONTROL': admission_control,
+
+    'HOST_NAME': lambda: config_parser().get('host_name', "fqdn"),
+    'HOST_PORT': lambda: config_parser().get('host_name', "port"),
+    'APP_CONFIG': lambda: {
+        # This is important in order to know what URL to send back to user request
+        'host': setting('HOST_NAME'),
+        'port': setting('HOST_PORT')
+    },
+
+    'REDIS_HOST': lambda: config_parser().get('redis_server', "server"),
+    'REDIS_PORT': lambda: config_parser().get('redis_server', "port"),
+    'REDIS_PASS': lambda: config_parser().get('redis_server', "password"),
+    'REDIS_UNIX_SOCKET': lambda: config_parser().get('redis_server', "unix_socket", fallback=''),
+    'REDIS_MAX_CONNECTIONS': lambda: config_parser().getint('redis_server', "max_connections", fallback=50),
+    'REDIS_POOL_TIMEOUT': lambda: config_parser().getfloat('redis_server', "pool_timeout", fallback=5.0),
+    'REDIS_CONNECT_TIMEOUT': lambda: config_parser().getfloat('redis_server', "connect_timeout", fallback=2.0),
+    'REDIS_SOCKET_TIMEOUT': lambda: config_parser().getfloat('redis_server', "socket_timeout", fallback=10.0),
+    'REDIS_KEEPALIVE': lambda: config_parser().getboolean('redis_server', "keepalive", fallback=True),
+    'REDIS_HEALTH_CHECK_INTERVAL': lambda: config_parser().getint('redis_server', "health_check_interval",
+                                                                  fallback=30),
+    'REDIS_MODE': lambda: config_parser().get('redis_server', "mode", fallback="single").strip().lower(),
+    'REDIS_SENTINELS': lambda: config_parser().get('redis_server', "sentinels", fallback=''),
+    'REDIS_SENTINEL_SERVICE': lambda: config_parser().get('redis_server', "sentinel_service", fallback="mymaster"),
+    'REDIS_SENTINEL_PASS': lambda: config_parser().get('redis_server', "sentinel_password", fallback=''),
+    'REDIS_CLUSTER_NODES': lambda: config_parser().get('redis_server', "cluster_nodes", fallback=''),
+    'REDIS': redis_client,
+    # Returns bytes: used for the tasks (see 'task_codec')
+    'REDIS_RAW': lambda: redis_client(raw=True),
+
+    'TASK_ENCODING': lambda: config_parser().get('task_encoding', "format", fallback="compact").strip().lower(),
+    'TASK_COMPRESS_THRESHOLD': lambda: config_parser().getint('task_encoding', "compress_threshold", fallback=512),
+
+    'STATUS_CACHE_ENABLED': lambda: config_parser().getboolean('status_cache', "enabled", fallback=True),
+    'STATUS_CACHE_MAX_ENTRIES': lambda: config_parser().getint('status_cache', "max_entries", fallback=10000),
+    'STATUS_CACHE_TTL': lambda: config_parser().getfloat('status_cache', "ttl", fallback=30.0),
+    # The cache itself: built on first use, listens once the first request reads it
+    'TASK_CACHE': task_cache,
+
+    'ARTIFACTS_MANIFEST_TTL': lambda: config_parser().getint('artifacts_cache', "manifest_ttl", fallback=86400),
+    'ARTIFACTS_CACHE_DIR': lambda: config_parser().get('artifacts_cache', "path", fallback='') or path.join(
+        path.dirname(path.dirname(path.abspath(__file__))), "artifacts_cache"
+    ),
+    'ARTIFACTS_CACHE_MAX_SIZE': lambda: config_parser().getint('artifacts_cache', "max_size_mb",
+                                                               fallback=20480) * 1024 * 1024,
+    'ARTIFACTS_DOWNLOAD_WAIT': lambda: config_parser().getfloat('artifacts_cache', "download_wait", fallback=300.0),
+
+    # Production WSGI server ('serve.py')
+    'WSGI_BIND': lambda: config_parser().get('wsgi', "bind", fallback="0.0.0.0:8888"),
+    'WSGI_WORKERS': lambda: config_parser().getint('wsgi', "workers", fallback=0),
+    'WSGI_THREADS': lambda: config_parser().getint('wsgi', "threads", fallback=8),
+    'WSGI_KEEPALIVE': lambda: config_parser().getint('wsgi', "keepalive", fallback=5),
+    'WSGI_BACKLOG': lambda: config_parser().getint('wsgi', "backlog", fallback=2048),
+    'WSGI_TIMEOUT': lambda: config_parser().getint('wsgi', "timeout", fallback=60),
+    'WSGI_MAX_REQUESTS': lambda: config_parser().getint('wsgi', "max_requests", fallback=0)
 }
 
-REDIS_HOST = CFG.get('redis_server', "server")
-REDIS_PORT = CFG.get('redis_server', "port")
-REDIS_PASS = CFG.get('redis_server', "password")
-REDIS = redis.StrictRedis(host=REDIS_HOST,
-                          port=REDIS_PORT,
-                          db=0,
-                          password=REDIS_PASS,
-                          socket_timeout=None,
-                          connection_pool=None,
-                          charset='utf-8',
-                          errors='strict',
-                          unix_socket_path=None,
-                          decode_responses=True)
+
+# The objects among the settings (clients, caches, shared state): built on first use only, never by 'dir()'
+lazy_objects = frozenset(('REDIS', 'REDIS_RAW', 'TASK_CACHE', 'BAMBOO_RATE_LIMITER', 'BAMBOO_CIRCUIT_BREAKER',
+                          'ADMISSION_CONTROL'))
+
+
+def __getattr__(name):
+    """Compute a setting on first use and keep it as a module attribute."""
+
+    if name not in lazy_settings:
+        raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+
+    value = globals()[name] = lazy_settings[name]()
+    return value
+
+
+def __dir__():
+    # Lists the settings not computed yet, e.g. for Flask's 'config.from_object()'; not the objects, which the APP
+    # builds on first use (see 'app.LazyConfig')
+    return sorted((set(globals()) | set(lazy_settings)) - lazy_objects)
@@ -0,0 +1,73 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""JSON utils:
+JSON encoding and decoding for the API responses and the tasks, with the optional 'orjson' package when installed
+(several times faster than the standard 'json' module), the standard module otherwise.
+"""
+
+
+import json
+
+from collections.abc import Mapping
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JsonUtils(object):
+    """JSON encoding and decoding through the fastest backend available."""
+
+    # 'orjson' when installed, else 'json' (e.g.: the benchmarks switch it to compare)
+    BACKEND = 'orjson' if orjson is not None else 'json'
+
+    @staticmethod
+    def dumps(data=None):
+        """Encode data as JSON.
+        :param data: Data to encode
+        :return: JSON [bytes]
+        """
+
+        if JsonUtils.BACKEND == 'orjson':
+            try:
+                # The subclasses go through 'encode_subclass', so both backends give the same JSON
+                return orjson.dumps(data, default=JsonUtils.encode_subclass, option=orjson.OPT_PASSTHROUGH_SUBCLASS)
+            except TypeError:
+                # E.g.: keys which are not strings: left to the standard module
+                pass
+
+        return json.dumps(data).encode()
+
+    @staticmethod
+    def encode_subclass(value=None):
+        """Convert the values orjson does not encode as the standard module does (e.g.: a werkzeug MultiDict is a
+        dictionary of lists for orjson, of first values for the standard module).
+        :param value: Value to convert
+        :return: The same value, as a built-in type
+        :raise: TypeError for the types which cannot be encoded
+        """
+
+        if isinstance(value, Mapping):
+            return dict(value.items())
+        if isinstance(value, str):
+            return str(value)
+        if isinstance(value, int):
+            return int(value)
+        if isinstance(value, (list, tuple)):
+            return list(value)
+
+        raise TypeError("Type is not JSON serializable: {0}".format(type(value).__name__))
+
+    @staticmethod
+    def loads(data=None):
+        """Decode JSON.
+        :param data: JSON [bytes or string]
+        :return: Decoded data
+        """
+
+        if JsonUtils.BACKEND == 'orjson':
+            return orjson.loads(data)
+
+        return json.loads(data)
@@ -0,0 +1,236 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Metrics module:
+In-process metrics registry (counters, gauges, histograms) rendered in the Prometheus text format.
+"""
+
+
+import sys
+import threading
+
+from contextlib import contextmanager
+from os import path
+from time import time
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from utils import RedisKeyUtils
+
+
+# The worker publishes its metrics in Redis, the API exposes them next to its own metrics
+WORKER_METRICS_KEY = RedisKeyUtils.internal_key("metrics", "worker")
+WORKER_METRICS_TTL = 600
+
+
+class Metric(object):
+    """A metric family: one value (or histogram) per set of label values."""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name=None, documentation=None, metric_type=None, label_names=(), buckets=None):
+        """Create the metric instance object.
+        :param name: Name of the metric, without the registry prefix [string]
+        :param documentation: Help text of the metric [string]
+        :param metric_type: Type of the metric (counter/gauge/histogram) [string]
+        :param label_names: Names of the labels [tuple]
+        :param buckets: Upper bounds of the histogram buckets [tuple]
+        """
+        self.__name = name
+        self.__documentation = documentation
+        self.__metric_type = metric_type
+        self.__label_names = tuple(label_names)
+        self.__buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+
+        # {label values: value} or {label values: [bucket counts..., sum, count]} for histograms
+        self.__values = dict()
+        self.__lock = threading.Lock()
+
+    @property
+    def name(self):
+        """Get the name of the metric."""
+        return self.__name
+
+    @property
+    def metric_type(self):
+        """Get the type of the metric."""
+        return self.__metric_type
+
+    def __label_values(self, labels):
+        return tuple(str(labels.get(label_name, "")) for label_name in self.__label_names)
+
+    def inc(self, amount=1, **labels):
+        """Increase a counter or a gauge.
+        :param amount: Value to add [float]
+        :param labels: Label values
+        """
+
+        key = self.__label_values(labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrease a gauge.
+        :param amount: Value to subtract [float]
+        :param labels: Label values
+        """
+        self.inc(-amount, **labels)
+
+    def set(self, value=None, **labels):
+        """Set the value of a gauge.
+        :param value: New value [float]
+        :param labels: Label values
+        """
+
+        with self.__lock:
+            self.__values[self.__label_values(labels)] = value
+
+    def reset(self):
+        """Drop all the values (e.g.: before setting again all the values of a gauge)."""
+
+        with self.__lock:
+            self.__values.clear()
+
+    def observe(self, value=None, **labels):
+        """Add an observation to a histogram.
+        :param value: Observed value [float]
+        :param labels: Label values
+        """
+
+        key = self.__label_values(labels)
+        with self.__lock:
+            values = self.__values.get(key)
+            if values is None:
+                values = self.__values[key] = [0] * (len(self.__buckets) + 2)
+
+            for index, upper_bound in enumerate(self.__buckets):
+                if value <= upper_bound:
+                    values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the enclosed block, in seconds.
+        :param labels: Label values
+        """
+
+        start_time = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start_time, **labels)
+
+    @staticmethod
+    def __format_labels(label_pairs):
+        if not label_pairs:
+            return ""
+
+        return "{" + ",".join(
+            '{0}="{1}"'.format(name, value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n"))
+            for name, value in label_pairs
+        ) + "}"
+
+    def render(self, prefix=None):
+        """Render the metric family in the Prometheus text format.
+        :param prefix: Prefix of the metric name [string]
+        :return: List of lines
+        """
+
+        full_name = "{0}_{1}".format(prefix, self.name) if prefix else self.name
+        lines = [
+            "# HELP {0} {1}".format(full_name, self.__documentation),
+            "# TYPE {0} {1}".format(full_name, self.metric_type)
+        ]
+
+        with self.__lock:
+            values = sorted((key, list(value) if isinstance(value, list) else value)
+                            for key, value in self.__values.items())
+
+        for key, value in values:
+            label_pairs = list(zip(self.__label_names, key))
+            if self.metric_type != 'histogram':
+                lines.append("{0}{1} {2}".format(full_name, self.__format_labels(label_pairs), value))
+                continue
+
+            for index, upper_bound in enumerate(self.__buckets):
+                lines.append("{0}_bucket{1} {2}".format(
+                    full_name, self.__format_labels(label_pairs + [('le', repr(float(upper_bound)))]), value[index]
+                ))
+            lines.append("{0}_bucket{1} {2}".format(
+                full_name, self.__format_labels(label_pairs + [('le', "+Inf")]), value[-1]
+            ))
+            lines.append("{0}_sum{1} {2}".format(full_name, self.__format_labels(label_pairs), value[-2]))
+            lines.append("{0}_count{1} {2}".format(full_name, self.__format_labels(label_pairs), value[-1]))
+
+        return lines
+
+
+class MetricsRegistry(object):
+    """Registry holding all the metrics of the process.
+
+    The metric names are prefixed at render time with the name of the process (e.g.: 'bamboo_api',
+    'bamboo_worker'), so the API can expose its own metrics and the snapshot published by the worker side by side.
+    """
+
+    def __init__(self, prefix="bamboo_api"):
+        """Create the registry instance object.
+        :param prefix: Prefix of all the metric names [string]
+        """
+        self.prefix = prefix
+
+        self.__metrics = dict()
+        self.__lock = threading.Lock()
+
+    def __metric(self, name=None, documentation=None, metric_type=None, label_names=(), buckets=None):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = Metric(name=name, documentation=documentation,
+                                                       metric_type=metric_type, label_names=label_names,
+                                                       buckets=buckets)
+        return metric
+
+    def counter(self, name=None, documentation=None, label_names=()):
+        """Get (create on first use) a counter.
+        :param name: Name of the metric [string]
+        :param documentation: Help text of the metric [string]
+        :param label_names: Names of the labels [tuple]
+        """
+        return self.__metric(name=name, documentation=documentation, metric_type='counter', label_names=label_names)
+
+    def gauge(self, name=None, documentation=None, label_names=()):
+        """Get (create on first use) a gauge.
+        :param name: Name of the metric [string]
+        :param documentation: Help text of the metric [string]
+        :param label_names: Names of the labels [tuple]
+        """
+        return self.__metric(name=name, documentation=documentation, metric_type='gauge', label_names=label_names)
+
+    def histogram(self, name=None, documentation=None, label_names=(), buckets=None):
+        """Get (create on first use) a histogram.
+        :param name: Name of the metric [string]
+        :param documentation: Help text of the metric [string]
+        :param label_names: Names of the labels [tuple]
+        :param buckets: Upper bounds of the buckets [tuple]
+        """
+        return self.__metric(name=name, documentation=documentation, metric_type='histogram',
+                             label_names=label_names, buckets=buckets)
+
+    def render(self):
+        """Render all the metrics in the Prometheus text format.
+        :return: Exposition text [string]
+        """
+
+        with self.__lock:
+            metrics = sorted(self.__metrics.values(), key=lambda metric: metric.name)
+
+        lines = list()
+        for metric in metrics:
+            lines.extend(metric.render(prefix=self.prefix))
+
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+# Registry of the current process
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,195 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Query the structured (JSON lines) log files:
+Filters the events by time range and field values, and aggregates a numeric field per group.
+
+Examples:
+    python query_events.py --since 2019-08-01T10:00 -f event=task_state -f new_state=FINISHED
+    python query_events.py -f event=task_polled -g plan_key -a bamboo_latency
+    python query_events.py -f event=task_error -g product -a retry
+"""
+
+
+import argparse
+import glob
+import sys
+
+from datetime import datetime, timedelta
+from json import dumps, loads
+from os import path
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from utils import StatsUtils
+
+
+class EventsQuery(object):
+    """Filter and aggregate the events of a log type."""
+
+    def __init__(self, path_to_parent_dir=None, log_file_type='events'):
+        """Create the EventsQuery instance object.
+        :param path_to_parent_dir: Full path to the dir containing the logs [string]
+        :param log_file_type: Type of the log file (errors/bamboo/events/misc) [string]
+        """
+        self.__path_to_parent_dir = path_to_parent_dir
+        self.__log_file_type = log_file_type
+
+    @property
+    def path_to_parent_dir(self):
+        """Get the path to the parent directory."""
+        return self.__path_to_parent_dir
+
+    @property
+    def log_file_type(self):
+        """Get the log file type."""
+        return self.__log_file_type
+
+    @staticmethod
+    def parse_time(time_value=None):
+        """Parse a point in time.
+        :param time_value: ISO date/time (e.g.: 2019-08-01T10:00) or relative to now (e.g.: 30m, 2h, 1d) [string]
+        :return: Epoch timestamp [float]
+        """
+
+        if not time_value:
+            return None
+
+        units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+        if time_value[-1] in units and time_value[:-1].isdigit():
+            return (datetime.now() - timedelta(**{units[time_value[-1]]: int(time_value[:-1])})).timestamp()
+
+        return datetime.fromisoformat(time_value).timestamp()
+
+    def log_files(self, since=None, until=None):
+        """Get the log files which may contain events from the time range.
+        :param since: Epoch timestamp [float]
+        :param until: Epoch timestamp [float]
+        :return: List of paths
+        """
+
+        since_date = datetime.fromtimestamp(since).date() if since else None
+        until_date = datetime.fromtimestamp(until).date() if until else None
+
+        log_files = list()
+        for log_file in sorted(glob.glob(path.join(self.path_to_parent_dir, "logs", self.log_file_type, "*.jsonl"))):
+            # E.g: events_2019-08-01.jsonl
+            try:
+                file_date = datetime.strptime(path.basename(log_file).rsplit("_", 1)[-1][:-6], "%Y-%m-%d").date()
+            except ValueError:
+                continue
+
+            if (since_date and file_date < since_date) or (until_date and file_date > until_date):
+                continue
+
+            log_files.append(log_file)
+
+        return log_files
+
+    def events(self, since=None, until=None, filters=None):
+        """Iterate over the events matching the time range and the filters.
+        :param since: Epoch timestamp [float]
+        :param until: Epoch timestamp [float]
+        :param filters: Field values to match {field: value} [dictionary]
+        """
+
+        filters = filters or {}
+        for log_file in self.log_files(since=since, until=until):
+            with open(log_file) as file_handle:
+                for line in file_handle:
+                    try:
+                        event = loads(line)
+                    except ValueError:
+                        continue
+
+                    event_ts = event.get('ts', 0)
+                    if (since and event_ts < since) or (until and event_ts > until):
+                        continue
+
+                    if any(str(event.get(field)) != value for field, value in filters.items()):
+                        continue
+
+                    yield event
+
+    def aggregate(self, events=None, group_by=None, field=None):
+        """Aggregate a numeric field per group.
+        :param events: Events to aggregate [iterable]
+        :param group_by: Field to group the events by [string]
+        :param field: Numeric field to aggregate [string]
+        :return: {group: {count, sum, avg, min, max, p50, p95, p99}} [dictionary]
+        """
+
+        groups = dict()
+        counts = dict()
+        for event in events:
+            group = str(event.get(group_by)) if group_by else "all"
+            counts[group] = counts.get(group, 0) + 1
+
+            value = event.get(field) if field else None
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                groups.setdefault(group, []).append(value)
+
+        result = dict()
+        for group, count in counts.items():
+            values = sorted(groups.get(group, []))
+            result[group] = {'count': count}
+            if not field:
+                continue
+
+            result[group].update({
+                'samples': len(values),
+                'sum': round(sum(values), 6),
+                'avg': round(sum(values) / len(values), 6) if values else None,
+                'min': values[0] if values else None,
+                'max': values[-1] if values else None,
+                'p50': StatsUtils.percentile(values, 50),
+                'p95': StatsUtils.percentile(values, 95),
+                'p99': StatsUtils.percentile(values, 99)
+            })
+
+        # Slowest / biggest first
+        return dict(sorted(result.items(), key=lambda item: -(item[1].get('sum') or item[1]['count'])))
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Filter and aggregate the JSON lines log files.")
+    parser.add_argument('-t', dest='log_file_type', default='events', help='Log type (errors/bamboo/events/misc)!')
+    parser.add_argument('--since', dest='since', required=False, help='Start of the time range (ISO or 30m/2h/1d)!')
+    parser.add_argument('--until', dest='until', required=False, help='End of the time range (ISO or 30m/2h/1d)!')
+    parser.add_argument('-f', dest='filters', action='append', default=[], help='Filter as field=value!')
+    parser.add_argument('-g', dest='group_by', required=False, help='Field to group the events by!')
+    parser.add_argument('-a', dest='field', required=False, help='Numeric field to aggregate!')
+    parser.add_argument('-n', dest='limit', type=int, default=0, help='Print at most N events (no aggregation)!')
+    args = parser.parse_args()
+
+    filters = dict()
+    for field_filter in args.filters:
+        field, separator, value = field_filter.partition("=")
+        if not separator:
+            parser.error("Filter must be field=value: '{0}'".format(field_filter))
+        filters[field] = value
+
+    query = EventsQuery(path_to_parent_dir=path.dirname(path.abspath(__file__)), log_file_type=args.log_file_type)
+    events = query.events(since=EventsQuery.parse_time(args.since), until=EventsQuery.parse_time(args.until),
+                          filters=filters)
+
+    if args.group_by or args.field:
+        print(dumps(query.aggregate(events=events, group_by=args.group_by, field=args.field), indent=4))
+        sys.exit(0)
+
+    for index, event in enumerate(events):
+        if args.limit and index >= args.limit:
+            break
+        print(dumps(event))
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Rate limiter module:
+Token buckets limiting the requests sent to Bamboo, one per (Bamboo server, operation class), so that raising the
+worker concurrency cannot flood a Bamboo instance.
+
+The operations are grouped in classes (see OPERATION_CLASSES): 'trigger' (plans triggered or stopped), 'status'
+(plan and queue queries) and 'artifacts' (artifact pages and downloads). Each class has a rate (requests per second)
+and a burst from the [rate_limit] config section.
+
+The buckets are shared by the threads of the process; with 'shared = yes' they are kept in Redis and shared by all
+the worker processes (falling back to the local bucket while Redis is unreachable).
+"""
+
+
+import sys
+import threading
+
+from os import path
+from time import monotonic, sleep
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from metrics import REGISTRY
+from utils import RedisKeyUtils
+
+
+# Class of each Bamboo operation (the 'operation' of 'BambooAPI.__send_request')
+OPERATION_CLASSES = {
+    'trigger': 'trigger',
+    'stop_plan': 'trigger',
+    'plan_status': 'status',
+    'plan_info': 'status',
+    'query_queue': 'status',
+    'query_results': 'status',
+    'query_for_artifacts': 'artifacts',
+    'download_artifact': 'artifacts'
+}
+
+RATE_LIMIT_WAIT = REGISTRY.histogram('bamboo_rate_limit_wait_seconds', "Time waited for the Bamboo rate limiter.",
+                                     ('server', 'operation_class'))
+RATE_LIMIT_WAITING = REGISTRY.gauge('bamboo_rate_limit_waiting', "Requests waiting for the Bamboo rate limiter.",
+                                    ('server', 'operation_class'))
+RATE_LIMIT_ERRORS = REGISTRY.counter('bamboo_rate_limit_redis_errors_total',
+                                     "Shared buckets unreachable, the local bucket was used.")
+
+
+class TokenBucket(object):
+    """Token bucket of the process.
+
+    A request takes a token even when none is left: the tokens go below zero and the request waits until its token is
+    refilled, so the waiting requests are served in turn at the configured rate.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """Create the bucket instance object.
+        :param rate: Tokens refilled per second [float]
+        :param burst: Maximum number of tokens [float]
+        """
+        self.__rate = rate
+        self.__burst = burst
+        self.__tokens = burst
+        self.__last_time = monotonic()
+        self.__lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """Get the tokens refilled per second."""
+        return self.__rate
+
+    @property
+    def burst(self):
+        """Get the maximum number of tokens."""
+        return self.__burst
+
+    def reserve(self):
+        """Take a token.
+        :return: Seconds to wait before using it [float]
+        """
+
+        with self.__lock:
+            now = monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last_time) * self.rate) - 1
+            self.__last_time = now
+
+            return max(0.0, -self.__tokens / self.rate)
+
+
+class RedisTokenBucket(object):
+    """Token bucket kept in Redis, shared by all the processes (same semantics as TokenBucket)."""
+
+    # The Redis server clock is used: the worker hosts' clocks may differ
+    SCRIPT = """
+        redis.replicate_commands()
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+        local tokens = tonumber(state[1]) or burst
+        local last_time = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - last_time) * rate) - 1
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+        if tokens >= 0 then
+            return '0'
+        end
+        return tostring(-tokens / rate)
+    """
+
+    def __init__(self, redis_client=None, key=None, rate=None, burst=None):
+        """Create the bucket instance object.
+        :param redis_client: Redis client holding the bucket [StrictRedis]
+        :param key: Key of the bucket [string]
+        :param rate: Tokens refilled per second [float]
+        :param burst: Maximum number of tokens [float]
+        """
+        self.__redis_client = redis_client
+        self.__key = key
+        self.__script = redis_client.register_script(self.SCRIPT)
+
+        # Used while Redis is unreachable
+        self.__local_bucket = TokenBucket(rate=rate, burst=burst)
+
+    @property
+    def rate(self):
+        """Get the tokens refilled per second."""
+        return self.__local_bucket.rate
+
+    @property
+    def burst(self):
+        """Get the maximum number of tokens."""
+        return self.__local_bucket.burst
+
+    def reserve(self):
+        """Take a token.
+        :return: Seconds to wait before using it [float]
+        """
+
+        try:
+            return float(self.__script(keys=[self.__key], args=[repr(self.rate), repr(self.burst)]))
+        except Exception as err:
+            print("Error when using the shared rate limiter, using the local one: {err}".format(err=err))
+            RATE_LIMIT_ERRORS.inc()
+            return self.__local_bucket.reserve()
+
+
+class RateLimiter(object):
+    """Rate limiter of the Bamboo requests: one bucket per (Bamboo server, operation class)."""
+
+    def __init__(self, rates=None, redis_client=None):
+        """Create the rate limiter instance object.
+        :param rates: {operation class: (requests per second, burst)}, a rate of 0 is not limited [dictionary]
+        :param redis_client: Redis client holding the buckets shared by the processes, local buckets if None
+        """
+        self.__rates = rates or {}
+        self.__redis_client = redis_client
+
+        # {(bamboo_server, operation_class): bucket}
+        self.__buckets = dict()
+        self.__lock = threading.Lock()
+
+    @property
+    def rates(self):
+        """Get the rates per operation class."""
+        return self.__rates
+
+    @property
+    def redis_client(self):
+        """Get the Redis client."""
+        return self.__redis_client
+
+    @staticmethod
+    def operation_class(operation=None):
+        """Get the class of a Bamboo operation.
+        :param operation: Name of the operation (e.g.: <trigger/plan_info/stop_plan>) [string]
+        :return: Operation class [string]
+        """
+        return OPERATION_CLASSES.get(operation, 'status')
+
+    @staticmethod
+    def bucket_key(bamboo_server=None, operation_class=None):
+        """Compound the Redis key of a shared bucket.
+        :param bamboo_server: Bamboo server name [string]
+        :param operation_class: Operation class [string]
+        :return: Key name [string]
+        """
+        return RedisKeyUtils.internal_key("rate_limit", bamboo_server, operation_class)
+
+    def bucket(self, bamboo_server=None, operation_class=None):
+        """Get (create on first use) the bucket of a Bamboo server and operation class.
+        :param bamboo_server: Bamboo server name [string]
+        :param operation_class: Operation class [string]
+        :return: The bucket, None if the class is not limited [TokenBucket]
+        """
+
+        rate, burst = self.rates.get(operation_class, (0, 0))
+        if rate <= 0:
+            return None
+
+        with self.__lock:
+            bucket = self.__buckets.get((bamboo_server, operation_class))
+            if bucket is None:
+                burst = max(burst, 1)
+                if self.redis_client is not None:
+                    bucket = RedisTokenBucket(redis_client=self.redis_client, rate=rate, burst=burst,
+                                              key=self.bucket_key(bamboo_server=bamboo_server,
+                                                                  operation_class=operation_class))
+                else:
+                    bucket = TokenBucket(rate=rate, burst=burst)
+                self.__buckets[(bamboo_server, operation_class)] = bucket
+
+        return bucket
+
+    def acquire(self, bamboo_server=None, operation=None):
+        """Wait until a request may be sent.
+        :param bamboo_server: Bamboo server name [string]
+        :param operation: Name of the operation (e.g.: <trigger/plan_info/stop_plan>) [string]
+        :return: Seconds waited [float]
+        """
+
+        operation_class = self.operation_class(operation=operation)
+        bucket = self.bucket(bamboo_server=bamboo_server, operation_class=operation_class)
+        if bucket is None:
+            return 0.0
+
+        wait_time = bucket.reserve()
+        if wait_time > 0:
+            RATE_LIMIT_WAITING.inc(server=bamboo_server, operation_class=operation_class)
+            try:
+                sleep(wait_time)
+            finally:
+                RATE_LIMIT_WAITING.dec(server=bamboo_server, operation_class=operation_class)
+
+        RATE_LIMIT_WAIT.observe(wait_time, server=bamboo_server, operation_class=operation_class)
+
+        return wait_time
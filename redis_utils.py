@@ -0,0 +1,365 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Redis utils:
+The Redis client shared by the API and the worker. It is built on first use, with a single connection pool per
+process, sized and timed out from the [redis_server] config section (TCP or Unix socket, keepalive, health checks).
+A second client returning bytes, with its own pool, reads and writes the encoded tasks (see 'task_codec'): redis-py
+decodes the responses per connection, so the two clients cannot share a pool. 'max_connections' is split between the
+two pools (see 'RedisUtils.max_connections'), so the process never opens more connections than configured.
+
+Three deployments are supported ('mode' in the [redis_server] config section):
+    - single: one Redis server (default)
+    - sentinel: the master is looked up through Redis Sentinel and followed on failover
+    - cluster: Redis Cluster, through the optional 'redis-py-cluster' package
+"""
+
+
+import functools
+import redis
+import socket
+import sys
+import threading
+
+from os import path
+from redis.sentinel import SentinelConnectionPool
+from time import time
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from metrics import REGISTRY
+
+
+class InstrumentedPipelineCommands(object):
+    """Mixin for the Redis pipelines: counts the pipelined commands and records the duration of every batch in the
+    metrics registry (the commands of a batch are sent together, they have no duration of their own)."""
+
+    def execute(self, *args, **kwargs):
+        """Execute the pipelined commands and record the batch."""
+
+        command_names = [str(command[0][0]).upper() if command[0] else "UNKNOWN" for command in self.command_stack]
+        start_time = time()
+        try:
+            return super().execute(*args, **kwargs)
+        except Exception:
+            REGISTRY.counter('redis_errors_total', "Failed Redis commands.", ('command',)).inc(command="PIPELINE")
+            raise
+        finally:
+            REGISTRY.histogram('redis_pipeline_duration_seconds', "Duration of the Redis pipelines.").observe(
+                time() - start_time
+            )
+            pipelined_commands = REGISTRY.counter('redis_pipelined_commands_total', "Commands sent in Redis pipelines.",
+                                                  ('command',))
+            for command_name in command_names:
+                pipelined_commands.inc(command=command_name)
+
+
+class InstrumentedCommands(object):
+    """Mixin for the Redis clients: records the duration of every command, and of every pipeline, in the metrics
+    registry."""
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def instrumented_pipeline_class(pipeline_class=None):
+        """Get the instrumented subclass of a pipeline class (redis-py or redis-py-cluster pipeline).
+        :param pipeline_class: Pipeline class [type]
+        :return: Subclass [type]
+        """
+        return type('Instrumented{0}'.format(pipeline_class.__name__), (InstrumentedPipelineCommands, pipeline_class),
+                    {})
+
+    def pipeline(self, *args, **kwargs):
+        """Get a pipeline which records its commands (see 'InstrumentedPipelineCommands')."""
+
+        pipeline = super().pipeline(*args, **kwargs)
+        pipeline.__class__ = self.instrumented_pipeline_class(type(pipeline))
+
+        return pipeline
+
+    def execute_command(self, *args, **options):
+        """Execute a command and record its duration."""
+
+        command_name = str(args[0]).upper() if args else "UNKNOWN"
+        start_time = time()
+        try:
+            return super().execute_command(*args, **options)
+        except Exception:
+            REGISTRY.counter('redis_errors_total', "Failed Redis commands.", ('command',)).inc(command=command_name)
+            raise
+        finally:
+            REGISTRY.histogram('redis_command_duration_seconds', "Duration of the Redis commands.",
+                               ('command',)).observe(time() - start_time, command=command_name)
+
+
+class InstrumentedRedis(InstrumentedCommands, redis.StrictRedis):
+    """Redis client which records the duration of every command in the metrics registry."""
+
+
+class BlockingSentinelConnectionPool(SentinelConnectionPool, redis.BlockingConnectionPool):
+    """Connection pool of the master monitored by Redis Sentinel which, like the pool of a single server, waits up to
+    'timeout' seconds for a free connection instead of failing at once when all are in use."""
+
+    def disconnect(self, inuse_connections=True):
+        """Disconnect the connections of the pool; only the idle ones when the master changed (the connections in use
+        are dropped when released, see 'SentinelConnectionPool.owns_connection').
+        :param inuse_connections: Also disconnect the connections in use [bool]
+        """
+
+        if inuse_connections:
+            return super().disconnect()
+
+        self._checkpid()
+        # Under the lock of the queue: an idle connection is not handed out while it is disconnected
+        with self.pool.mutex:
+            for connection in self.pool.queue:
+                if connection is not None:
+                    connection.disconnect()
+
+
+class RedisUtils(object):
+    """Builds, on first use, the connection pool and the client shared by the whole process."""
+
+    MODES = ('single', 'sentinel', 'cluster')
+
+    # {raw: client}
+    __CLIENTS = dict()
+    __LOCK = threading.Lock()
+
+    @staticmethod
+    def parse_nodes(nodes=None):
+        """Parse a list of Redis nodes.
+        :param nodes: Comma separated host:port [string]
+        :return: [(host, port)] [list]
+        """
+
+        parsed_nodes = list()
+        for node in nodes.split(","):
+            node = node.strip()
+            if not node:
+                continue
+            host, _, port = node.rpartition(":")
+            parsed_nodes.append((host, int(port)))
+
+        return parsed_nodes
+
+    @staticmethod
+    def connection_options(transport=True, decode_responses=True):
+        """Get the options of the connections, from the [redis_server] config section.
+        :param transport: Add the address of the server (server/port or unix_socket) [bool]
+        :param decode_responses: Return strings instead of bytes [bool]
+        :return: Keyword arguments of the connection pool [dictionary]
+        """
+
+        from config import default as config
+
+        connection_options = {
+            'db': 0,
+            'password': config.REDIS_PASS,
+            'encoding': 'utf-8',
+            'encoding_errors': 'strict',
+            'decode_responses': decode_responses,
+            'socket_timeout': config.REDIS_SOCKET_TIMEOUT or None,
+            'retry_on_timeout': False,
+            'health_check_interval': config.REDIS_HEALTH_CHECK_INTERVAL
+        }
+
+        if transport and config.REDIS_UNIX_SOCKET:
+            connection_options.update({
+                'connection_class': redis.UnixDomainSocketConnection,
+                'path': config.REDIS_UNIX_SOCKET
+            })
+            return connection_options
+
+        if transport:
+            connection_options.update({
+                'host': config.REDIS_HOST,
+                'port': config.REDIS_PORT
+            })
+
+        connection_options.update({
+            'socket_connect_timeout': config.REDIS_CONNECT_TIMEOUT or None,
+            'socket_keepalive': config.REDIS_KEEPALIVE
+        })
+
+        # Detect a dead peer in ~2 minutes instead of the OS default (hours)
+        keepalive_options = {
+            getattr(socket, option_name): value
+            for option_name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4))
+            if hasattr(socket, option_name)
+        }
+        if config.REDIS_KEEPALIVE and keepalive_options:
+            connection_options['socket_keepalive_options'] = keepalive_options
+
+        return connection_options
+
+    @staticmethod
+    def max_connections(decode_responses=True):
+        """Get the size of the pool of a client: half of 'max_connections' each (the client returning bytes gets the
+        odd one), at least one.
+        :param decode_responses: Pool of the client returning strings [bool]
+        :return: Number of connections [int]
+        """
+
+        from config import default as config
+
+        total_connections = max(config.REDIS_MAX_CONNECTIONS, 2)
+        raw_connections = (total_connections + 1) // 2
+
+        return total_connections - raw_connections if decode_responses else raw_connections
+
+    @staticmethod
+    def single_client(decode_responses=True):
+        """Build the client of a single Redis server: at most its share of 'max_connections' connections, the callers
+        wait up to 'pool_timeout' seconds for a free one.
+        :param decode_responses: Return strings instead of bytes [bool]
+        :return: The client [InstrumentedRedis]
+        """
+
+        from config import default as config
+
+        pool = redis.BlockingConnectionPool(max_connections=RedisUtils.max_connections(decode_responses),
+                                            timeout=config.REDIS_POOL_TIMEOUT,
+                                            **RedisUtils.connection_options(decode_responses=decode_responses))
+
+        return InstrumentedRedis(connection_pool=pool)
+
+    @staticmethod
+    def sentinel_client(decode_responses=True):
+        """Build the client of the master monitored by Redis Sentinel. The master is looked up on connect, so after a
+        failover the new connections go to the promoted replica. As in 'single_client', the callers wait up to
+        'pool_timeout' seconds for a free connection.
+        :param decode_responses: Return strings instead of bytes [bool]
+        :return: The client [InstrumentedRedis]
+        """
+
+        from redis.sentinel import Sentinel
+        from config import default as config
+
+        sentinels = RedisUtils.parse_nodes(config.REDIS_SENTINELS)
+        if not sentinels:
+            raise ValueError("Redis mode 'sentinel' needs the 'sentinels' of the [redis_server] config section!")
+
+        connection_options = RedisUtils.connection_options(transport=False, decode_responses=decode_responses)
+        sentinel = Sentinel(sentinels, sentinel_kwargs={
+            'password': config.REDIS_SENTINEL_PASS or None,
+            'socket_timeout': connection_options['socket_timeout'],
+            'socket_connect_timeout': connection_options['socket_connect_timeout']
+        }, **connection_options)
+
+        return sentinel.master_for(config.REDIS_SENTINEL_SERVICE, redis_class=InstrumentedRedis,
+                                   connection_pool_class=BlockingSentinelConnectionPool,
+                                   max_connections=RedisUtils.max_connections(decode_responses),
+                                   timeout=config.REDIS_POOL_TIMEOUT)
+
+    @staticmethod
+    def cluster_client(decode_responses=True):
+        """Build the client of a Redis Cluster (optional 'redis-py-cluster' package). Only database 0 exists in a
+        cluster; the commands on several keys need the keys in the same slot (see 'RedisKeyUtils.task_key').
+        :param decode_responses: Return strings instead of bytes [bool]
+        :return: The client [InstrumentedRedisCluster]
+        """
+
+        try:
+            from rediscluster import RedisCluster
+        except ImportError:
+            raise ImportError("Redis mode 'cluster' needs the 'redis-py-cluster' package: "
+                              "pip install 'redis-py-cluster>=2.1,<3'")
+
+        from config import default as config
+
+        startup_nodes = [{'host': host, 'port': port}
+                         for host, port in RedisUtils.parse_nodes(config.REDIS_CLUSTER_NODES)]
+        if not startup_nodes:
+            raise ValueError("Redis mode 'cluster' needs the 'cluster_nodes' of the [redis_server] config section!")
+
+        connection_options = RedisUtils.connection_options(transport=False, decode_responses=decode_responses)
+        del connection_options['db']
+
+        instrumented_cluster = type('InstrumentedRedisCluster', (InstrumentedCommands, RedisCluster), {})
+        return instrumented_cluster(startup_nodes=startup_nodes,
+                                    max_connections=RedisUtils.max_connections(decode_responses),
+                                    skip_full_coverage_check=True, **connection_options)
+
+    @staticmethod
+    def pool(raw=False):
+        """Get the connection pool of a client of the process.
+        :param raw: Pool of the client returning bytes [bool]
+        :return: The pool [redis.BlockingConnectionPool, BlockingSentinelConnectionPool or ClusterConnectionPool]
+        """
+        return RedisUtils.client(raw=raw).connection_pool
+
+    @staticmethod
+    def pool_stats():
+        """Get the utilisation of the connection pools, all clients together.
+        :return: {max_connections, created, in_use, idle} [dictionary]
+        """
+
+        pool_stats = {'max_connections': 0, 'created': 0, 'in_use': 0, 'idle': 0}
+        for client in list(RedisUtils.__CLIENTS.values()):
+            pool = client.connection_pool
+            if isinstance(pool, redis.BlockingConnectionPool):
+                # Every connection ever created is in '_connections', the idle ones wait in 'pool' (the free slots are
+                # 'None' placeholders)
+                created = len(pool._connections)
+                idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+            else:
+                # ClusterConnectionPool: lists of connections, per node
+                available, in_use = pool._available_connections, pool._in_use_connections
+                if isinstance(available, dict):
+                    idle = sum(len(connections) for connections in list(available.values()))
+                    created = idle + sum(len(connections) for connections in list(in_use.values()))
+                else:
+                    idle = len(available)
+                    created = idle + len(in_use)
+
+            pool_stats['max_connections'] += pool.max_connections
+            pool_stats['created'] += created
+            pool_stats['in_use'] += created - idle
+            pool_stats['idle'] += idle
+
+        return pool_stats
+
+    @staticmethod
+    def observe_pool_stats():
+        """Publish the pool utilisation in the metrics registry."""
+
+        pool_stats = RedisUtils.pool_stats()
+        connections = REGISTRY.gauge('redis_pool_connections', "Connections of the Redis pool, by state.", ('state',))
+        for state in ('in_use', 'idle'):
+            connections.set(pool_stats[state], state=state)
+        REGISTRY.gauge('redis_pool_max_connections', "Size of the Redis pool.").set(pool_stats['max_connections'])
+
+    @staticmethod
+    def client(raw=False):
+        """Get a Redis client of the process, for the configured mode.
+        :param raw: Client returning bytes instead of strings [bool]
+        :return: The client [InstrumentedRedis or InstrumentedRedisCluster]
+        """
+
+        client = RedisUtils.__CLIENTS.get(raw)
+        if client is None:
+            with RedisUtils.__LOCK:
+                client = RedisUtils.__CLIENTS.get(raw)
+                if client is None:
+                    # Read the config only now: importing this module does not need it
+                    from config import default as config
+
+                    mode = config.REDIS_MODE
+                    if mode not in RedisUtils.MODES:
+                        raise ValueError("Unknown Redis mode '{0}', expected one of: {1}!".format(
+                            mode, ", ".join(RedisUtils.MODES)))
+
+                    client = RedisUtils.__CLIENTS[raw] = getattr(RedisUtils, "{0}_client".format(mode))(
+                        decode_responses=not raw
+                    )
+
+        return client
+
+    @staticmethod
+    def reset():
+        """Close the connections and drop the pools and the clients: the next use builds new ones."""
+
+        with RedisUtils.__LOCK:
+            for client in RedisUtils.__CLIENTS.values():
+                client.connection_pool.disconnect()
+            RedisUtils.__CLIENTS.clear()
@@ -1,11 +1,14 @@
 #!flask/bin/python
 # -*- coding: utf-8 -*-
 
-"""Start the Flask server."""
+"""Start the Flask development server. Use 'serve.py' in production."""
 
 
 import sys
-from os import path
+from os import environ, path
+
+# Development mode: debug toolbar
+environ.setdefault("BAMBOO_API_DEBUG", "1")
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 from app import APP
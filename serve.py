@@ -0,0 +1,83 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Start the API on the production WSGI server (gunicorn): several worker processes with several threads each.
+
+The settings come from the [wsgi] section of 'config/config.txt' and can be overridden from the command line, e.g.:
+    python serve.py -w 4 -t 16 --keepalive 10
+"""
+
+
+import argparse
+import multiprocessing
+import sys
+
+from os import path
+
+from gunicorn.app.base import BaseApplication
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from config.default import (WSGI_BACKLOG, WSGI_BIND, WSGI_KEEPALIVE, WSGI_MAX_REQUESTS, WSGI_THREADS, WSGI_TIMEOUT,
+                            WSGI_WORKERS)
+
+
+class WSGIServer(BaseApplication):
+    """Gunicorn application serving the Flask APP."""
+
+    def __init__(self, options=None):
+        """Create the server.
+        :param options: Gunicorn settings [dictionary]
+        """
+        self.options = options or {}
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        from app import APP
+
+        return APP
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Start the API on the production WSGI server.")
+    parser.add_argument('-b', dest='bind', default=WSGI_BIND, help='Address to listen on (host:port or unix:path)!')
+    parser.add_argument('-w', dest='workers', type=int, default=WSGI_WORKERS,
+                        help='Worker processes (0: 2 x CPUs + 1)!')
+    parser.add_argument('-t', dest='threads', type=int, default=WSGI_THREADS, help='Threads per worker process!')
+    parser.add_argument('--keepalive', dest='keepalive', type=int, default=WSGI_KEEPALIVE,
+                        help='Seconds to keep idle client connections open!')
+    parser.add_argument('--backlog', dest='backlog', type=int, default=WSGI_BACKLOG,
+                        help='Maximum number of pending connections!')
+    parser.add_argument('--timeout', dest='timeout', type=int, default=WSGI_TIMEOUT,
+                        help='Seconds before a silent worker is restarted!')
+    parser.add_argument('--max-requests', dest='max_requests', type=int, default=WSGI_MAX_REQUESTS,
+                        help='Requests before a worker is recycled (0: never)!')
+    args = parser.parse_args()
+
+    WSGIServer(options={
+        'bind': args.bind,
+        'workers': args.workers or multiprocessing.cpu_count() * 2 + 1,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'keepalive': args.keepalive,
+        'backlog': args.backlog,
+        'timeout': args.timeout,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        # Each worker process imports the APP itself and so gets its own Redis connection pool
+        'preload_app': False
+    }).run()
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
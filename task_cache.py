@@ -0,0 +1,239 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Task cache module:
+In-process cache of the tasks read by the API ('/get_product_info'), so the IDs polled by many clients are served from
+memory instead of Redis.
+
+The writers publish the ID of every task they write or erase (see 'TaskRecord.save'); each API process listens and
+drops its copy. The cache only answers while it is subscribed: when the subscription is lost, the notifications may
+have been missed, so it is emptied and bypassed until it is subscribed again. The time to live bounds how long an
+entry can outlive a missed notification.
+"""
+
+
+import os
+import sys
+import threading
+
+from collections import OrderedDict
+from os import path
+from time import monotonic
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from metrics import REGISTRY
+from task_record import TASK_UPDATES_CHANNEL, TaskRecord
+
+
+CACHE_REQUESTS = REGISTRY.counter('task_cache_requests_total', "Reads of the task cache, by result.", ('result',))
+CACHE_ENTRIES = REGISTRY.gauge('task_cache_entries', "Tasks held by the task cache.")
+CACHE_INVALIDATIONS = REGISTRY.counter('task_cache_invalidations_total', "Tasks dropped on a notification.")
+
+
+class TaskStatusCache(object):
+    """LRU cache of task records, with a time to live, invalidated by the notifications of the writers."""
+
+    # Seconds to wait for a notification before checking the stop flag; between two subscription attempts
+    POLL_INTERVAL = 1.0
+    RETRY_INTERVAL = 5.0
+
+    def __init__(self, redis_client=None, max_entries=10000, ttl=30.0):
+        """Create the cache instance object.
+        :param redis_client: Redis client used to subscribe to the notifications [StrictRedis]
+        :param max_entries: Maximum number of tasks kept, the least recently used are dropped first [int]
+        :param ttl: Seconds a task is kept [float]
+        """
+        self.__redis_client = redis_client
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+
+        # {task_id: (expire time, record)}, least recently used first
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+        # Bumped on every invalidation: a task read from Redis is only cached if none happened during the read
+        self.__generation = 0
+
+        self.__subscribed = False
+        self.__listener = None
+        self.__listener_pid = None
+        self.__stop = threading.Event()
+
+    @property
+    def redis_client(self):
+        """Get the Redis client."""
+        return self.__redis_client
+
+    @property
+    def max_entries(self):
+        """Get the maximum number of tasks kept."""
+        return self.__max_entries
+
+    @property
+    def ttl(self):
+        """Get the time to live of a task."""
+        return self.__ttl
+
+    @property
+    def subscribed(self):
+        """Whether the cache receives the notifications, i.e. answers."""
+        return self.__subscribed
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, task_id=None):
+        """Get a cached task.
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :return: The record, None on miss [TaskRecord]
+        """
+
+        self.start()
+        if not self.__subscribed:
+            CACHE_REQUESTS.inc(result="bypass")
+            return None
+
+        with self.__lock:
+            entry = self.__entries.get(task_id)
+            if entry is not None and entry[0] > monotonic():
+                self.__entries.move_to_end(task_id)
+                CACHE_REQUESTS.inc(result="hit")
+                return entry[1]
+            if entry is not None:
+                del self.__entries[task_id]
+
+        CACHE_REQUESTS.inc(result="miss")
+        return None
+
+    def put(self, record=None, generation=None):
+        """Cache a task read from Redis.
+        :param record: The record [TaskRecord]
+        :param generation: The 'generation' taken before the task was read [int]
+        """
+
+        with self.__lock:
+            # An invalidation during the read may be about this task: the record may already be outdated
+            if not self.__subscribed or generation != self.__generation:
+                return
+
+            self.__entries[record.task_id] = (monotonic() + self.ttl, record)
+            self.__entries.move_to_end(record.task_id)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+            CACHE_ENTRIES.set(len(self.__entries))
+
+    @property
+    def generation(self):
+        """Get the number of invalidations so far."""
+        return self.__generation
+
+    def invalidate(self, task_id=None):
+        """Drop a task, or every task.
+        :param task_id: Object ID in Redis (SHA512), None for every task [string]
+        """
+
+        with self.__lock:
+            self.__generation += 1
+            if task_id is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(task_id, None)
+
+            CACHE_ENTRIES.set(len(self.__entries))
+
+    def load(self, redis_client=None, task_id=None):
+        """Get a task from the cache, else from Redis (see 'TaskRecord.load') and cache it.
+        :param redis_client: Redis client returning bytes [StrictRedis]
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :return: The record, None if the task does not exist [TaskRecord]
+        """
+
+        record = self.get(task_id=task_id)
+        if record is not None:
+            return record
+
+        generation = self.generation
+        record = TaskRecord.load(redis_client=redis_client, task_id=task_id)
+        if record is not None:
+            self.put(record=record, generation=generation)
+
+        return record
+
+    def load_revision(self, redis_client=None, task_id=None):
+        """Get the revision of a task from the cache, else from Redis (see 'TaskRecord.load_revision').
+        :param redis_client: Redis client [StrictRedis]
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :return: The revision, None if unknown [int]
+        """
+
+        record = self.get(task_id=task_id)
+        if record is not None:
+            return record.revision
+
+        return TaskRecord.load_revision(redis_client=redis_client, task_id=task_id)
+
+    def start(self):
+        """Start listening to the notifications, once per process (the thread does not survive a fork)."""
+
+        if self.__listener_pid == os.getpid():
+            return
+
+        with self.__lock:
+            if self.__listener_pid == os.getpid():
+                return
+
+            self.__subscribed = False
+            self.__entries.clear()
+            self.__stop.clear()
+            self.__listener = threading.Thread(target=self.__listen, name="task-cache-listener", daemon=True)
+            self.__listener_pid = os.getpid()
+            self.__listener.start()
+
+    def stop(self):
+        """Stop listening; the cache is bypassed from then on."""
+
+        self.__stop.set()
+        if self.__listener is not None:
+            self.__listener.join()
+
+    def __set_subscribed(self, subscribed=False):
+        with self.__lock:
+            self.__subscribed = subscribed
+            self.__generation += 1
+            self.__entries.clear()
+
+            CACHE_ENTRIES.set(0)
+
+    def __listen(self):
+        while not self.__stop.is_set():
+            pubsub = None
+            try:
+                pubsub = self.redis_client.pubsub()
+                pubsub.subscribe(TASK_UPDATES_CHANNEL)
+
+                while not self.__stop.is_set():
+                    message = pubsub.get_message(timeout=self.POLL_INTERVAL)
+                    if not message:
+                        continue
+
+                    if message['type'] == 'subscribe':
+                        # Nothing was cached while not subscribed: the cache starts empty
+                        self.__set_subscribed(subscribed=True)
+                    elif message['type'] == 'message':
+                        task_id = message['data']
+                        self.invalidate(task_id=task_id.decode() if isinstance(task_id, bytes) else task_id)
+                        CACHE_INVALIDATIONS.inc()
+            except Exception as err:
+                print("Error when listening to the task notifications: {err}".format(err=err))
+            finally:
+                # Notifications may be missed until subscribed again
+                self.__set_subscribed(subscribed=False)
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+            self.__stop.wait(self.RETRY_INTERVAL)
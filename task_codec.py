@@ -0,0 +1,227 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Task codec module:
+Encoding of the tasks stored in Redis.
+
+Compact format (version 1):
+    byte 0      format version (0x01; a legacy JSON task starts with '{')
+    byte 1      flags: 0x01 body is msgpack (else compact JSON), 0x02 body is zlib compressed
+    bytes 2..   body: the task with its field names replaced by the short ids of FIELD_IDS
+
+msgpack is used when the optional 'msgpack' package is installed. The body is compressed when it is larger than the
+'compress_threshold' of the [task_encoding] config section. The readers accept both formats, so the tasks written
+before the switch (legacy JSON) are read as before and re-encoded on their next update.
+
+Examples:
+    python task_codec.py -r        Report the bytes saved by the compact format on the tasks of the DB
+"""
+
+
+import argparse
+import sys
+import zlib
+
+from json import dumps
+from os import path
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from config import default as config
+from json_utils import JsonUtils
+
+
+FORMAT_VERSION = 1
+
+FLAG_MSGPACK = 0x01
+FLAG_ZLIB = 0x02
+
+# Short ids of the task fields. NEVER change or reuse an id: only append new fields
+FIELD_IDS = {
+    'status': 0,
+    'product_name': 1,
+    'bamboo_server': 2,
+    'bamboo_main_plan_url': 3,
+    'bamboo_state': 4,
+    'bamboo_wait_for_plan_to_finish': 5,
+    'bamboo_artifact_on_stage': 6,
+    'bamboo_artifact_names': 7,
+    'request_options': 8,
+    'start_build_retries': 9,
+    'stop_build_retries': 10,
+    'insert_time': 11,
+    'bamboo_build_key_api': 12,
+    'bamboo_build_result_key': 13,
+    'bamboo_build_url': 14,
+    'build_start_time': 15,
+    'build_stop_time': 16,
+    'post_operation': 17,
+    'artifacts': 18,
+    'timeline': 19,
+    'next_attempt_time': 20,
+    'attempt_failures': 21,
+    'priority': 22
+}
+
+# The JSON body has string keys only: both are accepted when decoding
+FIELD_NAMES = dict([(field_id, name) for name, field_id in FIELD_IDS.items()])
+FIELD_NAMES.update([(str(field_id), name) for name, field_id in FIELD_IDS.items()])
+
+
+class TaskCodec(object):
+    """Encodes and decodes the tasks stored in Redis."""
+
+    @staticmethod
+    def encode(task_values=None, encoding=None):
+        """Encode a task.
+        :param task_values: The task [dictionary]
+        :param encoding: 'compact' or 'json', defaults to the 'format' of the [task_encoding] config section [string]
+        :return: Compact encoding or legacy JSON [bytes]
+        """
+
+        if (encoding or config.TASK_ENCODING) == 'json':
+            return JsonUtils.dumps(task_values)
+
+        flags = 0
+        if msgpack is not None:
+            flags |= FLAG_MSGPACK
+            body = msgpack.packb({FIELD_IDS.get(name, name): value for name, value in task_values.items()},
+                                 use_bin_type=True)
+        else:
+            body = JsonUtils.dumps({str(FIELD_IDS[name]) if name in FIELD_IDS else name: value
+                                    for name, value in task_values.items()})
+
+        if len(body) > config.TASK_COMPRESS_THRESHOLD > 0:
+            compressed_body = zlib.compress(body, 6)
+            # Small or random bodies may not shrink
+            if len(compressed_body) < len(body):
+                flags |= FLAG_ZLIB
+                body = compressed_body
+
+        return bytes((FORMAT_VERSION, flags)) + body
+
+    @staticmethod
+    def decode(task_data=None):
+        """Decode a task, in the compact format or in legacy JSON.
+        :param task_data: The task as stored [bytes or string]
+        :return: The task [dictionary]
+        """
+
+        if isinstance(task_data, str):
+            return JsonUtils.loads(task_data)
+
+        if task_data[:1] != bytes((FORMAT_VERSION,)):
+            # Legacy JSON
+            return JsonUtils.loads(task_data)
+
+        flags = task_data[1]
+        body = task_data[2:]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+
+        if flags & FLAG_MSGPACK:
+            if msgpack is None:
+                raise ValueError("The task is encoded with msgpack, please install the 'msgpack' package!")
+            task_values = msgpack.unpackb(body, raw=False, strict_map_key=False)
+        else:
+            task_values = JsonUtils.loads(body)
+
+        return {FIELD_NAMES.get(field_id, field_id): value for field_id, value in task_values.items()}
+
+    @staticmethod
+    def to_json(task_data=None):
+        """Get a task as JSON, without decoding it when it is stored as JSON.
+        :param task_data: The task as stored [bytes or string]
+        :return: JSON [bytes]
+        """
+
+        if isinstance(task_data, str):
+            return task_data.encode()
+        if task_data[:1] != bytes((FORMAT_VERSION,)):
+            return task_data
+        return JsonUtils.dumps(TaskCodec.decode(task_data))
+
+
+class EncodingReport(object):
+    """Size of the tasks of the DB: as stored, as legacy JSON and in the compact format, per status."""
+
+    def __init__(self, redis_client=None, batch_size=500):
+        """Create the EncodingReport instance object.
+        :param redis_client: Redis client returning bytes [StrictRedis]
+        :param batch_size: Keys per SCAN call and per pipeline [int]
+        """
+        self.__redis_client = redis_client
+        self.__batch_size = batch_size
+
+    @property
+    def redis_client(self):
+        """Get the Redis client."""
+        return self.__redis_client
+
+    def report(self):
+        """Measure the tasks.
+        :return: {status: {tasks, stored_bytes, json_bytes, compact_bytes, saved_bytes, saved_ratio}} [dictionary]
+        """
+
+        # Imported here: 'utils' imports this module
+        from utils import TaskDump
+
+        task_dump = TaskDump(redis_client=self.redis_client, batch_size=self.__batch_size)
+
+        report = dict()
+        for _, task_data in task_dump.entries(parse=False):
+            task_values = TaskCodec.decode(task_data)
+            status_report = report.setdefault(task_values.get('status') or "UNKNOWN", {
+                'tasks': 0, 'stored_bytes': 0, 'json_bytes': 0, 'compact_bytes': 0
+            })
+
+            status_report['tasks'] += 1
+            status_report['stored_bytes'] += len(task_data)
+            status_report['json_bytes'] += len(JsonUtils.dumps(task_values))
+            status_report['compact_bytes'] += len(TaskCodec.encode(task_values, encoding='compact'))
+
+        if report:
+            report['ALL'] = {
+                field: sum(status_report[field] for status_report in report.values())
+                for field in ('tasks', 'stored_bytes', 'json_bytes', 'compact_bytes')
+            }
+
+        for status_report in report.values():
+            status_report['saved_bytes'] = status_report['json_bytes'] - status_report['compact_bytes']
+            status_report['saved_ratio'] = round(status_report['saved_bytes'] / status_report['json_bytes'], 4) \
+                if status_report['json_bytes'] else 0.0
+
+        return report
+
+
+def main():
+    """The main function."""
+
+    parser = argparse.ArgumentParser(description="Report the bytes saved by the compact encoding of the tasks.")
+    parser.add_argument('-r', dest='report', action='store_true', help='Measure the tasks of the Redis DB!')
+    args = parser.parse_args()
+
+    if args.report:
+        from redis_utils import RedisUtils
+
+        print(dumps(EncodingReport(redis_client=RedisUtils.client(raw=True)).report(), indent=4))
+    else:
+        print("\nEncoding: {0}, msgpack: {1}, compression above {2} bytes\n".format(
+            config.TASK_ENCODING, "yes" if msgpack is not None else "no (not installed)",
+            config.TASK_COMPRESS_THRESHOLD
+        ))
+
+    sys.exit(0)
+
+
+####################################################################################################
+# Standard boilerplate to call the main() function to begin the program.
+# This only runs if the module was *not* imported.
+#
+if __name__ == '__main__':
+    main()
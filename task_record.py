@@ -0,0 +1,155 @@
+#!/usr/bin/python -tt
+# -*- coding: utf-8 -*-
+
+"""Task record module:
+The task stored in Redis, as used by the API and the worker: one slot per field instead of a dictionary, decoded once
+when read and encoded once when written.
+
+Every write bumps the revision of the task, kept next to it (same Redis Cluster slot): the API uses it as the ETag of
+the task status. Every write or erase is also notified on TASK_UPDATES_CHANNEL (see 'task_cache').
+"""
+
+
+import sys
+
+from os import path
+
+# Add custom libs
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from task_codec import FIELD_IDS, TaskCodec
+from utils import RedisKeyUtils
+
+
+# Every field known by the codec, in the order of their ids
+TASK_FIELDS = tuple(sorted(FIELD_IDS, key=FIELD_IDS.get))
+
+# Pub/sub channel receiving the ID of every task written or erased
+TASK_UPDATES_CHANNEL = RedisKeyUtils.internal_key("task_updates")
+
+
+class TaskRecord(object):
+    """A task of the Redis DB.
+
+    The known fields are attributes (None when not set); the unknown ones (e.g.: written by a newer version) are
+    kept in 'extra' so they are written back unchanged. 'revision' is not stored in the task but next to it.
+    """
+
+    __slots__ = ('task_id', 'extra', 'revision') + TASK_FIELDS
+
+    def __init__(self, task_id=None, **values):
+        """Create the task record.
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :param values: Fields of the task
+        """
+
+        self.task_id = task_id
+        self.revision = None
+        for name in TASK_FIELDS:
+            setattr(self, name, values.pop(name, None))
+        self.extra = values
+
+    @staticmethod
+    def decode(task_id=None, task_data=None):
+        """Build the record of a task read from Redis.
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :param task_data: The task as stored, compact or legacy JSON [bytes or string]
+        :return: The record [TaskRecord]
+        """
+        return TaskRecord(task_id=task_id, **TaskCodec.decode(task_data))
+
+    @staticmethod
+    def revision_key(task_id=None):
+        """Compound the name of the key holding the revision of a task.
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :return: Key name [string]
+        """
+        return RedisKeyUtils.task_key(task_id, "revision")
+
+    @staticmethod
+    def load(redis_client=None, task_id=None):
+        """Read a task and its revision, in one round trip.
+        :param redis_client: Redis client returning bytes [StrictRedis]
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :return: The record, None if the task does not exist [TaskRecord]
+        """
+
+        task_data, revision = redis_client.mget(task_id, TaskRecord.revision_key(task_id))
+        if not task_data:
+            return None
+
+        record = TaskRecord.decode(task_id=task_id, task_data=task_data)
+        record.revision = int(revision) if revision is not None else None
+
+        return record
+
+    @staticmethod
+    def load_revision(redis_client=None, task_id=None):
+        """Read the revision of a task, without the task.
+        :param redis_client: Redis client [StrictRedis]
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :return: The revision, None for the tasks not written since the revisions exist [int]
+        """
+
+        revision = redis_client.get(TaskRecord.revision_key(task_id))
+        return int(revision) if revision is not None else None
+
+    def save(self, redis_client=None):
+        """Write the task, bump its revision and notify it, in one round trip.
+        :param redis_client: Redis client [StrictRedis]
+        :return: The new revision [int]
+        """
+
+        # Not a transaction (not available on Redis Cluster): the revision is bumped after the write, so a reader may
+        # get the new task with the old revision (one more full response) but never the old task with the new revision
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.set(self.task_id, self.encode())
+        pipeline.incr(self.revision_key(self.task_id))
+        pipeline.publish(TASK_UPDATES_CHANNEL, self.task_id)
+        _, self.revision, _ = pipeline.execute()
+
+        return self.revision
+
+    def erase(self, redis_client=None):
+        """Delete the task and its revision, and notify it.
+        :param redis_client: Redis client [StrictRedis]
+        """
+
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.delete(self.task_id, self.revision_key(self.task_id))
+        pipeline.publish(TASK_UPDATES_CHANNEL, self.task_id)
+        pipeline.execute()
+
+    def encode(self):
+        """Encode the task to be written to Redis (see 'TaskCodec.encode').
+        :return: Compact encoding [bytes] or legacy JSON [string]
+        """
+        return TaskCodec.encode(self.to_dict())
+
+    def to_dict(self):
+        """Get the fields which are set.
+        :return: {field: value} [dictionary]
+        """
+
+        task_values = {name: getattr(self, name) for name in TASK_FIELDS if getattr(self, name) is not None}
+        task_values.update(self.extra)
+
+        return task_values
+
+    def copy(self):
+        """Copy the record; the timeline, updated in place by the worker, is copied too.
+        :return: The copy [TaskRecord]
+        """
+
+        record = TaskRecord.__new__(TaskRecord)
+        for name in self.__slots__:
+            setattr(record, name, getattr(self, name))
+        record.extra = dict(self.extra)
+        if self.timeline is not None:
+            record.timeline = dict(self.timeline)
+
+        return record
+
+    @property
+    def plan_key(self):
+        """Get the key of the Bamboo plan, from the plan URL (e.g.: https://bamboo.com/browse/ABC-XYZ => ABC-XYZ)."""
+        return (self.bamboo_main_plan_url or "").split("/")[-1]
@@ -7,47 +7,85 @@ Takes the tasks from the Redis DB and starts to consume them. Also, it updates t
 
 
 import argparse
-import redis
+import cProfile
+import pstats
 import sys
+import threading
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime
 from decimal import Decimal, ROUND_DOWN
-from json import loads, dumps
-from os import path, sep
+from json import dumps
+from os import makedirs, path, sep
 from time import sleep, time
 from urllib.parse import urlparse
 
 # Add custom libs
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from artifact_cache import ArtifactManifestCache
 from bamboo_api import BambooAPI
-from config.default import REDIS_HOST, REDIS_PASS, REDIS_PORT
-from utils import FileUtils, LoggingUtils
+from config import default as config
+from metrics import REGISTRY, WORKER_METRICS_KEY, WORKER_METRICS_TTL
+from task_record import TaskRecord
+from utils import BackoffUtils, BufferedLogWriter, LatencyStats, TaskDump
 
 
 LOGS = dict()
 
+SWEEP_DURATION = REGISTRY.histogram('sweep_duration_seconds', "Duration of the sweeps over all the tasks.",
+                                    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+TASKS_PER_STATE = REGISTRY.gauge('tasks', "Tasks found in the last sweep, by state.", ('state',))
+TASK_RETRIES = REGISTRY.counter('task_retries_total', "Retries requested by the task processing.", ('bamboo_status',))
+SERVER_SWEEP_DURATION = REGISTRY.histogram('sweep_server_duration_seconds',
+                                           "Time spent on the tasks of a Bamboo server in a sweep.", ('server',),
+                                           buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0))
+TASKS_DEFERRED = REGISTRY.counter('tasks_deferred_total', "Tasks not processed in a sweep, by reason.", ('reason',))
+
+# Result of the processing of a task
+Response = namedtuple('Response', "code data")
+
 
 class RedisCommunication(object):
     """Redis server communication data."""
 
-    CLIENT = redis.StrictRedis(host=REDIS_HOST,
-                               port=REDIS_PORT,
-                               db=0,
-                               password=REDIS_PASS,
-                               socket_timeout=None,
-                               connection_pool=None,
-                               charset='utf-8',
-                               errors='strict',
-                               unix_socket_path=None,
-                               decode_responses=True)
+    # Built on first use: the clients shared by the process (see 'redis_utils'), unless replaced (e.g.: benchmarks)
+    CLIENT = None
+    # Returns bytes: used for the tasks (see 'task_codec')
+    RAW_CLIENT = None
+
+    @staticmethod
+    def client(raw=False):
+        """Get a Redis client used by the worker.
+        :param raw: Client returning bytes instead of strings [bool]
+        """
+
+        if (RedisCommunication.RAW_CLIENT if raw else RedisCommunication.CLIENT) is None:
+            # Imported here: the redis package is only loaded when a client is needed
+            from redis_utils import RedisUtils
+
+            if raw:
+                RedisCommunication.RAW_CLIENT = RedisUtils.client(raw=True)
+            else:
+                RedisCommunication.CLIENT = RedisUtils.client()
+
+        return RedisCommunication.RAW_CLIENT if raw else RedisCommunication.CLIENT
+
+    @staticmethod
+    def observe_pool_stats():
+        """Publish the utilisation of the shared connection pool in the metrics."""
+
+        from redis_utils import RedisUtils
+
+        RedisUtils.observe_pool_stats()
 
 
 class BambooUtils(BambooAPI):
     """Bamboo utils class used to interact with Bamboo API from 'bamboo_api' module."""
 
-    def __init__(self, verbose=False, bamboo_server=None):
-        super().__init__(verbose=verbose, bamboo_server=bamboo_server)
+    def __init__(self, verbose=False, bamboo_server=None, manifest_cache=None, **bamboo_api_options):
+        super().__init__(verbose=verbose, bamboo_server=bamboo_server, **bamboo_api_options)
 
         if verbose:
             BambooAPI.verbose.fset(self, verbose)
@@ -55,6 +93,8 @@ class BambooUtils(BambooAPI):
         if bamboo_server:
             BambooAPI.bamboo_server.fset(self, bamboo_server)
 
+        self.manifest_cache = manifest_cache
+
     ###########################################################################################
     def trigger_bamboo_plan(self, values=None):
         """Trigger specific Bamboo plan using custom plan options.
@@ -106,6 +146,24 @@ class BambooUtils(BambooAPI):
 
         return response
 
+    ###########################################################################################
+    def get_queue_depth(self, bamboo_server=None):
+        """Get the number of builds waiting in the queue of a Bamboo server.
+        :param bamboo_server: Bamboo server used in API call (e.g.:<bamboo1/bamboo2>) [string]
+        :return: Number of queued builds [int]
+        :raise: Exception, ValueError on errors
+        """
+
+        build_queue = self.query_build_queue(bamboo_server=bamboo_server or self.bamboo_server)
+
+        response_status_code = build_queue.get('status_code')
+        if response_status_code != 200:
+            raise ValueError("status_code: {status_code}\n{content}".format(status_code=response_status_code,
+                                                                            content=build_queue.get('content')))
+
+        # E.g.: {'queuedBuilds': {'size': 2, 'queuedBuild': [...]}}
+        return int(build_queue['content']['queuedBuilds']['size'])
+
     ###########################################################################################
     def get_plan_status(self, bamboo_server=None, plan_key=None):
         """Get the status of a specific Bamboo plan.
@@ -156,6 +214,7 @@ class BambooUtils(BambooAPI):
 
         # Get returned content
         response_content = query_plan.get('content', {})
+        response['build_completed_time'] = response_content.get('buildCompletedTime')
         finished_status = response_content.get('finished')
         life_cycle = response_content.get('lifeCycleState')
         success_flag = response_content.get('successful')
@@ -220,6 +279,86 @@ class BambooUtils(BambooAPI):
 
         return response
 
+    ###########################################################################################
+    @staticmethod
+    def parse_bamboo_time(bamboo_time=None):
+        """Parse a timestamp returned by Bamboo API (e.g.: 2019-08-06T14:02:44.950+03:00).
+        :param bamboo_time: Timestamp as returned by Bamboo [string]
+        :return: Epoch timestamp [float], None if it can not be parsed
+        """
+
+        if not bamboo_time:
+            return None
+
+        try:
+            return datetime.fromisoformat(bamboo_time).timestamp()
+        except ValueError:
+            pass
+
+        try:
+            return datetime.strptime(bamboo_time, "%Y-%m-%dT%H:%M:%S.%f%z").timestamp()
+        except ValueError:
+            return None
+
+    ###########################################################################################
+    def query_artifact_manifest(self, bamboo_server=None, plan_key=None, job_name=None, artifact_name=None,
+                                url_extra_values=None):
+        """Get the artifacts of a Bamboo plan run job from the manifest cache, else query Bamboo and cache them.
+        :param bamboo_server: Bamboo server used in API call (e.g.:<bamboo1/bamboo2>) [string]
+        :param plan_key: Key of the Bamboo plan [string]
+        :param job_name: Bamboo job name [string]
+        :param artifact_name: Name of the artifact as in Bamboo plan stage job [string]
+        :param url_extra_values: Extra values to compound the URL [string]
+        :return: The response of 'query_job_for_artifacts', or the cached manifest [dict]
+        """
+
+        # Custom URLs are not cached
+        cached = self.manifest_cache and not url_extra_values
+        if cached:
+            manifest = self.manifest_cache.get(bamboo_server=bamboo_server, plan_key=plan_key,
+                                               job_name=job_name, artifact_name=artifact_name)
+            if manifest is not None:
+                return dict(manifest, response=True)
+
+        artifacts = self.query_job_for_artifacts(bamboo_server=bamboo_server,
+                                                 plan_key=plan_key,
+                                                 query_type="query_for_artifacts",
+                                                 job_name=job_name,
+                                                 artifact_names=(artifact_name,),
+                                                 url_extra_values=url_extra_values)
+
+        # Only a successful listing is cached: a failed one may succeed on the next attempt
+        if cached and artifacts.get('status_code') == 200:
+            self.manifest_cache.set(bamboo_server=bamboo_server, plan_key=plan_key, job_name=job_name,
+                                    artifact_name=artifact_name, artifacts=artifacts.get('artifacts', []),
+                                    artifacts_links=artifacts.get('artifacts_links', []))
+
+        return artifacts
+
+    @staticmethod
+    def print_artifacts_error(artifacts=None, plan_key=None, job_name=None):
+        """Print the error of a failed query for artifacts.
+        :param artifacts: The response of 'query_job_for_artifacts' [dict]
+        :param plan_key: Key of the Bamboo plan [string]
+        :param job_name: Bamboo job name [string]
+        """
+
+        if artifacts.get('response') is None:
+            print(
+                "Error when trying to query plan for artifacts"
+                "\nMethod returned: {0}\n".format(artifacts.get('content'))
+            )
+        else:
+            print(
+                "Error when trying to query plan for artifacts"
+                "\nURL: {0}"
+                "\nPlan_key: {1}"
+                "\nStage_name: {2}"
+                "\nResponse content: {3}\n".format(
+                    artifacts.get('url'), plan_key, job_name, artifacts.get('content')
+                )
+            )
+
     ###########################################################################################
     def query_for_artifacts(self, bamboo_server=None, plan_key=None, job_name=None, artifact_names=None,
                             url_extra_values=None):
@@ -247,42 +386,27 @@ class BambooUtils(BambooAPI):
         if not bamboo_server:
             bamboo_server = self.bamboo_server
 
-        try:
-            artifacts = self.query_job_for_artifacts(bamboo_server=bamboo_server,
-                                                     plan_key=plan_key,
-                                                     query_type="query_for_artifacts",
-                                                     job_name=job_name,
-                                                     artifact_names=artifact_names,
-                                                     url_extra_values=url_extra_values)
-        except Exception as err:
-            response['response'] = False
-            response['content'] = err
-            return response
-
-        if artifacts.get('response') is None:
-            if self.verbose:
-                print(
-                    "Error when trying to query plan for artifacts"
-                    "\nMethod returned: {0}\n".format(artifacts.get('content'))
-                )
+        artifacts_list = list()
+        artifacts_links = list()
+        for artifact_name in artifact_names:
+            try:
+                artifacts = self.query_artifact_manifest(bamboo_server=bamboo_server, plan_key=plan_key,
+                                                         job_name=job_name, artifact_name=artifact_name,
+                                                         url_extra_values=url_extra_values)
+            except Exception as err:
+                response['response'] = False
+                response['content'] = err
+                return response
 
-            response['response'] = False
-            return response
+            if not artifacts.get('response'):
+                if self.verbose:
+                    self.print_artifacts_error(artifacts=artifacts, plan_key=plan_key, job_name=job_name)
 
-        if artifacts.get('response') is False:
-            if self.verbose:
-                print(
-                    "Error when trying to query plan for artifacts"
-                    "\nURL: {0}"
-                    "\nPlan_key: {1}"
-                    "\nStage_name: {2}"
-                    "\nResponse content: {3}\n".format(
-                        artifacts.get('url'), plan_key, job_name, artifacts.get('content')
-                    )
-                )
+                response['response'] = False
+                return response
 
-            response['response'] = False
-            return response
+            artifacts_list.extend(artifacts.get('artifacts', []))
+            artifacts_links.extend(artifacts.get('artifacts_links', []))
 
         if self.verbose:
             print(
@@ -292,8 +416,8 @@ class BambooUtils(BambooAPI):
             )
 
         response['response'] = True
-        response['artifacts'] = artifacts.get('artifacts', [])
-        response['artifacts_links'] = artifacts.get('artifacts_links', [])
+        response['artifacts'] = artifacts_list
+        response['artifacts_links'] = artifacts_links
 
         return response
 
@@ -301,60 +425,141 @@ class BambooUtils(BambooAPI):
 class TasksProcessingUnit(BambooUtils):
     """Tasks processing unit for all tasks found in Redis backend"""
 
-    def __init__(self, bamboo_server=None, path_to_parent_dir=None, verbose=False):
+    def __init__(self, bamboo_server=None, path_to_parent_dir=None, verbose=False, profile=False,
+                 admission_control=None, **bamboo_api_options):
         """Create the TPU instance object using custom config.
         :param bamboo_server: Bamboo server name [string]
         :param path_to_parent_dir: Full path to the dir containing the logs [string]
         :param verbose: True/False [boolean]
+        :param profile: Profile every sweep with cProfile, the stats go to 'logs/profiles' [boolean]
+        :param admission_control: Holds the new tasks while the Bamboo queue is full, from the config if None, False
+        disables it [AdmissionControl]
+        :param bamboo_api_options: Extra BambooAPI options (e.g.: url_scheme, artifacts_domain)
         """
-        super().__init__(bamboo_server=bamboo_server, verbose=verbose)
+        super().__init__(bamboo_server=bamboo_server, verbose=verbose,
+                         manifest_cache=ArtifactManifestCache(redis_client=RedisCommunication.client(),
+                                                              ttl=config.ARTIFACTS_MANIFEST_TTL),
+                         **bamboo_api_options)
 
         self.bamboo_server = bamboo_server
-        self.file_utils = FileUtils()
-        self.logging_utils = LoggingUtils(path_to_parent_dir=path_to_parent_dir)
+        self.log_writer = BufferedLogWriter(path_to_parent_dir=path_to_parent_dir)
+        self.latency_stats = LatencyStats(redis_client=RedisCommunication.client())
         self.verbose = verbose
 
+        self.profile_dir = path.join(path_to_parent_dir, "logs", "profiles") if profile else None
+        self.sweep_id = 0
+
+        self.admission_control = config.ADMISSION_CONTROL if admission_control is None else admission_control
+
+        # {bamboo_server: processing unit} (see 'server_unit')
+        self.__server_units = dict()
+        self.__units_lock = threading.Lock()
+
     def write_to_disk_file(self, content=None, log_file_type=None):
         """Write content to corresponding log file type.
         :param content: Content to write on file [string]
-        :param log_file_type: Type of the log file (error/bamboo/misc) [string]
+        :param log_file_type: Type of the log file (errors/bamboo/events/misc) [string]
         """
 
         if not content:
             print("{os_line_sep}No content to write in log file supplied!{os_line_sep}".format(os_line_sep=sep))
             return
 
-        self.file_utils.disk_file = self.logging_utils.logs_paths.get(log_file_type)
-        if not self.file_utils:
+        if log_file_type not in ('bamboo', 'errors', 'events', 'misc'):
             print(
                 "{os_line_sep}Could not get the log file based on log_type option '{log_type}'!{os_line_sep}".format(
                     os_line_sep=sep, log_type=log_file_type)
             )
             return
 
-        self.file_utils.write_to_disk_file(content=content)
+        # Only buffered here: the disk write happens on the log writer thread
+        self.log_writer.write(content=content, log_file_type=log_file_type)
+
+    def log_task_event(self, event=None, task_id=None, task_values=None, **fields):
+        """Write a structured task lifecycle event to the 'events' log.
+        :param event: Name of the event (e.g.: <task_state/task_polled/task_error>) [string]
+        :param task_id: Object ID in Redis (SHA512) [string]
+        :param task_values: The task as found in Redis DB [TaskRecord]
+        :param fields: Extra fields of the event (e.g.: new_state, bamboo_latency)
+        """
+
+        task_values = task_values or TaskRecord()
+        event_fields = {
+            'task_id': task_id,
+            'product': task_values.product_name,
+            'plan_key': task_values.plan_key,
+            'build_result_key': task_values.bamboo_build_result_key,
+            'old_state': task_values.status,
+            'start_build_retries': task_values.start_build_retries,
+            'stop_build_retries': task_values.stop_build_retries
+        }
+        event_fields.update(fields)
+
+        self.log_writer.emit(log_file_type='events', event=event, **event_fields)
+
+    def update_timeline(self, task_values=None, action_label=None, task_processing_data=None):
+        """Add the points reached by a task to its timeline and record the latency of the completed phases.
+        :param task_values: The task, updated in place [TaskRecord]
+        :param action_label: Action returned by the task processing [string]
+        :param task_processing_data: Data returned by the task processing [dictionary]
+        :return: True if the timeline changed
+        """
+
+        if task_values.timeline is None:
+            task_values.timeline = dict()
+        timeline = task_values.timeline
+        timeline.setdefault('inserted', task_values.insert_time)
+
+        current_time = time()
+        new_points = dict()
+        if action_label == 'PLAN_TRIGGERED':
+            new_points['trigger_sent'] = task_processing_data.get('trigger_sent_time')
+            new_points['triggered'] = task_processing_data.get('build_start_time')
+        elif action_label == 'IN_PROGRESS' and 'first_in_progress' not in timeline:
+            new_points['first_in_progress'] = current_time
+        elif action_label == 'FINISHED' and task_values.status == 'IN_PROGRESS':
+            new_points['finish_detected'] = current_time
+            new_points['bamboo_finished'] = task_processing_data.get('bamboo_finished_time')
+            if not task_processing_data.get('post_operation'):
+                new_points['done'] = current_time
+        elif action_label == 'FINISHED' and task_values.status == 'FINISHED':
+            new_points['artifacts_crawled'] = current_time
+            new_points['done'] = current_time
+        elif action_label == 'ERASE':
+            new_points['erased'] = current_time
+
+        new_points = {point: value for point, value in new_points.items() if value is not None}
+        if not new_points:
+            return False
+
+        timeline.update(new_points)
+        self.latency_stats.record(
+            product=task_values.product_name,
+            samples=LatencyStats.timeline_samples(timeline=timeline, end_points=new_points)
+        )
+
+        return True
 
     def process_task(self, value_to_process=None):
         """Check the status of the current task in Redis DB and process the request.
-        :param value_to_process: Values used when processing task [dictionary]
+        :param value_to_process: The task [TaskRecord], or as stored in Redis [bytes or string]
         :return: Status of the task
         """
 
-        Response = namedtuple('Response', "code data")
-
         if not value_to_process:
             return Response(code=None, data="No input data supplied!")
 
-        # Transform returned Redis data type to dict
-        value_to_process = loads(value_to_process)
+        # Transform returned Redis data type to a task record
+        if not isinstance(value_to_process, TaskRecord):
+            value_to_process = TaskRecord.decode(task_data=value_to_process)
 
         # Get Bamboo server name
-        bamboo_server = value_to_process.get('bamboo_server')
+        bamboo_server = value_to_process.bamboo_server
         if not bamboo_server:
             return Response(code=False, data="Could not get Bamboo server from DB!")
 
         # Get Bamboo plan key
-        bamboo_plan_key = value_to_process.get('bamboo_main_plan_url', "").split("/")[-1]
+        bamboo_plan_key = value_to_process.plan_key
         if not bamboo_plan_key:
             return Response(code=False, data="Could not get Bamboo plan key from DB!")
 
@@ -362,12 +567,14 @@ class TasksProcessingUnit(BambooUtils):
         current_time_epoch_ts = \
             float(Decimal(str(datetime.now().timestamp())).quantize(Decimal('.00000001'), rounding=ROUND_DOWN))
 
-        build_start_time = value_to_process.get('build_start_time', -1)
+        build_start_time = value_to_process.build_start_time
+        if build_start_time is None:
+            build_start_time = -1
 
         # ------------------------------------------------------------------------------------------------------------ #
-        if value_to_process.get('status') == 'NEW_REQUEST':
-            request_options = value_to_process.get('request_options', {})
-            start_build_retries = value_to_process.get('start_build_retries')
+        if value_to_process.status == 'NEW_REQUEST':
+            request_options = value_to_process.request_options or {}
+            start_build_retries = value_to_process.start_build_retries
 
             bamboo_plan_variables = dict()
             for option_name, option_value in request_options.items():
@@ -379,10 +586,11 @@ class TasksProcessingUnit(BambooUtils):
                 'bamboo_plan_variables': bamboo_plan_variables
             }
 
+            trigger_sent_time = time()
             plan_trigger = self.trigger_bamboo_plan(values=plan_values)
             response_status = plan_trigger.get('response')
             if not response_status:
-                if not start_build_retries:
+                if start_build_retries is None:
                     # Signal to erase the object from Redis DB
                     return Response(code=True, data={
                         'action_label': "ERASE",
@@ -397,7 +605,8 @@ class TasksProcessingUnit(BambooUtils):
                     return Response(code=False, data={
                         'bamboo_status': 'NOT_STARTED',
                         'data': "Could not get start the Bamboo plan! Trying one more time!",
-                        'retry': start_build_retries + 1
+                        'retry': start_build_retries + 1,
+                        'retry_counter': 'start_build_retries'
                     })
 
                 # Signal to erase the object from Redis DB
@@ -411,32 +620,33 @@ class TasksProcessingUnit(BambooUtils):
             response_content = plan_trigger.get('content')
             response_content['action_label'] = "PLAN_TRIGGERED"
             response_content['build_start_time'] = time()
+            response_content['trigger_sent_time'] = trigger_sent_time
 
             return Response(code=True, data=response_content)
         # ------------------------------------------------------------------------------------------------------------ #
-        if value_to_process.get('status') == 'IN_PROGRESS':
+        if value_to_process.status == 'IN_PROGRESS':
             if build_start_time == -1 and self.verbose:
                 print(
                     "Error when trying to get build start time from Redis for Bamboo plan '{0}'!".format(
-                        value_to_process.get('bamboo_build_url'))
+                        value_to_process.bamboo_build_url)
                 )
 
             if (
-                (current_time_epoch_ts - build_start_time) > float(value_to_process.get(
-                    'bamboo_wait_for_plan_to_finish', 0))
+                (current_time_epoch_ts - build_start_time) > float(
+                    value_to_process.bamboo_wait_for_plan_to_finish or 0)
             ):
                 if build_start_time == -1 and not self.verbose:
                     print("Could not get the start-time from DB!")
 
-                stop_build_retries = value_to_process.get('stop_build_retries')
+                stop_build_retries = value_to_process.stop_build_retries
 
                 # Stop current build if it has reached timeout
                 try:
                     stopping_status = self.stop_build(bamboo_server=bamboo_server,
-                                                      plan_key=value_to_process.get('bamboo_build_result_key'),
+                                                      plan_key=value_to_process.bamboo_build_result_key,
                                                       query_type='stop_plan')
                 except Exception as err:
-                    if not stop_build_retries:
+                    if stop_build_retries is None:
                         # Signal to erase the object from Redis DB
                         return Response(code=True, data={
                             'action_label': "ERASE",
@@ -451,7 +661,8 @@ class TasksProcessingUnit(BambooUtils):
                             'bamboo_status': 'NOT_STOPPED',
                             'data': "Could not stop the Bamboo plan! Trying one more time!",
                             'err:': err,
-                            'retry': stop_build_retries + 1
+                            'retry': stop_build_retries + 1,
+                            'retry_counter': 'stop_build_retries'
                         })
 
                     # Signal to erase the object from Redis DB
@@ -467,7 +678,7 @@ class TasksProcessingUnit(BambooUtils):
                     if self.verbose:
                         print(stopping_status.get('content'))
 
-                    if not stop_build_retries:
+                    if stop_build_retries is None:
                         # Signal to erase the object from Redis DB
                         return Response(code=True, data={
                             'action_label': "ERASE",
@@ -481,7 +692,8 @@ class TasksProcessingUnit(BambooUtils):
                             'bamboo_status': 'NOT_STOPPED',
                             'data': "Could not stop the Bamboo plan! Trying one more time!",
                             'err:': stopping_status.get('content'),
-                            'retry': stop_build_retries + 1
+                            'retry': stop_build_retries + 1,
+                            'retry_counter': 'stop_build_retries'
                         })
 
                     # Signal to erase the object from Redis DB
@@ -503,7 +715,7 @@ class TasksProcessingUnit(BambooUtils):
                 )
 
             plan_info = self.get_plan_status(bamboo_server=bamboo_server,
-                                             plan_key=value_to_process.get('bamboo_build_result_key'))
+                                             plan_key=value_to_process.bamboo_build_result_key)
             response = plan_info.get("response")
             if response is None:
                 return Response(code=False, data={'data': plan_info.get("extra_info")})
@@ -520,6 +732,7 @@ class TasksProcessingUnit(BambooUtils):
             if plan_info.get("api_life_cycle_flag") == "NotBuilt":
                 return Response(code=True, data={
                     'action_label': "FINISHED",
+                    'bamboo_finished_time': self.parse_bamboo_time(plan_info.get('build_completed_time')),
                     'bamboo_status': "NotBuilt",
                     'build_stop_time': time(),
                     'data': "Plan did not finished"
@@ -529,6 +742,7 @@ class TasksProcessingUnit(BambooUtils):
             if not plan_info.get("success_flag"):
                 return Response(code=True, data={
                     'action_label': "FINISHED",
+                    'bamboo_finished_time': self.parse_bamboo_time(plan_info.get('build_completed_time')),
                     'bamboo_status': "failed",
                     'build_stop_time': time(),
                     'data': "Plan finished",
@@ -537,6 +751,7 @@ class TasksProcessingUnit(BambooUtils):
 
             return Response(code=True, data={
                 'action_label': "FINISHED",
+                'bamboo_finished_time': self.parse_bamboo_time(plan_info.get('build_completed_time')),
                 'bamboo_status': plan_info.get("api_life_cycle_flag"),
                 'build_stop_time': time(),
                 'data': "Plan finished",
@@ -544,12 +759,13 @@ class TasksProcessingUnit(BambooUtils):
                 'post_operation': True
             })
         # ------------------------------------------------------------------------------------------------------------ #
-        if value_to_process.get('status') == 'FINISHED':
-            build_stop_time = value_to_process.get('build_stop_time', -1)
-            if build_stop_time == -1:
+        if value_to_process.status == 'FINISHED':
+            build_stop_time = value_to_process.build_stop_time
+            if build_stop_time is None:
+                build_stop_time = -1
                 print(
                     "Error when trying to get build stop time for Bamboo plan '{0}'".format(
-                        value_to_process.get('bamboo_build_url'))
+                        value_to_process.bamboo_build_url)
                 )
 
             # Check if finished plan (no matter the result) is > 10 minutes old: if yes, delete the item
@@ -562,20 +778,17 @@ class TasksProcessingUnit(BambooUtils):
                 })
 
             # Failed plan => nothing to download
-            if (
-                value_to_process.get('bamboo_status', "").lower() == 'notbuilt' or
-                value_to_process.get('bamboo_status', "").lower() == 'failed'
-            ):
+            if (value_to_process.bamboo_state or "").lower() in ('notbuilt', 'failed'):
                 return Response(code=True, data={'action_label': "POST_FINISHED_OPS"})
 
-            if value_to_process.get('post_operation'):
+            if value_to_process.post_operation:
                 # Get all artifacts
-                job_name = value_to_process.get('bamboo_artifact_on_stage')
-                artifact_names = tuple(value_to_process.get('bamboo_artifact_names', []))
+                job_name = value_to_process.bamboo_artifact_on_stage
+                artifact_names = tuple(value_to_process.bamboo_artifact_names or [])
 
                 get_list_of_artifacts = self.query_for_artifacts(
                     bamboo_server=bamboo_server,
-                    plan_key=value_to_process.get('bamboo_build_result_key'),
+                    plan_key=value_to_process.bamboo_build_result_key,
                     job_name=job_name,
                     artifact_names=artifact_names
                 )
@@ -606,31 +819,371 @@ class TasksProcessingUnit(BambooUtils):
 
         return Response(code=False, data="NO CASE MATCHED!")
 
+    def process_sweep(self, redis_client=None):
+        """Go once over all the tasks from the Redis DB and process them.
+        :param redis_client: Redis client holding the tasks [redis.StrictRedis]
+        :return: {sweep_id, tasks, states, duration, profile} of the sweep [dictionary]
+        """
+
+        self.sweep_id += 1
+        if not self.profile_dir:
+            sweep_result = self.__sweep(redis_client=redis_client)
+        else:
+            profiler = cProfile.Profile()
+            sweep_result = profiler.runcall(self.__sweep, redis_client=redis_client)
+            sweep_result['profile'] = self.dump_profile(profiler=profiler)
+
+        sweep_result['sweep_id'] = self.sweep_id
+        self.log_writer.emit(log_file_type='events', event='sweep', sweep_id=self.sweep_id, tasks=sweep_result['tasks'],
+                             duration=round(sweep_result['duration'], 6), profile=sweep_result.get('profile'))
+
+        return sweep_result
+
+    def dump_profile(self, profiler=None):
+        """Write the stats of a profiled sweep: '.prof' (for pstats/snakeviz) and '.txt' (top functions).
+        :param profiler: Profiler of the sweep [cProfile.Profile]
+        :return: Path of the '.prof' file [string]
+        """
+
+        makedirs(self.profile_dir, exist_ok=True)
+        profile_path = path.join(self.profile_dir, "sweep_{sweep_id}_{date}.prof".format(
+            sweep_id=self.sweep_id, date=datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        ))
+        profiler.dump_stats(profile_path)
+
+        with open(profile_path[:-len(".prof")] + ".txt", 'w') as file_handle:
+            pstats.Stats(profiler, stream=file_handle).sort_stats('cumulative').print_stats(40)
+
+        return profile_path
+
+    def server_unit(self, bamboo_server=None):
+        """Get the processing unit of a Bamboo server: a copy of this unit sharing its logs, caches, rate limiter and
+        circuit breaker, with its own request state (plan key, job name...) so the servers can be processed in
+        parallel.
+        :param bamboo_server: Bamboo server name [string]
+        :return: The unit [TasksProcessingUnit]
+        """
+
+        if not bamboo_server:
+            return self
+
+        with self.__units_lock:
+            unit = self.__server_units.get(bamboo_server)
+            if unit is None:
+                unit = self.__server_units[bamboo_server] = copy(self)
+                unit.bamboo_server = bamboo_server
+
+        return unit
+
+    def process_server_tasks(self, task_records=None, task_client=None):
+        """Process, one after the other, the tasks of a Bamboo server.
+        :param task_records: The tasks [list of TaskRecord]
+        :param task_client: Redis client returning bytes, used to write the tasks [redis.StrictRedis]
+        """
+
+        with SERVER_SWEEP_DURATION.time(server=self.bamboo_server):
+            if self.admission_control and self.bamboo_server:
+                task_records = self.admit_tasks(task_records=task_records)
+
+            for task_values in task_records:
+                self.process_entry(task_values=task_values, task_client=task_client)
+
+    def admit_tasks(self, task_records=None):
+        """Hold the new tasks of the Bamboo server while its build queue is full (see 'AdmissionControl').
+        :param task_records: The tasks of the server [list of TaskRecord]
+        :return: The tasks to process now: the others first, then the new tasks admitted, by priority [list]
+        """
+
+        current_time = time()
+        new_tasks = list()
+        other_tasks = list()
+        for task_values in task_records:
+            # The tasks waiting for their next attempt are deferred anyway (see 'process_entry')
+            if task_values.status == 'NEW_REQUEST' and (task_values.next_attempt_time or 0) <= current_time:
+                new_tasks.append(task_values)
+            else:
+                other_tasks.append(task_values)
+
+        admitted_tasks, held_tasks = self.admission_control.admit(
+            bamboo_server=self.bamboo_server, task_records=new_tasks,
+            queue_depth=lambda: self.get_queue_depth(bamboo_server=self.bamboo_server)
+        )
+        if held_tasks:
+            TASKS_DEFERRED.inc(len(held_tasks), reason="queue_full")
+
+        return other_tasks + admitted_tasks
+
+    def build_triggered(self):
+        """Count a build triggered in the estimated build queue of the Bamboo server (see 'AdmissionControl')."""
+        if self.admission_control and self.bamboo_server:
+            self.admission_control.triggered(bamboo_server=self.bamboo_server)
+
+    def deferred(self, task_values=None):
+        """Check whether the processing of a task must wait for a later sweep.
+        :param task_values: The task [TaskRecord]
+        :return: True if the task is not processed in this sweep [boolean]
+        """
+
+        # Failed before: waiting for its next attempt
+        if (task_values.next_attempt_time or 0) > time():
+            TASKS_DEFERRED.inc(reason="backoff")
+            return True
+
+        # Its Bamboo server keeps failing: no request until the circuit breaker lets a probe through
+        if self.circuit_breaker and not self.circuit_breaker.allows(bamboo_server=task_values.bamboo_server):
+            TASKS_DEFERRED.inc(reason="circuit_open")
+            return True
+
+        return False
+
+    def retry_later(self, task_values=None, error_data=None, task_client=None, bamboo_latency=None):
+        """Write a task whose processing failed, to be processed again after a backoff delay.
+        :param task_values: The task [TaskRecord]
+        :param error_data: Data of the failed processing [dict/string]
+        :param task_client: Redis client returning bytes, used to write the task [redis.StrictRedis]
+        :param bamboo_latency: Time spent in the task processing, in seconds [float]
+        """
+
+        err_msg = "Error when processing task!\n'{err}'".format(err=error_data)
+        print(err_msg)
+        self.write_to_disk_file(content=err_msg, log_file_type='errors')
+
+        if isinstance(error_data, dict) and error_data.get('retry'):
+            TASK_RETRIES.inc(bamboo_status=error_data.get('bamboo_status'))
+
+        # Keep the retry counter and try again later, later after each consecutive failure
+        failed_task_values = task_values.copy()
+        if isinstance(error_data, dict) and error_data.get('retry_counter'):
+            setattr(failed_task_values, error_data['retry_counter'], error_data.get('retry'))
+        failed_task_values.attempt_failures = (failed_task_values.attempt_failures or 0) + 1
+        failed_task_values.next_attempt_time = time() + BackoffUtils.delay(
+            failures=failed_task_values.attempt_failures, base=config.TASK_RETRY_BACKOFF_BASE,
+            maximum=config.TASK_RETRY_BACKOFF_MAX
+        )
+        failed_task_values.save(redis_client=task_client)
+
+        self.log_task_event(
+            event='task_error', task_id=task_values.task_id, task_values=task_values,
+            bamboo_latency=bamboo_latency,
+            error=error_data.get('data') if isinstance(error_data, dict) else error_data,
+            retry=error_data.get('retry') if isinstance(error_data, dict) else None
+        )
+
+    def finished_task_values(self, task_values=None, task_processing_data=None):
+        """Get the new values of a task whose Bamboo build finished.
+        :param task_values: The task [TaskRecord]
+        :param task_processing_data: Data of the task processing [dict]
+        :return: Updated copy of the task [TaskRecord]
+        """
+
+        updated_task_values = task_values.copy()
+        self.update_timeline(task_values=updated_task_values, action_label='FINISHED',
+                             task_processing_data=task_processing_data)
+
+        updated_task_values.bamboo_state = task_processing_data.get('bamboo_status')
+        updated_task_values.post_operation = task_processing_data.get('post_operation')
+        updated_task_values.artifacts = task_processing_data.get('artifacts')
+        updated_task_values.status = 'FINISHED'
+
+        # Add plan stopped time in DB if action_label == 'FINISHED'
+        build_stop_time = task_processing_data.get('build_stop_time')
+        if build_stop_time:
+            updated_task_values.build_stop_time = task_processing_data.get('build_stop_time')
+
+        return updated_task_values
+
+    def process_entry(self, task_values=None, task_client=None):
+        """Process a task of the Redis DB and write its new state.
+        :param task_values: The task [TaskRecord]
+        :param task_client: Redis client returning bytes, used to write the task [redis.StrictRedis]
+        """
+
+        if self.deferred(task_values=task_values):
+            return
+
+        process_start_time = time()
+        task_processing_status = self.process_task(value_to_process=task_values)
+        # Time spent in the task processing: dominated by the Bamboo requests
+        bamboo_latency = round(time() - process_start_time, 6)
+
+        if not task_processing_status.code:
+            self.retry_later(task_values=task_values, error_data=task_processing_status.data,
+                             task_client=task_client, bamboo_latency=bamboo_latency)
+            return
+
+        # Processed: the past failures are forgotten (written with the update of the task)
+        recovered = task_values.attempt_failures is not None
+        if recovered:
+            task_values.attempt_failures = None
+            task_values.next_attempt_time = None
+
+        task_processing_data = task_processing_status.data
+        action_label = task_processing_data.get('action_label')
+        if action_label == 'IN_PROGRESS' or action_label == 'POST_FINISHED_OPS':
+            # Only the first IN_PROGRESS observation changes the timeline
+            if self.update_timeline(task_values=task_values, action_label=action_label,
+                                    task_processing_data=task_processing_data) or recovered:
+                task_values.save(redis_client=task_client)
+
+            self.log_task_event(
+                event='task_polled', task_id=task_values.task_id, task_values=task_values,
+                new_state=task_values.status, action=action_label,
+                bamboo_status=task_processing_data.get('bamboo_status'), bamboo_latency=bamboo_latency
+            )
+            return
+        elif action_label == 'FINISHED':
+            updated_task_values = self.finished_task_values(task_values=task_values,
+                                                            task_processing_data=task_processing_data)
+
+            # Add to Redis DB
+            updated_task_values.save(redis_client=task_client)
+        elif action_label == 'ERASE':
+            if self.verbose:
+                print(task_processing_data.get('data'))
+
+            # Remove the entry (and its revision) from DB as there is no
+            task_values.erase(redis_client=task_client)
+
+            updated_task_values = task_values.copy()
+            self.update_timeline(task_values=updated_task_values, action_label=action_label,
+                                 task_processing_data=task_processing_data)
+        elif action_label == 'PLAN_TRIGGERED':
+            updated_task_values = task_values.copy()
+            self.update_timeline(task_values=updated_task_values, action_label=action_label,
+                                 task_processing_data=task_processing_data)
+
+            updated_task_values.bamboo_build_key_api = task_processing_status.data.get('build_plan_url', "")
+            updated_task_values.bamboo_build_result_key = task_processing_data.get('build_result_key')
+            updated_task_values.bamboo_state = 'STARTED_IN_PROGRESS'
+            updated_task_values.build_start_time = task_processing_data.get('build_start_time', 0)
+            updated_task_values.status = 'IN_PROGRESS'
+
+            # E.g: https://bamboo.com/rest/api/latest/result/ABC-XYZ-100
+            parsed_uri = urlparse(task_processing_data.get('build_plan_url', ""))
+            browse_url = '{uri.scheme}://{uri.netloc}/'.format(uri=parsed_uri)
+            updated_task_values.bamboo_build_url = "{url}browse/{key}".format(
+                url=browse_url, key=task_processing_data.get('build_result_key', "")
+            )
+
+            updated_task_values.save(redis_client=task_client)
+            self.build_triggered()
+        else:
+            err_msg = (
+                "Current entry could not be parsed:\n{0}".format(dumps(task_values.to_dict(), indent=4))
+            )
+            print(err_msg)
+            self.write_to_disk_file(content=err_msg, log_file_type='errors')
+            return
+
+        self.log_task_event(
+            event='task_state', task_id=task_values.task_id, task_values=task_values,
+            new_state='ERASED' if action_label == 'ERASE' else updated_task_values.status,
+            action=action_label, bamboo_status=task_processing_data.get('bamboo_status'),
+            bamboo_latency=bamboo_latency, data=task_processing_data.get('data'),
+            timeline=updated_task_values.timeline
+        )
+
+    def __sweep(self, redis_client=None):
+        # The tasks are read and written as bytes (see 'task_codec')
+        task_client = RedisCommunication.client(raw=True)
+
+        sweep_start_time = time()
+        sweep_tasks = 0
+        sweep_states = dict()
+
+        # {bamboo_server: [task records]}: read in batches (one round trip each), then processed server by server
+        server_tasks = dict()
+        for db_entry, db_entry_values in TaskDump(redis_client=task_client).entries(parse=False):
+            '''
+            MIGHT BE USEFUL IN THE FUTURE
+
+
+            db_entry_values = {}
+            entry_type = redis_client.type(db_entry)
+
+            if entry_type == 'KV' or entry_type == 'string':
+                db_entry_values = redis_client.get(db_entry)
+            if entry_type == 'HGETALL':
+                db_entry_values = redis_client.hgetall(db_entry)
+            if entry_type == 'ZRANGE':
+                db_entry_values = redis_client.zrange(db_entry, 0, -1)
+            '''
+
+            # Decoded once: the processing and the updates work on the record
+            try:
+                db_entry_task_values = TaskRecord.decode(task_id=db_entry, task_data=db_entry_values)
+            except ValueError as err:
+                err_msg_ = "Error when getting values for entry: '{entry}': {err}".format(entry=db_entry, err=err)
+                print(err_msg_)
+                self.write_to_disk_file(content=err_msg_, log_file_type='errors')
+                continue
+
+            sweep_tasks += 1
+            task_state = db_entry_task_values.status
+            sweep_states[task_state] = sweep_states.get(task_state, 0) + 1
+
+            server_tasks.setdefault(db_entry_task_values.bamboo_server, []).append(db_entry_task_values)
+
+        # One thread per Bamboo server (at most 'server_threads'), so a slow server does not delay the others. In this
+        # thread when profiling (the profiler only sees this thread), for a single server or a single thread
+        server_threads = min(len(server_tasks), max(config.WORKER_SERVER_THREADS or 1, 1))
+        if self.profile_dir or server_threads <= 1:
+            for bamboo_server, task_records in server_tasks.items():
+                self.server_unit(bamboo_server=bamboo_server).process_server_tasks(task_records=task_records,
+                                                                                   task_client=task_client)
+        else:
+            with ThreadPoolExecutor(max_workers=server_threads, thread_name_prefix="sweep") as executor:
+                futures = [
+                    executor.submit(self.server_unit(bamboo_server=bamboo_server).process_server_tasks,
+                                    task_records=task_records, task_client=task_client)
+                    for bamboo_server, task_records in server_tasks.items()
+                ]
+                # Raises the errors of the threads, as when the tasks were processed in this thread
+                for future in futures:
+                    future.result()
+
+        sweep_time = time() - sweep_start_time
+
+        SWEEP_DURATION.observe(sweep_time)
+        TASKS_PER_STATE.reset()
+        for task_state, tasks_count in sweep_states.items():
+            TASKS_PER_STATE.set(tasks_count, state=task_state)
+        RedisCommunication.observe_pool_stats()
+        redis_client.setex(WORKER_METRICS_KEY, WORKER_METRICS_TTL, REGISTRY.render())
+
+        return {'tasks': sweep_tasks, 'states': sweep_states, 'duration': sweep_time}
+
 
 def main():
     """The main function."""
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', dest='dump', required=False, help='Dump Redis DB content on screen!')
+    parser.add_argument('--status', dest='status', required=False, help='Only dump the tasks with this status!')
+    parser.add_argument('--product', dest='product', required=False, help='Only dump the tasks of this product!')
     parser.add_argument('-f', dest='flush', required=False, help='Flush Redis DB content!')
     parser.add_argument('-v', dest='verbose', required=False, help='Get verbose about the output!')
+    parser.add_argument('-p', dest='profile', required=False, help='Profile every sweep (files in logs/profiles)!')
     args = parser.parse_args()
 
-    task_pu = TasksProcessingUnit(verbose=bool(args.verbose), path_to_parent_dir=path.dirname(path.abspath(__file__)))
+    REGISTRY.prefix = "bamboo_worker"
+
+    task_pu = TasksProcessingUnit(verbose=bool(args.verbose), path_to_parent_dir=path.dirname(path.abspath(__file__)),
+                                  profile=bool(args.profile))
 
-    redis_comm = RedisCommunication()
-    redis_client = redis_comm.CLIENT
+    redis_client = RedisCommunication.client()
 
-    # Dump Redis DB on screen
+    # Dump Redis DB on screen: one JSON line per task, printed batch by batch
     if bool(args.dump):
-        dump_content = dict()
-        for key in redis_client.scan_iter():
-            dump_content.update({key: loads(redis_client.get(key))})
+        task_dump = TaskDump(redis_client=RedisCommunication.client(raw=True), status=args.status, product=args.product)
 
-        if not dump_content:
-            print("\nRedis DB is empty\n")
-        else:
-            print(dumps(dump_content, indent=4))
+        dumped_tasks = 0
+        for task_id, task in task_dump.entries(parse=False):
+            sys.stdout.write(TaskDump.ndjson_line(task_id=task_id, task=task).decode())
+            dumped_tasks += 1
+
+        if not dumped_tasks:
+            print("\nRedis DB is empty\n" if not task_dump.filtered else "\nNo task matches the filters\n")
 
         # Exit app after dump
         sys.exit(0)
@@ -646,88 +1199,7 @@ def main():
     no_of_retries = 3
     while no_of_retries:
         try:
-            for db_entry in redis_client.scan_iter():
-                '''
-                MIGHT BE USEFUL IN THE FUTURE
-
-
-                db_entry_values = {}
-                entry_type = redis_client.type(db_entry)
-
-                if entry_type == 'KV' or entry_type == 'string':
-                    db_entry_values = redis_client.get(db_entry)
-                if entry_type == 'HGETALL':
-                    db_entry_values = redis_client.hgetall(db_entry)
-                if entry_type == 'ZRANGE':
-                    db_entry_values = redis_client.zrange(db_entry, 0, -1)
-                '''
-
-                db_entry_values = redis_client.get(db_entry)
-                if not db_entry_values:
-                    err_msg_ = "Error when getting values for entry: '{entry}'".format(entry=db_entry)
-                    print(err_msg_)
-                    task_pu.write_to_disk_file(content=err_msg_, log_file_type='errors')
-                    continue
-
-                task_processing_status = task_pu.process_task(value_to_process=db_entry_values)
-                if not task_processing_status.code:
-                    err_msg = "Error when processing task!\n'{err}'".format(err=task_processing_status.data)
-                    print(err_msg)
-                    task_pu.write_to_disk_file(content=err_msg, log_file_type='errors')
-                    continue
-
-                task_processing_data = task_processing_status.data
-                if (
-                    task_processing_data.get('action_label') == 'IN_PROGRESS' or
-                    task_processing_data.get('action_label') == 'POST_FINISHED_OPS'
-                ):
-                    continue
-                elif task_processing_data.get('action_label') == 'FINISHED':
-                    updated_db_entry_values = loads(db_entry_values)
-
-                    updated_db_entry_values['bamboo_state'] = task_processing_data.get('bamboo_status')
-                    updated_db_entry_values['post_operation'] = task_processing_data.get('post_operation')
-                    updated_db_entry_values['artifacts'] = task_processing_data.get('artifacts')
-                    updated_db_entry_values['status'] = 'FINISHED'
-
-                    # Add plan stopped time in DB if action_label == 'FINISHED'
-                    build_stop_time = task_processing_data.get('build_stop_time')
-                    if build_stop_time:
-                        updated_db_entry_values['build_stop_time'] = task_processing_data.get('build_stop_time')
-
-                    # Add to Redis DB
-                    redis_client.set(db_entry, dumps(updated_db_entry_values))
-                elif task_processing_data.get('action_label') == 'ERASE':
-                    if bool(args.verbose):
-                        print(task_processing_data.get('data'))
-
-                    # Remove the entry from DB as there is no
-                    redis_client.delete(db_entry)
-                elif task_processing_data.get('action_label') == 'PLAN_TRIGGERED':
-                    updated_db_entry_values = loads(db_entry_values)
-
-                    updated_db_entry_values['bamboo_build_key_api'] = \
-                        task_processing_status.data.get('build_plan_url', "")
-                    updated_db_entry_values['bamboo_build_result_key'] = task_processing_data.get('build_result_key')
-                    updated_db_entry_values['bamboo_state'] = 'STARTED_IN_PROGRESS'
-                    updated_db_entry_values['build_start_time'] = task_processing_data.get('build_start_time', 0)
-                    updated_db_entry_values['status'] = 'IN_PROGRESS'
-
-                    # E.g: https://bamboo.com/rest/api/latest/result/ABC-XYZ-100
-                    parsed_uri = urlparse(task_processing_data.get('build_plan_url', ""))
-                    browse_url = '{uri.scheme}://{uri.netloc}/'.format(uri=parsed_uri)
-                    updated_db_entry_values['bamboo_build_url'] = "{url}browse/{key}".format(
-                        url=browse_url, key=task_processing_data.get('build_result_key', "")
-                    )
-
-                    redis_client.set(db_entry, dumps(updated_db_entry_values))
-                else:
-                    err_msg = (
-                        "Current entry could not be parsed:\n{0}".format(dumps(loads(redis_client.get(db_entry)),
-                                                                               indent=4))
-                    )
-                    print(err_msg)
-                    task_pu.write_to_disk_file(content=err_msg, log_file_type='errors')
+            task_pu.process_sweep(redis_client=redis_client)
 
             # Add a delay of 60 seconds before performing another search
             sleep(60)
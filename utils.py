@@ -4,8 +4,17 @@
 """Utils module: A collection of useful methods."""
 
 
+import atexit
+import math
+import random
+import threading
+
 from datetime import datetime
-from os import path
+from json import dumps
+from os import makedirs, path
+
+from json_utils import JsonUtils
+from task_codec import TaskCodec
 
 
 class FileUtils(object):
@@ -33,17 +42,9 @@ class FileUtils(object):
         if not self.disk_file or not content:
             return
 
-        current_date = datetime.now()
-
         try:
             with open(self.disk_file, 'a+') as file_handle:
-                header = "*" * 120
-
-                file_content = str(
-                    "\n{header}\n{date}\t{content}".format(header=header, date=current_date, content=content)
-                )
-
-                file_handle.write(file_content)
+                file_handle.write(LogEventUtils.format_event(event='message', message=content))
         except Exception as err:
             print(
                 "\nError when trying to write status on disk log file: [{file}]\n\t{err}\n".format(file=self.disk_file,
@@ -92,3 +93,510 @@ class LoggingUtils(object):
             'errors': err_log_file,
             'misc': misc_log_file,
         }
+
+
+class LogEventUtils(object):
+    """Utilities for the structured (JSON lines) log events."""
+
+    @staticmethod
+    def format_event(event=None, current_date=None, **fields):
+        """Format a log event as one JSON line.
+        :param event: Name of the event (e.g.: <message/task_state/task_error/sweep>) [string]
+        :param current_date: Time of the event, defaults to now [datetime]
+        :param fields: Fields of the event
+        :return: JSON line [string]
+        """
+
+        current_date = current_date or datetime.now()
+        event_values = {'ts': round(current_date.timestamp(), 6), 'time': current_date.isoformat(), 'event': event}
+        event_values.update(fields)
+
+        return dumps(event_values, default=str) + "\n"
+
+
+class BufferedLogWriter(object):
+    """Buffered writer for the log files.
+
+    The log files are kept open and the JSON lines entries are only appended to in-memory buffers by the caller.
+    A background thread writes the buffers to disk when they grow over 'flush_size' bytes or every 'flush_interval'
+    seconds.
+    The files are rotated daily, based on the date of each entry.
+    """
+
+    def __init__(self, path_to_parent_dir=None, flush_size=64 * 1024, flush_interval=1.0):
+        """Create the BufferedLogWriter instance object.
+        :param path_to_parent_dir: Full path to parent dir where to write logs [string]
+        :param flush_size: Number of buffered bytes which triggers a write to disk [int]
+        :param flush_interval: Maximum number of seconds an entry stays in memory [float]
+        """
+        self.__path_to_parent_dir = path_to_parent_dir
+        self.__flush_size = flush_size
+        self.__flush_interval = flush_interval
+
+        # {(log_file_type, date): [entries]}
+        self.__buffers = dict()
+        self.__buffered_size = 0
+        # {log_file_type: (date, file handle)}
+        self.__file_handles = dict()
+
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__flush_event = threading.Event()
+        self.__closed = False
+
+        self.__flush_thread = threading.Thread(target=self.__flush_loop, name="log-writer", daemon=True)
+        self.__flush_thread.start()
+
+        atexit.register(self.close)
+
+    @property
+    def path_to_parent_dir(self):
+        """Get the path to the parent directory."""
+        return self.__path_to_parent_dir
+
+    def log_file_path(self, log_file_type=None, log_date=None):
+        """Compute the path of a log file.
+        :param log_file_type: Type of the log file (errors/bamboo/misc/events) [string]
+        :param log_date: Date of the log file [date]
+        :return: Full path to the log file [string]
+        """
+        return path.join(self.path_to_parent_dir, "logs", log_file_type,
+                         "{type}_{date}.jsonl".format(type=log_file_type, date=log_date))
+
+    def write(self, content=None, log_file_type=None):
+        """Queue a free text message for the corresponding log file. Does not touch the disk.
+        :param content: Content to write on disk file [string]
+        :param log_file_type: Type of the log file (errors/bamboo/misc/events) [string]
+        """
+
+        if not content:
+            return
+
+        self.emit(log_file_type=log_file_type, event='message', message=content)
+
+    def emit(self, log_file_type=None, event=None, **fields):
+        """Queue a structured event for the corresponding log file. Does not touch the disk.
+        :param log_file_type: Type of the log file (errors/bamboo/misc/events) [string]
+        :param event: Name of the event [string]
+        :param fields: Fields of the event
+        """
+
+        if not self.path_to_parent_dir or not event or not log_file_type or self.__closed:
+            return
+
+        current_date = datetime.now()
+        entry = LogEventUtils.format_event(event=event, current_date=current_date, **fields)
+
+        with self.__lock:
+            self.__buffers.setdefault((log_file_type, current_date.date()), []).append(entry)
+            self.__buffered_size += len(entry)
+            flush_now = self.__buffered_size >= self.__flush_size
+
+        if flush_now:
+            self.__flush_event.set()
+
+    def flush(self):
+        """Write all the buffered entries to disk."""
+
+        with self.__lock:
+            buffers, self.__buffers = self.__buffers, dict()
+            self.__buffered_size = 0
+
+        if not buffers:
+            return
+
+        # Only one thread touches the file handles at a time
+        with self.__flush_lock:
+            for (log_file_type, log_date), entries in sorted(buffers.items(), key=lambda item: item[0][1]):
+                try:
+                    file_handle = self.__file_handle(log_file_type=log_file_type, log_date=log_date)
+                    file_handle.write("".join(entries))
+                    file_handle.flush()
+                except Exception as err:
+                    print(
+                        "\nError when trying to write status on disk log file: [{file}]\n\t{err}\n".format(
+                            file=self.log_file_path(log_file_type=log_file_type, log_date=log_date), err=err)
+                    )
+
+    def close(self):
+        """Write all the buffered entries to disk and close the log files."""
+
+        if self.__closed:
+            return
+
+        self.__closed = True
+        self.__flush_event.set()
+        self.__flush_thread.join(timeout=5)
+
+        self.flush()
+        with self.__flush_lock:
+            for _, file_handle in self.__file_handles.values():
+                file_handle.close()
+            self.__file_handles.clear()
+
+    def __file_handle(self, log_file_type=None, log_date=None):
+        opened_date, file_handle = self.__file_handles.get(log_file_type, (None, None))
+        if file_handle and opened_date == log_date:
+            return file_handle
+
+        # Date boundary: rotate to the file of the new day
+        if file_handle:
+            file_handle.close()
+
+        log_file_path = self.log_file_path(log_file_type=log_file_type, log_date=log_date)
+        makedirs(path.dirname(log_file_path), exist_ok=True)
+        file_handle = open(log_file_path, 'a+')
+        self.__file_handles[log_file_type] = (log_date, file_handle)
+
+        return file_handle
+
+    def __flush_loop(self):
+        while not self.__closed:
+            self.__flush_event.wait(timeout=self.__flush_interval)
+            self.__flush_event.clear()
+            self.flush()
+
+
+class RedisKeyUtils(object):
+    """Utilities for the names of the keys kept in Redis.
+
+    Tasks are stored under their SHA512 ID. Everything else the service keeps in Redis (caches, counters etc.) lives
+    under the internal prefix so it is never picked up as a task.
+    """
+
+    INTERNAL_PREFIX = "bamboo_api_internal"
+
+    @staticmethod
+    def internal_key(*parts):
+        """Compound the name of an internal key.
+        :param parts: Parts of the key name [strings]
+        :return: Key name [string]
+        """
+        return ":".join((RedisKeyUtils.INTERNAL_PREFIX,) + tuple(str(part) for part in parts))
+
+    @staticmethod
+    def task_key(task_id=None, *parts):
+        """Compound the name of an internal key which belongs to a task (e.g. its counters).
+
+        The task ID is the hash tag of the key ('{<task_id>}'): Redis Cluster hashes only the tag, which is also the
+        whole name of the task key, so the task and its keys share a slot and can be used in the same MULTI/EXEC or
+        multi-key command.
+        :param task_id: ID of the task [string]
+        :param parts: Parts of the key name [strings]
+        :return: Key name [string]
+        """
+        return RedisKeyUtils.internal_key(*(parts + ("{" + task_id + "}",)))
+
+    @staticmethod
+    def task_id_of(key):
+        """Get the ID of the task a key belongs to.
+        :param key: Redis key: a task or a key from 'task_key()' [string]
+        :return: Task ID, None for the other internal keys [string]
+        """
+
+        if RedisKeyUtils.is_task_key(key):
+            return key
+        if key.endswith("}") and "{" in key:
+            return key[key.rindex("{") + 1:-1]
+        return None
+
+    @staticmethod
+    def is_task_key(key):
+        """Check if the Redis key holds a task.
+        :param key: Redis key [string]
+        """
+        return not key.startswith(RedisKeyUtils.INTERNAL_PREFIX)
+
+
+class BackoffUtils(object):
+    """Delays between the attempts of a failing operation."""
+
+    @staticmethod
+    def delay(failures=1, base=30.0, maximum=900.0):
+        """Get the delay before the next attempt: doubled on every failure, with jitter so that the operations which
+        failed together (e.g.: during an outage) are not all tried again at once.
+        :param failures: Consecutive failures so far [int]
+        :param base: Delay after the first failure, in seconds [float]
+        :param maximum: Maximum delay, in seconds [float]
+        :return: Delay in seconds [float]
+        """
+
+        ceiling = min(maximum, base * 2 ** (min(max(failures, 1), 32) - 1))
+
+        # At least half of the exponential delay
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class StatsUtils(object):
+    """Utilities for statistics."""
+
+    @staticmethod
+    def percentile(values=None, percent=None):
+        """Compute a percentile using the nearest-rank method.
+        :param values: Sorted values [list]
+        :param percent: Percentile to compute (0-100) [float]
+        """
+
+        if not values:
+            return None
+
+        rank = max(int(math.ceil(percent / 100.0 * len(values))) - 1, 0)
+        return values[min(rank, len(values) - 1)]
+
+    @staticmethod
+    def summary(values=None):
+        """Summarise a list of samples.
+        :param values: Samples [list]
+        :return: {count, min, max, p50, p95, p99} [dictionary]
+        """
+
+        values = sorted(values or [])
+        return {
+            'count': len(values),
+            'min': values[0] if values else None,
+            'max': values[-1] if values else None,
+            'p50': StatsUtils.percentile(values, 50),
+            'p95': StatsUtils.percentile(values, 95),
+            'p99': StatsUtils.percentile(values, 99)
+        }
+
+
+class LatencyStats(object):
+    """Latency samples of the task life cycle phases, per product, kept in Redis.
+
+    Phases:
+        queue_wait       task inserted -> trigger request sent to Bamboo
+        trigger_latency  trigger request sent -> Bamboo answered
+        detection_lag    Bamboo build completed -> the worker noticed it
+        artifact_crawl   finish noticed -> artifacts links crawled
+        end_to_end       task inserted -> task done (finished, with artifacts when needed)
+    """
+
+    PHASES = ('queue_wait', 'trigger_latency', 'detection_lag', 'artifact_crawl', 'end_to_end')
+
+    # {phase: (start point, end point)} in the task timeline
+    PHASE_POINTS = {
+        'queue_wait': ('inserted', 'trigger_sent'),
+        'trigger_latency': ('trigger_sent', 'triggered'),
+        'detection_lag': ('bamboo_finished', 'finish_detected'),
+        'artifact_crawl': ('finish_detected', 'artifacts_crawled'),
+        'end_to_end': ('inserted', 'done')
+    }
+
+    def __init__(self, redis_client=None, max_samples=1000):
+        """Create the LatencyStats instance object.
+        :param redis_client: Redis client [StrictRedis]
+        :param max_samples: Number of samples kept per product and phase [int]
+        """
+        self.__redis_client = redis_client
+        self.__max_samples = max_samples
+
+    @property
+    def redis_client(self):
+        """Get the Redis client."""
+        return self.__redis_client
+
+    @staticmethod
+    def samples_key(product=None, phase=None):
+        """Compound the Redis key holding the samples of a product phase."""
+        return RedisKeyUtils.internal_key("latency", product, phase)
+
+    @staticmethod
+    def products_key():
+        """Compound the Redis key holding the names of the products with samples."""
+        return RedisKeyUtils.internal_key("latency", "products")
+
+    def record(self, product=None, samples=None):
+        """Record latency samples for a product.
+        :param product: The name of the product [string]
+        :param samples: {phase: seconds} [dictionary]
+        """
+
+        samples = {phase: value for phase, value in (samples or {}).items() if value is not None and value >= 0}
+        if not self.redis_client or not samples:
+            return
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.sadd(self.products_key(), product)
+            for phase, value in samples.items():
+                pipeline.lpush(self.samples_key(product=product, phase=phase), round(value, 6))
+                pipeline.ltrim(self.samples_key(product=product, phase=phase), 0, self.__max_samples - 1)
+            pipeline.execute()
+        except Exception as err:
+            print("Error when recording latency samples: {err}".format(err=err))
+
+    def stats(self, product=None):
+        """Get the percentiles of every phase.
+        :param product: The name of the product, all products if not supplied [string]
+        :return: {product: {phase: {count, min, max, p50, p95, p99}}} [dictionary]
+        """
+
+        if not self.redis_client:
+            return {}
+
+        products = [product] if product else sorted(self.redis_client.smembers(self.products_key()))
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for product_name in products:
+            for phase in self.PHASES:
+                pipeline.lrange(self.samples_key(product=product_name, phase=phase), 0, -1)
+        samples = iter(pipeline.execute())
+
+        stats = dict()
+        for product_name in products:
+            stats[product_name] = {
+                phase: StatsUtils.summary([float(value) for value in next(samples)]) for phase in self.PHASES
+            }
+
+        return stats
+
+    @staticmethod
+    def timeline_samples(timeline=None, end_points=None):
+        """Compute the latency samples which can be derived from a task timeline.
+        :param timeline: {point: epoch timestamp} [dictionary]
+        :param end_points: Only compute the phases ending in one of these points [iterable]
+        :return: {phase: seconds} [dictionary]
+        """
+
+        timeline = timeline or {}
+
+        samples = dict()
+        for phase, (start_point, end_point) in LatencyStats.PHASE_POINTS.items():
+            if end_points is not None and end_point not in end_points:
+                continue
+
+            if timeline.get(start_point) is not None and timeline.get(end_point) is not None:
+                samples[phase] = timeline[end_point] - timeline[start_point]
+
+        return samples
+
+
+class TaskDump(object):
+    """Reads the tasks of the Redis DB in batches: the keys come from SCAN, the values of each batch from one
+    pipelined round trip. Nothing is accumulated, so the memory does not grow with the DB.
+    """
+
+    def __init__(self, redis_client=None, batch_size=500, status=None, product=None):
+        """Create the TaskDump instance object.
+        :param redis_client: Redis client returning bytes (see 'RedisUtils.client(raw=True)') [StrictRedis]
+        :param batch_size: Keys per SCAN call and per pipeline [int]
+        :param status: Only the tasks with this status, all if not supplied [string]
+        :param product: Only the tasks of this product, all if not supplied [string]
+        """
+        self.__redis_client = redis_client
+        self.__batch_size = batch_size
+        self.__status = status
+        self.__product = product
+
+    @property
+    def redis_client(self):
+        """Get the Redis client."""
+        return self.__redis_client
+
+    @property
+    def batch_size(self):
+        """Get the number of keys per batch."""
+        return self.__batch_size
+
+    @property
+    def filtered(self):
+        """Check if only some of the tasks are dumped."""
+        return bool(self.__status or self.__product)
+
+    def matches(self, task_values=None):
+        """Check if a task passes the filters.
+        :param task_values: The task [dictionary]
+        """
+
+        if self.__status and task_values.get('status') != self.__status:
+            return False
+        if self.__product and task_values.get('product_name') != self.__product:
+            return False
+        return True
+
+    def fetch(self, keys=None, parse=True):
+        """Get the tasks of a batch of keys, in one round trip.
+        :param keys: Task keys [list]
+        :param parse: Decode the tasks; when False, the tasks are returned as stored (no filtering) [bool]
+        :return: Generator of (task ID, task) [tuple]
+        """
+
+        if not keys:
+            return
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(key)
+
+        for key, task_data in zip(keys, pipeline.execute()):
+            # Erased since the SCAN
+            if task_data is None:
+                continue
+
+            if not parse:
+                yield key, task_data
+                continue
+
+            try:
+                task_values = TaskCodec.decode(task_data)
+            except ValueError as err:
+                print("Error when decoding the task '{key}': {err}".format(key=key, err=err))
+                continue
+
+            if self.matches(task_values):
+                yield key, task_values
+
+    def entries(self, parse=True):
+        """Get all the tasks, batch by batch.
+        :param parse: Decode the tasks (always done when filtering) [bool]
+        :return: Generator of (task ID, task) [tuple]
+        """
+
+        parse = parse or self.filtered
+
+        keys = list()
+        for key in self.redis_client.scan_iter(count=self.batch_size):
+            key = key.decode() if isinstance(key, bytes) else key
+            if not RedisKeyUtils.is_task_key(key):
+                continue
+
+            keys.append(key)
+            if len(keys) >= self.batch_size:
+                yield from self.fetch(keys=keys, parse=parse)
+                keys = list()
+
+        yield from self.fetch(keys=keys, parse=parse)
+
+    def page(self, cursor=0, count=None):
+        """Get a page of tasks. The cursor is the SCAN cursor: the pages never repeat nor skip a task which exists for
+        the whole walk, but a page holds at most 'count' tasks (fewer when filtering) and may be empty.
+        :param cursor: Cursor returned with the previous page, 0 for the first one [int]
+        :param count: Keys to read for the page [int]
+        :return: (next cursor (0 when done), {task ID: task}) [tuple]
+        """
+
+        count = count or self.batch_size
+
+        keys = list()
+        while True:
+            cursor, batch = self.redis_client.scan(cursor=cursor, count=count)
+            keys.extend(key for key in (key.decode() if isinstance(key, bytes) else key for key in batch)
+                        if RedisKeyUtils.is_task_key(key))
+            if not int(cursor) or len(keys) >= count:
+                break
+
+        return int(cursor), dict(self.fetch(keys=keys))
+
+    @staticmethod
+    def ndjson_line(task_id=None, task=None):
+        """Format a task as a line of NDJSON: {"id": ..., "task": {...}}.
+        :param task_id: ID of the task [string]
+        :param task: The task, decoded [dictionary] or as stored [bytes or string]
+        :return: The line [bytes]
+        """
+
+        if not isinstance(task, dict):
+            # Legacy JSON is sent as is, without decoding and encoding it again
+            return b'{"id": ' + JsonUtils.dumps(task_id) + b', "task": ' + TaskCodec.to_json(task) + b'}\n'
+        return JsonUtils.dumps({'id': task_id, 'task': task}) + b"\n"